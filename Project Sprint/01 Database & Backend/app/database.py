@@ -1,3 +1,4 @@
+from sqlalchemy import inspect
 from sqlmodel import SQLModel, create_engine
 
 sqlite_file_name = "database.db"
@@ -7,3 +8,15 @@ engine = create_engine(sqlite_url, echo=True)
 
 def init_db():
     SQLModel.metadata.create_all(engine)
+    _add_missing_columns()
+
+def _add_missing_columns():
+    """create_all never alters existing tables: add nullable columns introduced since a table was created."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    ddl_type = column.type.compile(engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {ddl_type}')
@@ -9,7 +9,11 @@ except Exception:
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.database import init_db
+from sqlmodel import Session
+
+from app.database import init_db, engine
+from app.services.dispatcher import dispatcher
+from app.services import day_planner, decision_log, eta_cache, eta_model, http_client, leader, routing, zone_matrix
 from app.routers import users, drivers, ride_requests
 
 # Optional: include analytics router only if present
@@ -34,6 +38,33 @@ app.add_middleware(
 @app.on_event("startup")
 def on_startup():
     init_db()  # creates tables if they don't exist
+    day_planner.fail_orphaned_jobs()  # plan jobs left queued/running by a stopped process
+    eta_cache.load_eta_cache()  # ETA_CACHE_PATH: Maps answers from the previous run
+    routing.preload()  # ROUTING_BACKEND=local: road graph + hierarchy before the first request
+    if not leader.coordinator.enabled:
+        # driver store, indexes, queues; with DISPATCH_LEADER only the leader loads them
+        with Session(engine) as session:
+            leader.load_dispatch_state(session)
+
+@app.on_event("startup")
+async def start_dispatcher():
+    dispatcher.start()  # scheduled-ride wheel + workers for DISPATCH_MODE
+    eta_model.start_retraining()  # learned ETAs, refreshed every ETA_MODEL_RETRAIN_SEC
+    zone_matrix.start_refreshing()  # zone-to-zone ETAs built from the model
+    decision_log.writer.start(engine)  # dispatch decision rows, written off the request thread
+    leader.coordinator.start()  # DISPATCH_LEADER: elect one dispatcher across workers
+
+@app.on_event("shutdown")
+async def stop_dispatcher():
+    await leader.coordinator.stop()
+    await dispatcher.stop()
+    await eta_model.stop_retraining()
+    await zone_matrix.stop_refreshing()
+    decision_log.writer.stop()
+    day_planner.stop_pool()
+    http_client.close()  # pooled Maps connections
+    await http_client.aclose()
+    eta_cache.save_eta_cache()
 
 # --- Routers ---
 app.include_router(users.router)
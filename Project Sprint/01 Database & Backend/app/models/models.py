@@ -56,6 +56,9 @@ class RideRequest(SQLModel, table=True):
     dropoff_lat: Optional[float] = None
     dropoff_lng: Optional[float] = None
 
+    # only drivers with this Driver.vehicle_type may serve the ride (None: any)
+    required_vehicle_type: Optional[str] = None
+
     # lifecycle: "requested", "assigned", "ongoing", "completed", "cancelled"
     status: str = "requested"
 
@@ -71,3 +74,60 @@ class RideRequest(SQLModel, table=True):
 
     user: Optional[User] = Relationship(back_populates="ride_requests")
     driver: Optional[Driver] = Relationship(back_populates="ride_requests")
+
+
+# -------------------------
+# DISPATCH DECISION (append-only log, one row per assignment attempt)
+# -------------------------
+class DispatchDecision(SQLModel, table=True):
+    decision_id: Optional[int] = Field(default=None, primary_key=True)
+    ride_id: Optional[int] = Field(default=None, index=True)
+    driver_id: Optional[int] = None  # None: no driver was assigned
+    path: str  # "single", "reserved" or "batch"
+    decided_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+    candidates: int = 0
+    maps_calls: int = 0
+
+    # wall-clock milliseconds
+    total_ms: float = 0.0
+    db_ms: float = 0.0
+    maps_ms: float = 0.0
+    scoring_ms: float = 0.0
+
+    best_score: Optional[float] = None
+    runner_up_margin: Optional[float] = None  # second-best score minus best
+
+
+# -------------------------
+# DISPATCH LEASE (one row per lease; the holder runs the dispatcher)
+# -------------------------
+class DispatchLease(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    holder: str
+    expires_at: float  # epoch seconds
+
+
+# -------------------------
+# GEOCODE CACHE (normalized address -> coordinates; lat/lng None caches a miss)
+# -------------------------
+class GeocodeCacheEntry(SQLModel, table=True):
+    address_key: str = Field(primary_key=True)  # "<scope>:<normalized address>"
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    cached_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+# -------------------------
+# DAY PLAN JOB (background day planner runs; result is the plan as JSON)
+# -------------------------
+class DayPlanJob(SQLModel, table=True):
+    job_id: str = Field(primary_key=True)
+    day: str  # ISO date
+    budget_sec: float
+    status: str = "queued"  # queued | running | done | failed
+    result: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    finished_at: Optional[datetime] = None
+    owner_pid: Optional[int] = None  # process whose runner holds the job; see day_planner.fail_orphaned_jobs
@@ -1,8 +1,15 @@
 from fastapi import APIRouter, Depends
 from sqlmodel import Session
 from ..database import engine
-from ..services.analytics import rides_per_day, avg_wait_minutes
-from ..services.google_maps import get_eta_and_distance_minutes
+from ..services.analytics import rides_per_day, avg_wait_minutes, dispatch_decision_summary
+from ..services.decision_log import writer as decision_writer
+from ..services import http_client, single_flight
+from ..services.geocode_cache import geocode_cache
+from ..services.eta_cache import eta_cache
+from ..services.google_maps_async import get_eta_and_distance_minutes
+from ..services.pending_queue import pending_queue
+from ..services.eta_model import accuracy_report, current_model, retrain
+from ..services.zone_matrix import current_matrix
 
 router = APIRouter(prefix="/analytics", tags=["Analytics"])
 
@@ -18,15 +25,78 @@ def get_rides_per_day(days: int = 7, session: Session = Depends(get_session)):
 def get_avg_wait_time(days: int = 30, session: Session = Depends(get_session)):
     return avg_wait_minutes(session, days)
 
+@router.get("/dispatch-decisions")
+def get_dispatch_decisions(hours: int = 24, slowest: int = 5, session: Session = Depends(get_session)):
+    """
+    Assignment cost breakdown (DB, Maps, scoring time; candidates; Maps calls;
+    score margins) over the last `hours`, with the slowest decisions listed.
+    """
+    summary = dispatch_decision_summary(session, hours, slowest)
+    summary["writer"] = decision_writer.stats()
+    return summary
+
+@router.get("/pending-queue")
+def get_pending_queue():
+    """Rides waiting for a free driver: queue depth and wait times in minutes."""
+    return pending_queue.stats()
+
+
+@router.get("/eta-model")
+def get_eta_model(holdout: float = 0.2, session: Session = Depends(get_session)):
+    """
+    Learned ETA model: what it was trained on, plus its error against the Maps
+    durations of the newest `holdout` share of completed rides.
+    """
+    return {"model": current_model().summary(), "accuracy": accuracy_report(session, holdout)}
+
+
+@router.post("/eta-model/retrain")
+def retrain_eta_model(session: Session = Depends(get_session)):
+    return retrain(session).summary()
+
 
 @router.get("/eta")
-def get_eta(origin_lat: float, origin_lng: float, dest_lat: float, dest_lng: float):
+async def get_eta(origin_lat: float, origin_lng: float, dest_lat: float, dest_lng: float, exact: bool = True):
     """
     Return ETA in minutes and distance in km between origin and destination using Google Distance Matrix.
+    With exact=false the precomputed zone-to-zone matrix answers first (zone-level accuracy, no API call).
     Example: /analytics/eta?origin_lat=14.56&origin_lng=120.99&dest_lat=14.57&dest_lng=121.00
     """
-    res = get_eta_and_distance_minutes(origin_lat, origin_lng, dest_lat, dest_lng)
+    res = None
+    source = "maps"
+    if not exact:
+        res = current_matrix().lookup(origin_lat, origin_lng, dest_lat, dest_lng)
+        source = "zone_matrix"
+    if res is None:
+        res = await get_eta_and_distance_minutes(origin_lat, origin_lng, dest_lat, dest_lng)
+        source = "maps"
     if res is None:
-        return {"duration_min": None, "distance_km": None}
+        return {"duration_min": None, "distance_km": None, "source": None}
     duration_min, distance_km = res
-    return {"duration_min": round(duration_min, 1), "distance_km": round(distance_km, 2)}
+    return {"duration_min": round(duration_min, 1), "distance_km": round(distance_km, 2), "source": source}
+
+
+@router.get("/maps-http")
+def get_maps_http():
+    """
+    Maps HTTP connection pool: requests, pool hits/misses (new connections),
+    limits; plus identical concurrent lookups coalesced into one call.
+    """
+    return {**http_client.stats(), "single_flight": single_flight.stats()}
+
+
+@router.get("/geocode-cache")
+def get_geocode_cache():
+    """Geocode cache: entries in memory, hits per tier (memory, database), misses, hit rate."""
+    return geocode_cache.stats()
+
+
+@router.get("/eta-cache")
+def get_eta_cache():
+    """Snapped-coordinate ETA cache: entries, grid and time bucket, hits, misses, hit rate."""
+    return eta_cache.stats()
+
+
+@router.get("/zone-matrix")
+def get_zone_matrix():
+    return current_matrix().summary()
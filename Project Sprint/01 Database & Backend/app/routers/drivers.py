@@ -1,9 +1,15 @@
+from datetime import datetime, timezone
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel, Field as PydField
+from sqlalchemy import update
 from sqlmodel import Session, select
 from app.database import engine
 from app.models.models import Driver
+from app.services.driver_index import available_drivers, load_available_drivers, vehicle_key
+from app.services.driver_state import driver_states, forget_driver, load_driver_states, sync_driver, verify_driver_states
+from app.services.leader import driver_available
+from app.services.commitments import commitments
 
 router = APIRouter(prefix="/drivers", tags=["Drivers"])
 
@@ -26,12 +32,39 @@ def create_driver(driver: Driver, session: Session = Depends(get_session)):
     session.add(driver)
     session.commit()
     session.refresh(driver)
+    sync_driver(driver)
     return driver
 
 @router.get("/", response_model=List[Driver])
 def get_drivers(session: Session = Depends(get_session)):
     return session.exec(select(Driver)).all()
 
+# ---------- In-memory driver state (must precede /{driver_id}) ----------
+@router.get("/state/verify")
+def verify_state(session: Session = Depends(get_session)):
+    """Diff the in-memory driver state and spatial index against the driver table."""
+    return verify_driver_states(session)
+
+@router.post("/state/rebuild")
+def rebuild_state(session: Session = Depends(get_session)):
+    """Reload the in-memory driver state and spatial index from the database."""
+    cached = load_driver_states(session)
+    indexed = load_available_drivers(session)
+    return {"cached": cached, "indexed": indexed}
+
+@router.get("/pools")
+def get_pools(session: Session = Depends(get_session)):
+    """Drivers per vehicle type and status; "available" is what each candidate pool holds."""
+    if driver_states.loaded:
+        drivers = driver_states.get_many(driver_states.ids())
+    else:
+        drivers = session.exec(select(Driver)).all()
+    pools = {}
+    for d in drivers:
+        counts = pools.setdefault(vehicle_key(d.vehicle_type) or "", {"available": 0, "on_ride": 0, "inactive": 0})
+        counts[d.availability_status] = counts.get(d.availability_status, 0) + 1
+    return {"pools": dict(sorted(pools.items())), "indexed": available_drivers.counts()}
+
 @router.get("/{driver_id}", response_model=Driver)
 def get_driver(driver_id: int, session: Session = Depends(get_session)):
     driver = session.get(Driver, driver_id)
@@ -50,6 +83,7 @@ def update_driver(driver_id: int, updated: Driver, session: Session = Depends(ge
     session.add(driver)
     session.commit()
     session.refresh(driver)
+    sync_driver(driver)
     return driver
 
 @router.delete("/{driver_id}")
@@ -59,6 +93,8 @@ def delete_driver(driver_id: int, session: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Driver not found")
     session.delete(driver)
     session.commit()
+    forget_driver(driver_id)
+    commitments.forget_driver(driver_id)
     return {"message": "Driver deleted"}
 
 # ---------- Extra endpoints used by the app/scheduler ----------
@@ -78,16 +114,54 @@ def set_status(driver_id: int, payload: StatusUpdate, session: Session = Depends
     session.add(driver)
     session.commit()
     session.refresh(driver)
+    sync_driver(driver)
+    if driver.availability_status == "available":
+        # serve the highest-priority waiting ride, else maybe take over a nearby
+        # ride from a driver farther away; the driver may be on_ride again
+        if driver_available(session, driver_id):
+            session.refresh(driver)
     return driver
 
 @router.patch("/{driver_id}/location", response_model=Driver)
 def set_location(driver_id: int, payload: LocationUpdate, session: Session = Depends(get_session)):
-    driver = session.get(Driver, driver_id)
-    if not driver:
+    # single UPDATE instead of read-modify-write; pings are the hottest write path
+    result = session.exec(
+        update(Driver)
+        .where(Driver.driver_id == driver_id)
+        .values(current_lat=payload.lat, current_lng=payload.lng)
+    )
+    if result.rowcount != 1:
         raise HTTPException(status_code=404, detail="Driver not found")
-    driver.current_lat = payload.lat
-    driver.current_lng = payload.lng
-    session.add(driver)
     session.commit()
-    session.refresh(driver)
+    driver = session.get(Driver, driver_id)
+    sync_driver(driver)
     return driver
+
+
+@router.get("/{driver_id}/commitments")
+def get_commitments(
+    driver_id: int,
+    start: Optional[datetime] = Query(None, description="UTC; with end, also report whether the driver is free"),
+    end: Optional[datetime] = Query(None),
+    session: Session = Depends(get_session),
+):
+    """Scheduled rides this driver is booked for, and optionally a free/busy check for [start, end)."""
+    if not session.get(Driver, driver_id):
+        raise HTTPException(status_code=404, detail="Driver not found")
+    result = {
+        "driver_id": driver_id,
+        "commitments": [
+            {"ride_id": ride_id, "start": s.isoformat(), "end": e.isoformat()}
+            for s, e, ride_id in commitments.windows(driver_id)
+        ],
+    }
+    if start is not None and end is not None:
+        if end <= start:
+            raise HTTPException(status_code=400, detail="end must be after start")
+        result["free"] = commitments.is_free(driver_id, _naive_utc(start), _naive_utc(end))
+    return result
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
@@ -1,10 +1,20 @@
-from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, Query
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import update
 from sqlmodel import Session, select
 from ..database import engine
 from ..models.models import RideRequest, User, Driver
-from ..services.scheduler import assign_driver_to_ride
-from ..services.google_maps import make_static_map_url, geocode_location
+from ..services.scheduler import assign_driver_to_ride, vehicle_compatible
+from ..services.google_maps import make_static_map_url
+from ..services.google_maps_async import geocode_location
+from ..services.driver_state import sync_driver
+from ..services.dispatcher import dispatcher
+from ..services.pending_queue import enqueue
+from ..services.day_planner import PLAN_BUDGET_SEC, PLAN_MAX_BUDGET_SEC, get_plan_job, start_plan
+from ..services.commitments import commitments
+from ..services import leader, ride_index
 
 
 router = APIRouter(prefix="/ride-requests", tags=["Ride Requests"])
@@ -26,7 +36,7 @@ def list_rides(user_id: int = Query(None), driver_id: int = Query(None), session
 
 
 @router.post("/")
-def create_ride(req: RideRequest, session: Session = Depends(get_session)):
+def create_ride(req: RideRequest, response: Response, session: Session = Depends(get_session)):
     # 1) Validate user
     user = session.get(User, req.user_id)
     if not user:
@@ -35,16 +45,59 @@ def create_ride(req: RideRequest, session: Session = Depends(get_session)):
     # 2) Initialize lifecycle fields
     req.status = "requested"
     req.requested_at = datetime.utcnow()
+    if isinstance(req.scheduled_for, str):
+        # table models skip validation, so the JSON string arrives as-is
+        req.scheduled_for = _parse_utc(req.scheduled_for)
 
+    # 2b) A driver can only be booked ahead, for the ride's scheduled window
+    booked_driver, req.driver_id = req.driver_id, None
+    reserved_ride = None
     session.add(req)
-    session.commit()
+    if booked_driver is not None:
+        if req.scheduled_for is None:
+            raise HTTPException(status_code=400, detail="driver_id can only be set for scheduled rides")
+        driver = session.get(Driver, booked_driver)
+        if not driver:
+            raise HTTPException(status_code=404, detail="Driver not found")
+        if not vehicle_compatible(driver, req):
+            raise HTTPException(status_code=400, detail="Driver's vehicle does not match required_vehicle_type")
+        session.flush()  # ride_id for the reservation
+        req.driver_id = booked_driver
+        try:
+            reserved = leader.reserve(req, booked_driver)
+        except ConnectionError:
+            raise HTTPException(status_code=503, detail="Dispatcher unavailable, try again shortly")
+        if not reserved:
+            raise HTTPException(status_code=409, detail="Driver is already committed at that time")
+        reserved_ride = req.ride_id
+    try:
+        session.commit()
+    except Exception:
+        # the reservation above was made for a row that now never exists
+        if reserved_ride is not None:
+            leader.release(reserved_ride)
+        raise
     session.refresh(req)
 
+    # 3a) Booked ahead: the dispatcher releases it into assignment shortly before pickup
+    if dispatcher.defer(req):
+        return _accepted(req, response)
+
+    # 3b) Batch/async mode: respond now, the dispatcher assigns a driver in the background
+    if dispatcher.background:
+        dispatcher.submit(req.ride_id)
+        return _accepted(req, response)
+
+    if req.pickup_lat is None or req.pickup_lng is None:
+        # leave as "requested"; without coordinates it can't be matched
+        raise HTTPException(status_code=400, detail="Missing pickup coordinates")
+
     # 3) Try to auto-assign a driver
     assigned = assign_driver_to_ride(session, req)
     if not assigned:
-        # leave as "requested" if no driver or missing coords
-        raise HTTPException(status_code=400, detail="No available drivers or missing pickup coordinates")
+        # no driver free: wait in the pending queue until one becomes available
+        enqueue(session, req)
+        return _accepted(req, response)
 
     # 4) Attach static map URL to the response
     static_map_url = make_static_map_url(assigned.pickup_lat, assigned.pickup_lng, assigned.dropoff_lat, assigned.dropoff_lng)
@@ -52,6 +105,23 @@ def create_ride(req: RideRequest, session: Session = Depends(get_session)):
     response["static_map_url"] = static_map_url
     return response
 
+def _parse_utc(value: str) -> datetime:
+    """ISO-8601 string -> naive UTC datetime (how requested_at is stored)."""
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=422, detail="scheduled_for must be an ISO-8601 datetime")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def _accepted(ride: RideRequest, response: Response) -> dict:
+    """202 body for rides that will be assigned later."""
+    response.status_code = 202
+    pending = ride.dict()
+    pending["static_map_url"] = make_static_map_url(ride.pickup_lat, ride.pickup_lng, ride.dropoff_lat, ride.dropoff_lng)
+    return pending
+
 @router.get("/{ride_id}/static-map")
 def ride_static_map(ride_id: int, session: Session = Depends(get_session)):
     ride = session.get(RideRequest, ride_id)
@@ -61,17 +131,94 @@ def ride_static_map(ride_id: int, session: Session = Depends(get_session)):
     return {"static_map_url": url}
 
 @router.get("/geocode")
-def geocode(address: str = Query(...)):
+async def geocode(address: str = Query(...)):
     """
     Convert an address to latitude and longitude.
     Returns {"lat": <float>, "lng": <float>} or null if not found.
     """
-    coords = geocode_location(address)
+    coords = await geocode_location(address)
     if coords:
         return {"lat": coords[0], "lng": coords[1]}
     return {"lat": None, "lng": None}
 
 
+@router.post("/day-plan", status_code=202)
+def start_day_plan(
+    day: date = Query(None, description="UTC date to plan; defaults to tomorrow"),
+    budget_sec: float = Query(PLAN_BUDGET_SEC, gt=0, le=PLAN_MAX_BUDGET_SEC),
+):
+    """
+    Start planning per-driver itineraries for the scheduled rides of one day.
+    Poll GET /ride-requests/day-plan/{job_id} for the result. Read-only: rides
+    are still released to dispatch by the scheduled-ride timer.
+    """
+    day = day or (datetime.utcnow() + timedelta(days=1)).date()
+    return {"job_id": start_plan(day, budget_sec), "status": "queued"}
+
+
+@router.get("/day-plan/{job_id}")
+def get_day_plan(job_id: str):
+    job = get_plan_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Day plan job not found")
+    return job
+
+
+def _load_ride(ride_id: int):
+    with Session(engine) as session:
+        return session.get(RideRequest, ride_id)
+
+
+@router.get("/{ride_id}", response_model=RideRequest)
+async def get_ride(ride_id: int, wait: float = Query(0, ge=0, le=30, description="Long-poll: seconds to wait for assignment")):
+    """
+    Fetch a ride. With ?wait=N and the ride still "requested", hold the request
+    until the dispatcher has processed it (or N seconds pass).
+    """
+    if wait > 0 and leader.coordinator.following:
+        # the leader process knows when the ride was processed
+        await run_in_threadpool(leader.wait_processed, ride_id, wait)
+        ride = await run_in_threadpool(_load_ride, ride_id)
+    elif wait <= 0 or not dispatcher.running:
+        ride = await run_in_threadpool(_load_ride, ride_id)
+    else:
+        async with dispatcher.watch(ride_id) as processed:
+            ride = await run_in_threadpool(_load_ride, ride_id)
+            if ride and ride.status == "requested":
+                try:
+                    await asyncio.wait_for(processed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                ride = await run_in_threadpool(_load_ride, ride_id)
+    if not ride:
+        raise HTTPException(status_code=404, detail="Ride not found")
+    return ride
+
+
+@router.patch("/{ride_id}/start", response_model=RideRequest)
+def start_ride(ride_id: int, session: Session = Depends(get_session)):
+    """
+    The driver picked the passenger up: the ride becomes "ongoing" and is no
+    longer a candidate for reassignment to another driver.
+    """
+    # conditional, so it cannot interleave with a reassignment of the same ride
+    started = session.exec(
+        update(RideRequest)
+        .where(RideRequest.ride_id == ride_id, RideRequest.status == "assigned")
+        .values(status="ongoing")
+    )
+    session.commit()
+    ride = session.get(RideRequest, ride_id)
+    if not ride:
+        raise HTTPException(status_code=404, detail="Ride not found")
+    if started.rowcount != 1:
+        raise HTTPException(status_code=409, detail=f"Ride is {ride.status}, not assigned")
+    session.refresh(ride)
+    ride_index.untrack(ride_id)
+    leader.ride_changed(ride_id)
+    return ride
+
+
 @router.patch("/{ride_id}/complete")
 def complete_ride(ride_id: int, session: Session = Depends(get_session)):
     """
@@ -86,6 +233,7 @@ def complete_ride(ride_id: int, session: Session = Depends(get_session)):
     session.add(ride)
 
     # update driver status if present
+    driver = None
     if ride.driver_id:
         driver = session.get(Driver, ride.driver_id)
         if driver:
@@ -94,5 +242,15 @@ def complete_ride(ride_id: int, session: Session = Depends(get_session)):
 
     session.commit()
     session.refresh(ride)
+    # in-memory indexes follow the committed row, as in start_ride
+    commitments.remove(ride_id)
+    ride_index.untrack(ride_id)
+    leader.ride_changed(ride_id)
+    if driver:
+        sync_driver(driver)
+        # the freed driver goes straight to the head of the pending queue,
+        # else maybe takes over a nearby ride from a driver farther away
+        if leader.driver_available(session, driver.driver_id):
+            session.refresh(ride)
     return ride
 
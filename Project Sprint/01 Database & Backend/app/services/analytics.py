@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta
 from collections import Counter
 from sqlmodel import Session, select
-from ..models.models import RideRequest
+from ..models.models import DispatchDecision, RideRequest
 
 def rides_per_day(session: Session, days: int = 7):
     cutoff = datetime.utcnow() - timedelta(days=days)
@@ -17,3 +17,42 @@ def avg_wait_minutes(session: Session, days: int = 30):
         for r in rows if r.assigned_at
     ]
     return {"avg_wait_min": round(sum(waits)/len(waits), 2) if waits else 0.0}
+
+def _pct(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+def dispatch_decision_summary(session: Session, hours: int = 24, slowest: int = 5):
+    """Where assignment time went over the last `hours`, plus the slowest decisions."""
+    cutoff = datetime.utcnow() - timedelta(hours=hours)
+    rows = session.exec(select(DispatchDecision).where(DispatchDecision.decided_at >= cutoff)).all()
+    if not rows:
+        return {"decisions": 0}
+    n = len(rows)
+
+    def avg(attr):
+        return round(sum(getattr(r, attr) for r in rows) / n, 2)
+
+    totals = sorted(r.total_ms for r in rows)
+    margins = [r.runner_up_margin for r in rows if r.runner_up_margin is not None]
+    breakdown = {"db": avg("db_ms"), "maps": avg("maps_ms"), "scoring": avg("scoring_ms")}
+    breakdown["other"] = round(avg("total_ms") - sum(breakdown.values()), 2)
+    return {
+        "decisions": n,
+        "assigned": sum(1 for r in rows if r.driver_id is not None),
+        "by_path": dict(Counter(r.path for r in rows)),
+        "total_ms": {"avg": avg("total_ms"), "p50": round(_pct(totals, 50), 2),
+                     "p95": round(_pct(totals, 95), 2), "max": round(totals[-1], 2)},
+        "avg_ms": breakdown,
+        "avg_candidates": avg("candidates"),
+        "avg_maps_calls": avg("maps_calls"),
+        "avg_runner_up_margin": round(sum(margins) / len(margins), 3) if margins else None,
+        "slowest": [
+            {
+                "ride_id": r.ride_id, "driver_id": r.driver_id, "path": r.path,
+                "decided_at": r.decided_at.isoformat(), "total_ms": round(r.total_ms, 2),
+                "db_ms": round(r.db_ms, 2), "maps_ms": round(r.maps_ms, 2), "scoring_ms": round(r.scoring_ms, 2),
+                "candidates": r.candidates, "maps_calls": r.maps_calls,
+            }
+            for r in sorted(rows, key=lambda r: r.total_ms, reverse=True)[:slowest]
+        ],
+    }
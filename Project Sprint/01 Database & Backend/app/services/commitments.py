@@ -0,0 +1,166 @@
+"""
+Per-driver index of committed time windows.
+
+availability_status only says what a driver is doing now. A scheduled ride
+booked with a driver_id reserves that driver for a window around its
+scheduled_for: from COMMITMENT_BUFFER_MIN before pickup (to get there) until the
+expected dropoff. Each driver keeps its windows sorted by start, so "is this
+driver free for [start, end)" is a bisect plus a short walk back over windows
+that could still reach into the range (bounded by the driver's longest window).
+
+Times are naive UTC datetimes, as stored on RideRequest. The index lives in
+process memory like app.services.driver_state: every read and change holds
+one lock (reentrant: reserve -> add -> remove), so request threads and the
+dispatcher never see a driver's windows half-updated; separate worker processes
+each hold their own copy.
+"""
+import os
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlmodel import Session, select
+
+from app.models.models import RideRequest
+from app.services.scoring import haversine_km
+
+# Travel time allowed before a committed pickup
+COMMITMENT_BUFFER_MIN = float(os.getenv("COMMITMENT_BUFFER_MIN", "20"))
+# Trip length when a ride has no estimated_duration yet (straight line x road factor)
+_ROAD_FACTOR = 1.3
+_FALLBACK_SPEED_KMH = 20.0
+
+Window = Tuple[datetime, datetime, int]  # (start, end, ride_id)
+
+
+class CommitmentIndex:
+    def __init__(self):
+        self._starts: Dict[int, List[datetime]] = {}
+        self._windows: Dict[int, List[Window]] = {}
+        self._longest: Dict[int, timedelta] = {}
+        self._by_ride: Dict[int, Tuple[int, Window]] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._by_ride)
+
+    def is_free(self, driver_id: int, start: datetime, end: datetime, ignore_ride: Optional[int] = None) -> bool:
+        """True if none of the driver's windows overlaps [start, end)."""
+        with self._lock:
+            starts = self._starts.get(driver_id)
+            if not starts:
+                return True
+            windows = self._windows[driver_id]
+            earliest = start - self._longest[driver_id]
+            i = bisect_left(starts, end) - 1
+            while i >= 0 and windows[i][0] > earliest:
+                if windows[i][1] > start and windows[i][2] != ignore_ride:
+                    return False
+                i -= 1
+            # a window starting exactly at `earliest` can only touch `start`, never cross it
+            return True
+
+    def add(self, driver_id: int, start: datetime, end: datetime, ride_id: int) -> None:
+        with self._lock:
+            self.remove(ride_id)
+            window = (start, end, ride_id)
+            insort(self._windows.setdefault(driver_id, []), window)
+            insort(self._starts.setdefault(driver_id, []), start)
+            self._longest[driver_id] = max(self._longest.get(driver_id, timedelta(0)), end - start)
+            self._by_ride[ride_id] = (driver_id, window)
+
+    def reserve(self, driver_id: int, start: datetime, end: datetime, ride_id: int) -> bool:
+        """Check and record in one step. False if the driver is already committed then."""
+        with self._lock:
+            if not self.is_free(driver_id, start, end, ignore_ride=ride_id):
+                return False
+            self.add(driver_id, start, end, ride_id)
+            return True
+
+    def remove(self, ride_id: int) -> Optional[int]:
+        """Drop a ride's window. Returns the driver it was reserved for."""
+        with self._lock:
+            entry = self._by_ride.pop(ride_id, None)
+            if entry is None:
+                return None
+            driver_id, window = entry
+            windows = self._windows[driver_id]
+            i = bisect_left(windows, window)
+            del windows[i]
+            del self._starts[driver_id][i]
+            if not windows:
+                del self._windows[driver_id], self._starts[driver_id], self._longest[driver_id]
+            return driver_id
+
+    def forget_driver(self, driver_id: int) -> None:
+        with self._lock:
+            for _, _, ride_id in list(self._windows.get(driver_id, ())):
+                self.remove(ride_id)
+
+    def driver_for(self, ride_id: int) -> Optional[int]:
+        with self._lock:
+            entry = self._by_ride.get(ride_id)
+            return entry[0] if entry else None
+
+    def windows(self, driver_id: int) -> List[Window]:
+        with self._lock:
+            return list(self._windows.get(driver_id, ()))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._starts.clear()
+            self._windows.clear()
+            self._longest.clear()
+            self._by_ride.clear()
+
+
+# Process-wide index, loaded at startup
+commitments = CommitmentIndex()
+
+
+def trip_minutes(ride: RideRequest) -> float:
+    if ride.estimated_duration is not None:
+        return float(ride.estimated_duration)
+    if None in (ride.pickup_lat, ride.pickup_lng, ride.dropoff_lat, ride.dropoff_lng):
+        return 0.0
+    km = haversine_km(ride.pickup_lat, ride.pickup_lng, ride.dropoff_lat, ride.dropoff_lng) * _ROAD_FACTOR
+    return km / _FALLBACK_SPEED_KMH * 60.0
+
+
+def commitment_window(ride: RideRequest) -> Optional[Tuple[datetime, datetime]]:
+    """Window a scheduled ride holds its driver for (None if not scheduled)."""
+    if ride.scheduled_for is None:
+        return None
+    return (ride.scheduled_for - timedelta(minutes=COMMITMENT_BUFFER_MIN),
+            ride.scheduled_for + timedelta(minutes=trip_minutes(ride)))
+
+
+def busy_window(ride: RideRequest, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """Window a driver assigned to `ride` right now is busy for: from now until dropoff."""
+    now = now or datetime.utcnow()
+    pickup = now + timedelta(minutes=COMMITMENT_BUFFER_MIN)
+    if ride.scheduled_for is not None and ride.scheduled_for > pickup:
+        pickup = ride.scheduled_for
+    return now, pickup + timedelta(minutes=trip_minutes(ride))
+
+
+def reserve(ride: RideRequest, driver_id: int) -> bool:
+    window = commitment_window(ride)
+    return window is not None and commitments.reserve(driver_id, window[0], window[1], ride.ride_id)
+
+
+def load_commitments(session: Session) -> int:
+    """Startup: rebuild from open scheduled rides that already have a driver."""
+    commitments.clear()
+    rides = session.exec(
+        select(RideRequest).where(
+            RideRequest.status.in_(("requested", "assigned")),
+            RideRequest.driver_id.is_not(None),
+            RideRequest.scheduled_for.is_not(None),
+        )
+    ).all()
+    for ride in rides:
+        start, end = commitment_window(ride)
+        commitments.add(ride.driver_id, start, end, ride.ride_id)
+    return len(rides)
@@ -0,0 +1,404 @@
+"""
+Day-ahead planning for rides booked through scheduled_for.
+
+Tomorrow's scheduled rides and the driver roster are turned into a vehicle
+routing problem with time windows: each ride must be picked up no earlier than
+scheduled_for - PLAN_EARLY_MIN and no later than scheduled_for + PLAN_LATE_MIN,
+and a driver can chain rides as long as every pickup stays inside its window.
+Rides with a required_vehicle_type only go to drivers with that vehicle.
+
+A plan is built by cheapest insertion (rides in pickup order, each placed where
+it adds the least deadhead driving) and improved by local search: relocating
+single rides, and emptying whole itineraries into the others to free a driver.
+The objective ranks unplanned rides first, then drivers used, then deadhead
+minutes. Several randomized restarts run in a process pool under a shared time
+budget and the best plan wins. The pool (spawned, so workers inherit none of
+the server's threads or sockets) is created by the first plan a server process
+runs, so processes that never plan never start one.
+
+Plans run as background jobs (`start_plan`), one at a time, off the request
+threads; the DayPlanJob row carries status and result to whichever worker is
+asked for it. Jobs live in the runner of the process that queued them
+(owner_pid); at startup, rows whose owner is gone are marked failed
+(`fail_orphaned_jobs`) instead of staying queued or running forever.
+
+Travel times are computed once in the parent (learned ETA model when confident,
+otherwise straight line at PLAN_SPEED_KMH) and shipped to the workers as plain
+lists, so workers need neither the database nor Maps.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlmodel import Session, select
+
+from app.database import engine
+from app.models.models import DayPlanJob, Driver, RideRequest
+from app.services import eta_model
+from app.services.driver_index import vehicle_key
+from app.services.scoring import haversine_km
+
+PLAN_EARLY_MIN = float(os.getenv("PLAN_EARLY_MIN", "10"))
+PLAN_LATE_MIN = float(os.getenv("PLAN_LATE_MIN", "10"))
+PLAN_BOARDING_MIN = float(os.getenv("PLAN_BOARDING_MIN", "5"))   # loading/unloading per ride
+PLAN_SPEED_KMH = float(os.getenv("PLAN_SPEED_KMH", "20"))
+PLAN_ROAD_FACTOR = 1.3
+PLAN_WORKERS = int(os.getenv("PLAN_WORKERS", str(min(4, os.cpu_count() or 1))))
+PLAN_BUDGET_SEC = float(os.getenv("PLAN_BUDGET_SEC", "10"))
+PLAN_MAX_BUDGET_SEC = float(os.getenv("PLAN_MAX_BUDGET_SEC", "60"))
+
+log = logging.getLogger(__name__)
+
+# Objective weights: an unplanned ride outweighs any number of drivers,
+# and a driver outweighs any realistic deadhead saving
+_UNPLANNED_COST = 1e6
+_DRIVER_COST = 1e3
+
+
+class PlanProblem:
+    """Everything the solver needs, as picklable lists indexed by ride / driver position."""
+
+    def __init__(self, ride_ids: List[int], driver_ids: List[int], ready: List[float], due: List[float],
+                 trip: List[float], from_driver: List[List[float]], from_ride: List[List[float]],
+                 ride_vehicle: Optional[List[Optional[str]]] = None, driver_vehicle: Optional[List[str]] = None):
+        self.ride_ids = ride_ids
+        self.driver_ids = driver_ids
+        self.ready = ready              # earliest pickup, minutes after midnight
+        self.due = due                  # latest pickup
+        self.trip = trip                # pickup -> dropoff incl. boarding
+        self.from_driver = from_driver  # [d][r] driver start -> pickup r
+        self.from_ride = from_ride      # [a][b] dropoff a -> pickup b
+        self.ride_vehicle = ride_vehicle or [None] * len(ride_ids)      # required vehicle type, None: any
+        self.driver_vehicle = driver_vehicle or [""] * len(driver_ids)
+
+
+# ---------- route evaluation ----------
+def _route_times(p: PlanProblem, d: int, route: List[int]) -> Optional[Tuple[float, List[float]]]:
+    """(deadhead minutes, pickup times) for one itinerary, or None if a window is missed."""
+    t, deadhead, prev = 0.0, 0.0, None
+    pickups = []
+    for r in route:
+        leg = p.from_driver[d][r] if prev is None else p.from_ride[prev][r]
+        deadhead += leg
+        t = max(t + leg, p.ready[r])
+        if t > p.due[r]:
+            return None
+        pickups.append(t)
+        t += p.trip[r]
+        prev = r
+    return deadhead, pickups
+
+
+def _route_cost(p: PlanProblem, d: int, route: List[int]) -> Optional[float]:
+    if not route:
+        return 0.0
+    timed = _route_times(p, d, route)
+    return None if timed is None else _DRIVER_COST + timed[0]
+
+
+def _best_insertion(p: PlanProblem, routes: List[List[int]], costs: List[float], r: int,
+                    skip: Optional[int] = None) -> Optional[Tuple[float, int, int]]:
+    """(added cost, driver, position) of the cheapest feasible place for ride r."""
+    best = None
+    required = p.ride_vehicle[r]
+    for d, route in enumerate(routes):
+        if d == skip or (required is not None and p.driver_vehicle[d] != required):
+            continue
+        for pos in range(len(route) + 1):
+            # keep itineraries in pickup order; windows make other orders rarely feasible
+            if pos > 0 and p.due[route[pos - 1]] > p.due[r] + PLAN_LATE_MIN + PLAN_EARLY_MIN:
+                break
+            cost = _route_cost(p, d, route[:pos] + [r] + route[pos:])
+            if cost is not None and (best is None or cost - costs[d] < best[0]):
+                best = (cost - costs[d], d, pos)
+    return best
+
+
+def _objective(routes: List[List[int]], costs: List[float], unplanned: List[int]) -> float:
+    return sum(costs) + _UNPLANNED_COST * len(unplanned)
+
+
+# ---------- solver ----------
+def _construct(p: PlanProblem, rnd: random.Random, noise: float) -> Tuple[List[List[int]], List[float], List[int]]:
+    routes: List[List[int]] = [[] for _ in p.driver_ids]
+    costs = [0.0] * len(routes)
+    unplanned: List[int] = []
+    order = sorted(range(len(p.ride_ids)), key=lambda r: p.ready[r] + rnd.uniform(0, noise))
+    for r in order:
+        found = _best_insertion(p, routes, costs, r)
+        if found is None:
+            unplanned.append(r)
+            continue
+        _, d, pos = found
+        routes[d].insert(pos, r)
+        costs[d] = _route_cost(p, d, routes[d])
+    return routes, costs, unplanned
+
+
+def _relocate_pass(p: PlanProblem, routes: List[List[int]], costs: List[float], deadline: float) -> bool:
+    improved = False
+    for d in range(len(routes)):
+        i = 0
+        while i < len(routes[d]) and time.monotonic() < deadline:
+            r = routes[d][i]
+            rest = routes[d][:i] + routes[d][i + 1:]
+            saving = costs[d] - _route_cost(p, d, rest)  # dropping a ride never breaks a window
+            found = _best_insertion(p, routes, costs, r, skip=d)
+            if found is not None and found[0] < saving - 1e-9:
+                _, to, pos = found
+                routes[d], costs[d] = rest, _route_cost(p, d, rest)
+                routes[to].insert(pos, r)
+                costs[to] = _route_cost(p, to, routes[to])
+                improved = True
+                continue
+            i += 1
+    return improved
+
+
+def _eliminate_route(p: PlanProblem, routes: List[List[int]], costs: List[float]) -> bool:
+    """Try to move every ride of the shortest itinerary elsewhere, freeing its driver."""
+    used = sorted((d for d in range(len(routes)) if routes[d]), key=lambda d: len(routes[d]))
+    for d in used:
+        trial = [list(r) for r in routes]
+        trial_costs = list(costs)
+        trial[d], trial_costs[d] = [], 0.0
+        for r in routes[d]:
+            found = _best_insertion(p, trial, trial_costs, r, skip=d)
+            if found is None:
+                break
+            _, to, pos = found
+            trial[to].insert(pos, r)
+            trial_costs[to] = _route_cost(p, to, trial[to])
+        else:
+            if sum(trial_costs) < sum(costs):
+                routes[:], costs[:] = trial, trial_costs
+                return True
+    return False
+
+
+def solve(p: PlanProblem, seed: int = 0, budget_sec: float = PLAN_BUDGET_SEC) -> Tuple[float, List[List[int]], List[int]]:
+    """One insertion + local search run. Returns (objective, routes, unplanned)."""
+    deadline = time.monotonic() + budget_sec
+    rnd = random.Random(seed)
+    routes, costs, unplanned = _construct(p, rnd, noise=0.0 if seed == 0 else PLAN_EARLY_MIN + PLAN_LATE_MIN)
+    while time.monotonic() < deadline:
+        still = []
+        for r in unplanned:
+            found = _best_insertion(p, routes, costs, r)
+            if found is None:
+                still.append(r)
+                continue
+            _, d, pos = found
+            routes[d].insert(pos, r)
+            costs[d] = _route_cost(p, d, routes[d])
+        unplanned = still
+        moved = _relocate_pass(p, routes, costs, deadline)
+        if not (_eliminate_route(p, routes, costs) or moved):
+            break
+    return _objective(routes, costs, unplanned), routes, unplanned
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def start_pool(workers: int = PLAN_WORKERS) -> Optional[ProcessPoolExecutor]:
+    """The solver process pool, created on first use in this server process."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None and workers > 1:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def stop_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+def solve_parallel(p: PlanProblem, workers: int = PLAN_WORKERS, budget_sec: float = PLAN_BUDGET_SEC):
+    """Best of up to `workers` randomized runs in the shared pool (seed 0 is the deterministic one)."""
+    if workers <= 1 or len(p.ride_ids) < 2:
+        return solve(p, 0, budget_sec)
+    pool = start_pool(PLAN_WORKERS)
+    workers = min(workers, _pool_workers)
+    if pool is None or workers <= 1:
+        return solve(p, 0, budget_sec)
+    runs = [pool.submit(solve, p, seed, budget_sec) for seed in range(workers)]
+    return min((f.result() for f in runs), key=lambda result: result[0])
+
+
+# ---------- database side ----------
+def _travel_min(lat1: float, lng1: float, lat2: float, lng2: float, hour: int) -> float:
+    est = eta_model.current_model().predict(lat1, lng1, lat2, lng2, hour)
+    if eta_model.trusted(est):
+        return est.duration_min
+    return haversine_km(lat1, lng1, lat2, lng2) * PLAN_ROAD_FACTOR / PLAN_SPEED_KMH * 60.0
+
+
+def build_problem(session: Session, day: date) -> Tuple[PlanProblem, Dict[int, RideRequest]]:
+    """Unassigned rides scheduled on `day` (UTC) and every driver not marked inactive."""
+    start = datetime.combine(day, datetime.min.time())
+    rides = session.exec(
+        select(RideRequest)
+        .where(
+            RideRequest.status == "requested",
+            RideRequest.driver_id.is_(None),
+            RideRequest.scheduled_for >= start,
+            RideRequest.scheduled_for < start + timedelta(days=1),
+            RideRequest.pickup_lat.is_not(None),
+            RideRequest.pickup_lng.is_not(None),
+        )
+        .order_by(RideRequest.scheduled_for)
+    ).all()
+    drivers = session.exec(select(Driver).where(Driver.availability_status != "inactive")).all()
+
+    minute = [(r.scheduled_for - start).total_seconds() / 60.0 for r in rides]
+    hours = [r.scheduled_for.hour for r in rides]
+    # rides without a dropoff end where they started
+    ends = [(r.dropoff_lat, r.dropoff_lng) if r.dropoff_lat is not None and r.dropoff_lng is not None
+            else (r.pickup_lat, r.pickup_lng) for r in rides]
+    trip = [
+        (float(r.estimated_duration) if r.estimated_duration is not None
+         else _travel_min(r.pickup_lat, r.pickup_lng, e[0], e[1], h)) + PLAN_BOARDING_MIN
+        for r, e, h in zip(rides, ends, hours)
+    ]
+    from_driver = [[_travel_min(d.current_lat, d.current_lng, r.pickup_lat, r.pickup_lng, h)
+                    for r, h in zip(rides, hours)] for d in drivers]
+    from_ride = [[_travel_min(e[0], e[1], r.pickup_lat, r.pickup_lng, h) for r, h in zip(rides, hours)]
+                 for e in ends]
+    problem = PlanProblem(
+        [r.ride_id for r in rides], [d.driver_id for d in drivers],
+        [m - PLAN_EARLY_MIN for m in minute], [m + PLAN_LATE_MIN for m in minute],
+        trip, from_driver, from_ride,
+        [vehicle_key(r.required_vehicle_type) for r in rides], [vehicle_key(d.vehicle_type) or "" for d in drivers],
+    )
+    return problem, {r.ride_id: r for r in rides}
+
+
+def plan_day(session: Session, day: date, budget_sec: float = PLAN_BUDGET_SEC, workers: int = PLAN_WORKERS) -> dict:
+    """Per-driver ordered itineraries for the scheduled rides of `day`."""
+    problem, rides = build_problem(session, day)
+    started = time.monotonic()
+    _, routes, unplanned = solve_parallel(problem, workers, budget_sec)
+    midnight = datetime.combine(day, datetime.min.time())
+
+    itineraries = []
+    for d, route in enumerate(routes):
+        if not route:
+            continue
+        deadhead, pickups = _route_times(problem, d, route)
+        itineraries.append({
+            "driver_id": problem.driver_ids[d],
+            "deadhead_min": round(deadhead, 1),
+            "stops": [
+                {
+                    "ride_id": problem.ride_ids[r],
+                    "scheduled_for": rides[problem.ride_ids[r]].scheduled_for.isoformat(),
+                    "pickup_at": (midnight + timedelta(minutes=t)).isoformat(timespec="minutes"),
+                    "dropoff_at": (midnight + timedelta(minutes=t + problem.trip[r])).isoformat(timespec="minutes"),
+                }
+                for r, t in zip(route, pickups)
+            ],
+        })
+    return {
+        "date": day.isoformat(),
+        "rides": len(problem.ride_ids),
+        "drivers_available": len(problem.driver_ids),
+        "drivers_used": len(itineraries),
+        "deadhead_min": round(sum(i["deadhead_min"] for i in itineraries), 1),
+        "unplanned": [problem.ride_ids[r] for r in unplanned],
+        "solve_sec": round(time.monotonic() - started, 2),
+        "itineraries": itineraries,
+    }
+
+
+# ---------- background jobs ----------
+_runner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="day-plan")  # CPU-bound: one plan at a time
+
+
+def create_plan_job(day: date, budget_sec: float = PLAN_BUDGET_SEC) -> str:
+    job_id = uuid.uuid4().hex
+    with Session(engine) as session:
+        session.add(DayPlanJob(job_id=job_id, day=day.isoformat(), budget_sec=min(budget_sec, PLAN_MAX_BUDGET_SEC),
+                               owner_pid=os.getpid()))
+        session.commit()
+    return job_id
+
+
+def run_plan_job(job_id: str) -> None:
+    """Plan the job's day and store the result (or the error) on its row."""
+    with Session(engine) as session:
+        job = session.get(DayPlanJob, job_id)
+        job.status = "running"
+        session.commit()
+        try:
+            plan = plan_day(session, date.fromisoformat(job.day), job.budget_sec)
+        except Exception as exc:
+            log.exception("day plan %s failed", job_id)
+            session.rollback()
+            job.status, job.error = "failed", str(exc)
+        else:
+            job.status, job.result = "done", json.dumps(plan)
+        job.finished_at = datetime.utcnow()
+        session.commit()
+
+
+def start_plan(day: date, budget_sec: float = PLAN_BUDGET_SEC) -> str:
+    """Queue a plan for `day`; returns the job id to poll with `get_plan_job`."""
+    job_id = create_plan_job(day, budget_sec)
+    _runner.submit(run_plan_job, job_id)
+    return job_id
+
+
+def _alive(pid: Optional[int]) -> bool:
+    if pid is None or pid == os.getpid():  # a process that is just starting holds no jobs yet
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:  # exists, owned by another user
+        return True
+    return True
+
+
+def fail_orphaned_jobs() -> int:
+    """Mark queued/running jobs whose owning process has exited as failed; returns how many."""
+    with Session(engine) as session:
+        stale = session.exec(select(DayPlanJob).where(DayPlanJob.status.in_(("queued", "running")))).all()
+        orphaned = [job for job in stale if not _alive(job.owner_pid)]
+        for job in orphaned:
+            job.status, job.error, job.finished_at = "failed", "interrupted by a server restart", datetime.utcnow()
+        session.commit()
+    if orphaned:
+        log.warning("marked %d interrupted day plan job(s) as failed", len(orphaned))
+    return len(orphaned)
+
+
+def get_plan_job(job_id: str) -> Optional[dict]:
+    with Session(engine) as session:
+        job = session.get(DayPlanJob, job_id)
+    if job is None:
+        return None
+    return {
+        "job_id": job.job_id,
+        "date": job.day,
+        "status": job.status,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "error": job.error,
+        "plan": json.loads(job.result) if job.result else None,
+    }
@@ -0,0 +1,207 @@
+"""
+Dispatch decision log: where the time went in every assignment.
+
+Assignment code runs inside `tracing(ride_id, path)`; the scheduler wraps its
+database reads/claims, Maps calls and scoring in `timed(...)` and reports
+candidate counts and final scores. Maps calls are counted by the Maps modules
+as each Distance Matrix request goes out. The trace lives in a context variable, so
+the helpers are no-ops outside a traced assignment (benchmarks, day planner).
+
+Finished traces become DispatchDecision rows. They are handed to a background
+writer thread through a bounded queue and inserted in batches, so the request
+thread never waits on the log; when the queue is full rows are dropped and
+counted rather than blocking dispatch.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Sequence
+from sqlmodel import Session
+
+from app.models.models import DispatchDecision
+
+DECISION_LOG_ENABLED = os.getenv("DECISION_LOG_ENABLED", "true").lower() in ("1", "true", "yes")
+DECISION_LOG_QUEUE_MAX = int(os.getenv("DECISION_LOG_QUEUE_MAX", "10000"))
+DECISION_LOG_FLUSH_SEC = float(os.getenv("DECISION_LOG_FLUSH_SEC", "1.0"))
+_BATCH_MAX = 500
+
+log = logging.getLogger(__name__)
+
+
+class DecisionTrace:
+    __slots__ = ("ride_id", "path", "started", "candidates", "maps_calls", "db_sec", "maps_sec",
+                 "scoring_sec", "driver_id", "best_score", "runner_up_margin")
+
+    def __init__(self, ride_id: Optional[int], path: str):
+        self.ride_id = ride_id
+        self.path = path
+        self.started = time.perf_counter()
+        self.candidates = 0
+        self.maps_calls = 0
+        self.db_sec = self.maps_sec = self.scoring_sec = 0.0
+        self.driver_id: Optional[int] = None
+        self.best_score: Optional[float] = None
+        self.runner_up_margin: Optional[float] = None
+
+    def set_scores(self, scores: Sequence[float], winner: Optional[int] = None) -> None:
+        """
+        Winning score and runner-up margin from the candidates' scores. The
+        winner defaults to the lowest score; batch matching passes the index of
+        the driver it actually chose.
+        """
+        if not scores:
+            return
+        if winner is None:
+            winner = min(range(len(scores)), key=scores.__getitem__)
+        others = [s for i, s in enumerate(scores) if i != winner]
+        self.best_score = float(scores[winner])
+        self.runner_up_margin = float(min(others) - scores[winner]) if others else None
+
+    def to_row(self) -> DispatchDecision:
+        return DispatchDecision(
+            ride_id=self.ride_id, driver_id=self.driver_id, path=self.path,
+            candidates=self.candidates, maps_calls=self.maps_calls,
+            total_ms=(time.perf_counter() - self.started) * 1000.0,
+            db_ms=self.db_sec * 1000.0, maps_ms=self.maps_sec * 1000.0, scoring_ms=self.scoring_sec * 1000.0,
+            best_score=self.best_score, runner_up_margin=self.runner_up_margin,
+        )
+
+
+_current: ContextVar[Optional[DecisionTrace]] = ContextVar("dispatch_trace", default=None)
+
+
+def current() -> Optional[DecisionTrace]:
+    return _current.get()
+
+
+@contextmanager
+def tracing(ride_id: Optional[int], path: str, record: bool = True) -> Iterator[DecisionTrace]:
+    """Trace one assignment; with record=False the caller logs it later via `record_trace`."""
+    trace = DecisionTrace(ride_id, path)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        if record:
+            record_trace(trace)
+
+
+@contextmanager
+def resume(trace: DecisionTrace) -> Iterator[DecisionTrace]:
+    """Make an unrecorded trace current again (batch matching works on many rides at once)."""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def timed(bucket: str) -> Iterator[None]:
+    """Add the block's wall time to the current trace's "db", "maps" or "scoring" bucket."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        attr = f"{bucket}_sec"
+        setattr(trace, attr, getattr(trace, attr) + time.perf_counter() - t0)
+
+
+def count(candidates: Optional[int] = None, maps_calls: int = 0) -> None:
+    trace = _current.get()
+    if trace is None:
+        return
+    if candidates is not None:
+        trace.candidates = candidates
+    trace.maps_calls += maps_calls
+
+
+def record_trace(trace: DecisionTrace) -> None:
+    if writer.running:
+        writer.put(trace.to_row())
+
+
+# ---------- background writer ----------
+class DecisionWriter:
+    """Daemon thread that drains a bounded queue of rows into the database in batches."""
+
+    def __init__(self, maxsize: int = DECISION_LOG_QUEUE_MAX):
+        self._queue: "queue.Queue[Optional[DispatchDecision]]" = queue.Queue(maxsize)
+        self._thread: Optional[threading.Thread] = None
+        self._engine = None
+        self.written = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, engine, flush_sec: float = DECISION_LOG_FLUSH_SEC) -> None:
+        if self.running or not DECISION_LOG_ENABLED:
+            return
+        self._engine = engine
+        self._thread = threading.Thread(target=self._run, args=(flush_sec,), name="decision-log", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Write whatever is queued, then end the thread."""
+        if not self.running:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def put(self, row: DispatchDecision) -> None:
+        if not self.running:
+            return
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self) -> dict:
+        return {"running": self.running, "queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+    def _run(self, flush_sec: float) -> None:
+        done = False
+        while not done:
+            batch: List[DispatchDecision] = []
+            try:
+                item = self._queue.get(timeout=flush_sec)
+            except queue.Empty:
+                continue
+            while True:
+                if item is None:
+                    done = True
+                else:
+                    batch.append(item)
+                if done or len(batch) >= _BATCH_MAX:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List[DispatchDecision]) -> None:
+        try:
+            with Session(self._engine) as session:
+                session.add_all(batch)
+                session.commit()
+            self.written += len(batch)
+        except Exception:
+            self.dropped += len(batch)
+            log.exception("could not write %d dispatch decisions", len(batch))
+
+
+writer = DecisionWriter()
@@ -0,0 +1,337 @@
+"""
+Background ride dispatcher.
+
+DISPATCH_MODE selects how new rides get a driver:
+  - "inline" (default): POST /ride-requests/ assigns the driver before responding.
+  - "batch": the ride is saved and returned right away; pending rides are collected
+    for DISPATCH_WINDOW_SEC and matched together (see app.services.matching).
+  - "async": the ride is saved and returned right away (202); a pool of
+    DISPATCH_WORKERS asyncio workers assigns queued rides one by one.
+
+In both background modes clients poll (or long-poll) GET /ride-requests/{id}.
+
+Rides booked ahead (scheduled_for) are kept in a timing wheel in every mode and
+released into assignment SCHEDULED_LEAD_MIN minutes before pickup.
+
+A driver turning available (status change, completed ride) is handed to
+`drain` in every mode: one background task serves the pending queue and the
+reassignment pass for all drivers freed meanwhile, so the request that freed
+the driver answers without waiting on Maps.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+from sqlmodel import Session, select
+
+from app.database import engine
+from app.models.models import RideRequest
+from app.services.commitments import commitments
+from app.services.matching import dispatch_batch
+from app.services.pending_queue import enqueue
+from app.services.reassign import serve_freed
+from app.services.scheduler import assign_driver_to_ride
+from app.services.timing_wheel import TimingWheel
+
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "inline").lower()
+DISPATCH_WINDOW_SEC = float(os.getenv("DISPATCH_WINDOW_SEC", "2.0"))
+DISPATCH_BATCH_MAX = int(os.getenv("DISPATCH_BATCH_MAX", "50"))
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "4"))
+
+# Scheduled rides enter assignment this long before scheduled_for
+SCHEDULED_LEAD_MIN = float(os.getenv("SCHEDULED_LEAD_MIN", "30"))
+SCHEDULED_TICK_SEC = float(os.getenv("SCHEDULED_TICK_SEC", "1.0"))
+
+log = logging.getLogger(__name__)
+
+_ATTEMPTED_MAX = 10_000
+
+
+def release_ts(ride: RideRequest) -> Optional[float]:
+    """Epoch seconds at which a scheduled ride should enter assignment (None if not scheduled)."""
+    if ride.scheduled_for is None:
+        return None
+    due = ride.scheduled_for - timedelta(minutes=SCHEDULED_LEAD_MIN)
+    if due.tzinfo is None:
+        due = due.replace(tzinfo=timezone.utc)  # stored naive, in UTC like requested_at
+    return due.timestamp()
+
+
+def pending_rides(session: Session, limit: int = DISPATCH_BATCH_MAX) -> List[RideRequest]:
+    """Oldest rides still waiting for a driver that are due now (or within the lead time)."""
+    now = datetime.utcnow() + timedelta(minutes=SCHEDULED_LEAD_MIN)
+    statement = (
+        select(RideRequest)
+        .where(
+            RideRequest.status == "requested",
+            RideRequest.driver_id.is_(None),
+            RideRequest.pickup_lat.is_not(None),
+            RideRequest.pickup_lng.is_not(None),
+            RideRequest.scheduled_for.is_(None) | (RideRequest.scheduled_for <= now),
+        )
+        .order_by(RideRequest.requested_at)
+        .limit(limit)
+    )
+    return session.exec(statement).all()
+
+
+def run_batch_once() -> List[int]:
+    """Match one batch of pending rides. Returns the ids of every ride considered."""
+    with Session(engine) as session:
+        rides = pending_rides(session)
+        ride_ids = [r.ride_id for r in rides]
+        if rides:
+            assigned = {r.ride_id for r in dispatch_batch(session, rides)}
+            # unmatched rides also wait in the pending queue for the next freed driver
+            for ride in rides:
+                if ride.ride_id not in assigned:
+                    enqueue(session, ride)
+        return ride_ids
+
+
+def free_drivers(driver_ids: Sequence[int]) -> bool:
+    """Let newly available drivers serve the pending queue and nearby rides (reassign.serve_freed)."""
+    with Session(engine) as session:
+        return serve_freed(session, driver_ids)
+
+
+def assign_one(ride_id: int) -> bool:
+    """
+    Assign a driver to one saved ride. Returns True if a driver was assigned;
+    otherwise the ride waits in the pending queue.
+    """
+    with Session(engine) as session:
+        ride = session.get(RideRequest, ride_id)
+        if ride is None or ride.status != "requested":
+            return False
+        if assign_driver_to_ride(session, ride) is not None:
+            return True
+        if ride.status == "requested" and ride.pickup_lat is not None and ride.pickup_lng is not None:
+            enqueue(session, ride)
+        return False
+
+
+class Dispatcher:
+    """Owns the background asyncio tasks: the scheduled-ride wheel plus the mode's workers."""
+
+    def __init__(
+        self,
+        mode: str = DISPATCH_MODE,
+        window_sec: float = DISPATCH_WINDOW_SEC,
+        workers: int = DISPATCH_WORKERS,
+    ):
+        self.mode = mode
+        self.window_sec = window_sec
+        self.workers = max(1, workers)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._waiters: Dict[int, Tuple[asyncio.Event, int]] = {}  # ride_id -> (event, waiter count)
+        # rides a worker already tried, so long-polls on them return at once
+        self._attempted: "OrderedDict[int, None]" = OrderedDict()
+        # ride_id -> release time, for rides booked ahead
+        self.wheel = TimingWheel(time.time(), SCHEDULED_TICK_SEC)
+        # set on follower processes (app.services.leader): rides go to the leader instead
+        self.leader = None
+        # drivers freed since the last drain started, in arrival order
+        self._freed: List[int] = []
+        self._draining: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return any(not t.done() for t in self._tasks)
+
+    @property
+    def background(self) -> bool:
+        """True when POST /ride-requests/ should hand rides off instead of assigning inline."""
+        return self.leader is not None or self.mode in ("batch", "async")
+
+    def start(self) -> None:
+        """Start the workers on the running event loop (call from an async startup hook)."""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._tasks = [self._loop.create_task(self._wheel_worker())]
+        if self.mode == "batch":
+            self._wakeup = asyncio.Event()
+            self._tasks.append(self._loop.create_task(self._batch_worker()))
+        elif self.mode == "async":
+            self._queue = asyncio.Queue()
+            self._tasks.extend(self._loop.create_task(self._async_worker()) for _ in range(self.workers))
+
+    async def stop(self) -> None:
+        if self._draining is not None:
+            self._tasks.append(self._draining)
+            self._draining = None
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def submit(self, ride_id: int) -> None:
+        """Hand a saved ride to the workers. Safe to call from request threads."""
+        if self.leader is not None:
+            self.leader.assign(ride_id)  # kept and re-sent if no leader answers
+            return
+        if self._loop is None:
+            return
+        # same path as a released scheduled ride: batch window, async queue, or an inline task
+        self._loop.call_soon_threadsafe(self._release, ride_id)
+
+    def defer(self, ride: RideRequest) -> bool:
+        """
+        Park a ride booked ahead in the timing wheel. Returns False (and does nothing)
+        if the ride is not scheduled or is already inside the lead time.
+        """
+        due = release_ts(ride)
+        if due is None or due <= time.time():
+            return False
+        if self.leader is not None:
+            try:
+                return self.leader.call("schedule", ride.ride_id)
+            except ConnectionError:
+                return False
+        self.wheel.schedule(ride.ride_id, due)
+        return True
+
+    def drain(self, driver_id: int) -> bool:
+        """
+        A driver became available: serve the pending queue with it in the
+        background. Safe to call from request threads. False if the workers
+        aren't running (the caller then serves it inline).
+        """
+        if self._loop is None or not self.running:
+            return False
+        self._loop.call_soon_threadsafe(self._queue_drain, driver_id)
+        return True
+
+    def _queue_drain(self, driver_id: int) -> None:
+        if driver_id not in self._freed:
+            self._freed.append(driver_id)
+        if self._draining is None or self._draining.done():
+            self._draining = self._loop.create_task(self._drain_worker())
+
+    async def _drain_worker(self) -> None:
+        # one drain at a time; drivers freed while it runs go in the next one
+        while self._freed:
+            freed, self._freed = self._freed, []
+            try:
+                await self._loop.run_in_executor(None, free_drivers, freed)
+            except Exception:
+                log.exception("pending-queue drain failed for drivers %s", freed)
+
+    def reset_wheel(self) -> None:
+        """Drop every scheduled ride (this process stopped being the dispatch leader)."""
+        self.wheel = TimingWheel(time.time(), SCHEDULED_TICK_SEC)
+
+    def load_scheduled(self, session: Session) -> int:
+        """Startup: put every unassigned (or only reserved) scheduled ride back in the wheel. Returns how many."""
+        rides = session.exec(
+            select(RideRequest).where(
+                RideRequest.status == "requested",
+                RideRequest.scheduled_for.is_not(None),
+            )
+        ).all()
+        for ride in rides:
+            # rides whose release time already passed fire on the first tick
+            self.wheel.schedule(ride.ride_id, release_ts(ride))
+        return len(rides)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @asynccontextmanager
+    async def watch(self, ride_id: int):
+        """
+        Long-poll helper: yields an asyncio.Event that is set once a worker has
+        processed the ride. Enter it before reading the ride so a result that
+        lands in between is not missed.
+        """
+        event, count = self._waiters.get(ride_id, (None, 0))
+        if event is None:
+            event = asyncio.Event()
+        if ride_id in self._attempted:
+            event.set()
+        self._waiters[ride_id] = (event, count + 1)
+        try:
+            yield event
+        finally:
+            entry = self._waiters.get(ride_id)
+            if entry is not None and entry[0] is event:
+                if entry[1] <= 1:
+                    del self._waiters[ride_id]
+                else:
+                    self._waiters[ride_id] = (event, entry[1] - 1)
+
+    def _notify(self, ride_id: int) -> None:
+        self._attempted[ride_id] = None
+        self._attempted.move_to_end(ride_id)
+        if len(self._attempted) > _ATTEMPTED_MAX:
+            self._attempted.popitem(last=False)
+        entry = self._waiters.pop(ride_id, None)
+        if entry is not None:
+            entry[0].set()
+
+    async def _batch_worker(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            # collect everything that arrives during the window, then match it at once
+            await asyncio.sleep(self.window_sec)
+            self._wakeup.clear()
+            try:
+                considered = await self._loop.run_in_executor(None, run_batch_once)
+            except Exception:
+                log.exception("batch dispatch failed")
+                continue
+            for ride_id in considered:
+                self._notify(ride_id)
+            if len(considered) >= DISPATCH_BATCH_MAX:
+                self._wakeup.set()  # more rides are waiting than fit in one batch
+
+    async def _wheel_worker(self) -> None:
+        while True:
+            await asyncio.sleep(self.wheel.tick_sec)
+            for ride_id in self.wheel.advance(time.time()):
+                self._release(ride_id)
+
+    def _release(self, ride_id: int) -> None:
+        """A scheduled ride reached its lead time: hand it to this mode's assignment path."""
+        # rides reserved for a driver skip batch matching: only that driver can take them
+        if self.mode == "batch" and commitments.driver_for(ride_id) is None:
+            self._wakeup.set()
+        elif self.mode == "async":
+            self._queue.put_nowait(ride_id)
+        else:
+            self._loop.create_task(self._assign_now(ride_id))
+
+    async def _assign_now(self, ride_id: int) -> None:
+        try:
+            await self._loop.run_in_executor(None, assign_one, ride_id)
+        except Exception:
+            log.exception("assignment failed for ride %s", ride_id)
+        finally:
+            self._notify(ride_id)
+
+    async def _async_worker(self) -> None:
+        while True:
+            ride_id = await self._queue.get()
+            try:
+                await self._loop.run_in_executor(None, assign_one, ride_id)
+            except Exception:
+                log.exception("assignment failed for ride %s", ride_id)
+            finally:
+                self._queue.task_done()
+                # wake long-pollers whether or not a driver was found
+                self._notify(ride_id)
+
+
+dispatcher = Dispatcher()
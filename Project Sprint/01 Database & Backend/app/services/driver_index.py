@@ -0,0 +1,227 @@
+import os
+import threading
+from math import cos, floor, radians, sqrt
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from sqlmodel import Session, select
+from app.models.models import Driver
+
+# Size of one grid cell and how far (in rings of cells) a lookup may expand
+DRIVER_INDEX_CELL_KM = float(os.getenv("DRIVER_INDEX_CELL_KM", "1.0"))
+DRIVER_INDEX_MAX_RINGS = int(os.getenv("DRIVER_INDEX_MAX_RINGS", "10"))
+
+_KM_PER_DEG = 111.32
+
+
+class GridIndex:
+    """
+    Bucket grid of (id -> lat, lng) points.
+    Each point lives in exactly one square cell, so upserts/removals are O(1)
+    and a lookup only touches the rings of cells around the query point.
+    """
+
+    def __init__(self, cell_km: float = DRIVER_INDEX_CELL_KM):
+        self.cell_deg = cell_km / _KM_PER_DEG
+        self._cells: Dict[Tuple[int, int], Set[int]] = {}
+        self._points: Dict[int, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self._points
+
+    def cell_of(self, lat: float, lng: float) -> Tuple[int, int]:
+        return (floor(lat / self.cell_deg), floor(lng / self.cell_deg))
+
+    def upsert(self, item_id: int, lat: float, lng: float) -> None:
+        cell = self.cell_of(lat, lng)
+        with self._lock:
+            old = self._points.get(item_id)
+            if old is not None:
+                old_cell = self.cell_of(*old)
+                if old_cell != cell:
+                    self._discard(old_cell, item_id)
+            self._points[item_id] = (lat, lng)
+            self._cells.setdefault(cell, set()).add(item_id)
+
+    def remove(self, item_id: int) -> None:
+        with self._lock:
+            old = self._points.pop(item_id, None)
+            if old is not None:
+                self._discard(self.cell_of(*old), item_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cells.clear()
+            self._points.clear()
+
+    def position(self, item_id: int) -> Optional[Tuple[float, float]]:
+        return self._points.get(item_id)
+
+    def nearby(self, lat: float, lng: float, max_rings: int = DRIVER_INDEX_MAX_RINGS,
+               accept: Optional[Callable[[int], bool]] = None) -> List[int]:
+        """
+        Return accepted ids around (lat, lng): rings of cells are searched
+        outwards until one holds an id `accept` allows, then on to the last ring
+        that can still hold a point closer than the farthest corner of that hit
+        ring (see `_stop_ring`), so the nearest accepted id is always included.
+        Falls back to every accepted id if nothing is found within max_rings.
+        """
+        ci, cj = self.cell_of(lat, lng)
+        found: List[int] = []
+        stop = max_rings
+        r = 0
+        while r <= stop:
+            with self._lock:
+                ring = self._ring(ci, cj, r)
+            if accept is not None:
+                ring = [item_id for item_id in ring if accept(item_id)]
+            if ring and not found:
+                stop = max(r, min(stop, self._stop_ring(lat, r)))
+            found.extend(ring)
+            r += 1
+        if not found:
+            with self._lock:
+                found = list(self._points.keys())
+            if accept is not None:
+                found = [item_id for item_id in found if accept(item_id)]
+        return found
+
+    def within(self, lat: float, lng: float, rings: int) -> List[int]:
+        """Ids in the cells at most `rings` away from (lat, lng); never falls back to every id."""
+        ci, cj = self.cell_of(lat, lng)
+        found: List[int] = []
+        with self._lock:
+            for r in range(rings + 1):
+                found.extend(self._ring(ci, cj, r))
+        return found
+
+    @staticmethod
+    def _stop_ring(lat: float, hit_ring: int) -> int:
+        """
+        Last ring worth searching after a hit in `hit_ring`. Cells are square in
+        degrees, so a longitude step is only cos(lat) of a latitude step. A hit
+        lies at most (hit + 1) * sqrt(1 + cos^2) cell heights away; a point in
+        ring k at least (k - 1) * cos cell heights.
+        """
+        c = max(cos(radians(lat)), 0.01)
+        return int((hit_ring + 1) * sqrt(1 + c * c) / c) + 1
+
+    # ---------- internals (caller holds the lock) ----------
+    def _discard(self, cell: Tuple[int, int], item_id: int) -> None:
+        bucket = self._cells.get(cell)
+        if bucket is not None:
+            bucket.discard(item_id)
+            if not bucket:
+                del self._cells[cell]
+
+    def _ring(self, ci: int, cj: int, r: int) -> List[int]:
+        if r == 0:
+            return list(self._cells.get((ci, cj), ()))
+        out: List[int] = []
+        for i in range(ci - r, ci + r + 1):
+            for j in (cj - r, cj + r):
+                out.extend(self._cells.get((i, j), ()))
+        for j in range(cj - r + 1, cj + r):
+            for i in (ci - r, ci + r):
+                out.extend(self._cells.get((i, j), ()))
+        return out
+
+
+def vehicle_key(vehicle_type: Optional[str]) -> Optional[str]:
+    """Normalized vehicle type ("Wheelchair Van " -> "wheelchair van"); None/blank means any."""
+    if vehicle_type is None:
+        return None
+    return " ".join(vehicle_type.split()).lower() or None
+
+
+class VehiclePools:
+    """
+    One GridIndex per vehicle type. A ride that requires a vehicle type only
+    searches that pool; unconstrained rides search every pool and merge (each
+    pool's answer contains its nearest drivers, so the union does too).
+    """
+
+    def __init__(self, cell_km: float = DRIVER_INDEX_CELL_KM):
+        self.cell_km = cell_km
+        self._pools: Dict[str, GridIndex] = {}
+        self._type_of: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._type_of)
+
+    def __contains__(self, driver_id: int) -> bool:
+        return driver_id in self._type_of
+
+    def upsert(self, driver_id: int, lat: float, lng: float, vehicle_type: Optional[str]) -> None:
+        key = vehicle_key(vehicle_type) or ""
+        with self._lock:
+            old = self._type_of.get(driver_id)
+            if old is not None and old != key:
+                self._pools[old].remove(driver_id)
+            self._type_of[driver_id] = key
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = GridIndex(self.cell_km)
+        pool.upsert(driver_id, lat, lng)
+
+    def remove(self, driver_id: int) -> None:
+        with self._lock:
+            key = self._type_of.pop(driver_id, None)
+        if key is not None:
+            self._pools[key].remove(driver_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pools.clear()
+            self._type_of.clear()
+
+    def position(self, driver_id: int) -> Optional[Tuple[float, float]]:
+        key = self._type_of.get(driver_id)
+        return self._pools[key].position(driver_id) if key is not None else None
+
+    def nearby(self, lat: float, lng: float, vehicle_type: Optional[str] = None,
+               max_rings: int = DRIVER_INDEX_MAX_RINGS, accept: Optional[Callable[[int], bool]] = None) -> List[int]:
+        key = vehicle_key(vehicle_type)
+        if key is not None:
+            pool = self._pools.get(key)
+            return pool.nearby(lat, lng, max_rings, accept) if pool is not None else []
+        found: List[int] = []
+        for pool in list(self._pools.values()):
+            if len(pool):
+                found.extend(pool.nearby(lat, lng, max_rings, accept))
+        return found
+
+    def counts(self) -> Dict[str, int]:
+        """Available drivers per vehicle type ("" for drivers without one)."""
+        return {key: len(pool) for key, pool in sorted(self._pools.items()) if len(pool)}
+
+
+# Process-wide index of drivers whose availability_status == "available"
+available_drivers = VehiclePools()
+
+
+def sync_driver(driver: Driver) -> None:
+    """Keep the index in line with a driver row that was just written."""
+    if driver.driver_id is None:
+        return
+    if driver.availability_status == "available":
+        available_drivers.upsert(driver.driver_id, driver.current_lat, driver.current_lng, driver.vehicle_type)
+    else:
+        available_drivers.remove(driver.driver_id)
+
+
+def load_available_drivers(session: Session) -> int:
+    """(Re)build the index from the database. Returns the number of indexed drivers."""
+    drivers = session.exec(
+        select(Driver).where(Driver.availability_status == "available")
+    ).all()
+    available_drivers.clear()
+    for d in drivers:
+        available_drivers.upsert(d.driver_id, d.current_lat, d.current_lng, d.vehicle_type)
+    available_drivers.loaded = True
+    return len(available_drivers)
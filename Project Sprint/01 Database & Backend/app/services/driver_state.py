@@ -0,0 +1,150 @@
+"""
+Process-local driver state (status, position, vehicle type).
+
+The scheduler reads candidates from here instead of querying the driver table
+on every assignment. Records use the same attribute names as the Driver model,
+so scoring code works on either. The database stays authoritative: routers
+update the store after every committed write, assignments still claim drivers
+with conditional UPDATEs, and a lost claim resyncs the record from the DB.
+"""
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+from sqlmodel import Session, select
+
+from app.models.models import Driver
+from app.services import driver_index
+
+
+class DriverRecord:
+    __slots__ = ("driver_id", "availability_status", "current_lat", "current_lng", "vehicle_type")
+
+    def __init__(self, driver_id: int, availability_status: str, current_lat: float, current_lng: float, vehicle_type: str):
+        self.driver_id = driver_id
+        self.availability_status = availability_status
+        self.current_lat = current_lat
+        self.current_lng = current_lng
+        self.vehicle_type = vehicle_type
+
+    @classmethod
+    def from_driver(cls, driver: Driver) -> "DriverRecord":
+        return cls(driver.driver_id, driver.availability_status, driver.current_lat, driver.current_lng, driver.vehicle_type)
+
+    def matches(self, driver: Driver) -> bool:
+        return all(getattr(self, name) == getattr(driver, name) for name in self.__slots__)
+
+
+class DriverStateStore:
+    """driver_id -> DriverRecord, guarded by a lock. Records are replaced, never mutated in place."""
+
+    def __init__(self):
+        self._records: Dict[int, DriverRecord] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, driver_id: int) -> bool:
+        return driver_id in self._records
+
+    def get(self, driver_id: int) -> Optional[DriverRecord]:
+        return self._records.get(driver_id)
+
+    def get_many(self, driver_ids: Iterable[int], status: Optional[str] = None) -> List[DriverRecord]:
+        records = self._records
+        found = [records.get(i) for i in driver_ids]
+        return [r for r in found if r is not None and (status is None or r.availability_status == status)]
+
+    def with_status(self, status: str) -> List[DriverRecord]:
+        with self._lock:
+            return [r for r in self._records.values() if r.availability_status == status]
+
+    def ids(self) -> List[int]:
+        with self._lock:
+            return list(self._records.keys())
+
+    def upsert(self, record: DriverRecord) -> None:
+        with self._lock:
+            self._records[record.driver_id] = record
+
+    def set_status(self, driver_id: int, status: str) -> None:
+        with self._lock:
+            old = self._records.get(driver_id)
+            if old is not None:
+                self._records[driver_id] = DriverRecord(
+                    driver_id, status, old.current_lat, old.current_lng, old.vehicle_type
+                )
+
+    def remove(self, driver_id: int) -> None:
+        with self._lock:
+            self._records.pop(driver_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._records.clear()
+
+
+# Process-wide driver state, loaded at startup
+driver_states = DriverStateStore()
+
+# Called with the driver id after every sync/forget; set on processes that
+# forward driver writes to a dispatch leader (app.services.leader)
+on_change: Optional[Callable[[int], None]] = None
+
+
+def sync_driver(driver: Driver) -> None:
+    """Mirror a driver row that was just committed into the store and the spatial index."""
+    if driver.driver_id is None:
+        return
+    driver_states.upsert(DriverRecord.from_driver(driver))
+    driver_index.sync_driver(driver)
+    if on_change is not None:
+        on_change(driver.driver_id)
+
+
+def forget_driver(driver_id: int) -> None:
+    driver_states.remove(driver_id)
+    driver_index.available_drivers.remove(driver_id)
+    if on_change is not None:
+        on_change(driver_id)
+
+
+def mark_on_ride(driver_id: int) -> None:
+    """A claim for this driver just committed."""
+    driver_states.set_status(driver_id, "on_ride")
+    driver_index.available_drivers.remove(driver_id)
+
+
+def load_driver_states(session: Session) -> int:
+    """(Re)build the store from the database. Returns the number of drivers."""
+    drivers = session.exec(select(Driver)).all()
+    driver_states.clear()
+    for d in drivers:
+        driver_states.upsert(DriverRecord.from_driver(d))
+    driver_states.loaded = True
+    return len(driver_states)
+
+
+def verify_driver_states(session: Session) -> dict:
+    """Compare the store (and the available-driver index) against the driver table."""
+    rows = {d.driver_id: d for d in session.exec(select(Driver)).all()}
+    cached = set(driver_states.ids())
+    mismatched = sorted(
+        i for i in cached & rows.keys() if not driver_states.get(i).matches(rows[i])
+    )
+    index_mismatched: List[int] = []
+    if driver_index.available_drivers.loaded:
+        index_mismatched = sorted(
+            i for i, d in rows.items()
+            if (d.availability_status == "available") != (i in driver_index.available_drivers)
+        )
+    report = {
+        "drivers": len(rows),
+        "cached": len(cached),
+        "missing": sorted(rows.keys() - cached),
+        "stale": sorted(cached - rows.keys()),
+        "mismatched": mismatched,
+        "index_mismatched": index_mismatched,
+    }
+    report["consistent"] = not (report["missing"] or report["stale"] or mismatched or index_mismatched)
+    return report
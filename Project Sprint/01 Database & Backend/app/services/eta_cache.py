@@ -0,0 +1,162 @@
+"""
+Cache of Distance Matrix answers keyed on snapped coordinates.
+
+Origin and destination are snapped to a grid of about ETA_CACHE_GRID_M meters
+and paired with a time-of-day bucket (ETA_CACHE_BUCKET_MIN minutes, UTC, as
+the ETA model uses), so repeated lookups for practically the same leg at the
+same time of day (dashboard ETA checks, a pickup scored again on the next
+dispatch attempt) are answered without a Maps request. Only successful answers
+are stored; failures are retried.
+
+Entries expire after ETA_CACHE_TTL_MIN; at most ETA_CACHE_SIZE are kept, least
+recently used evicted first. With ETA_CACHE_PATH set the cache is written there
+at shutdown and read back at startup, expired entries dropped. Each worker
+writes its own temp file and atomically replaces the path, so workers stopping
+together never interleave; the last one to finish wins.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+ETA_CACHE_ENABLED = os.getenv("ETA_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ETA_CACHE_GRID_M = float(os.getenv("ETA_CACHE_GRID_M", "100"))
+ETA_CACHE_BUCKET_MIN = int(os.getenv("ETA_CACHE_BUCKET_MIN", "60"))
+ETA_CACHE_SIZE = int(os.getenv("ETA_CACHE_SIZE", "50000"))
+ETA_CACHE_TTL_MIN = float(os.getenv("ETA_CACHE_TTL_MIN", "30"))
+ETA_CACHE_PATH = os.getenv("ETA_CACHE_PATH", "")  # empty: memory only
+
+_M_PER_DEG_LAT = 111_320.0
+
+Eta = Tuple[float, float]  # (duration_min, distance_km)
+Key = Tuple[int, int, int, int, int]
+
+
+class EtaCache:
+    """LRU of snapped (origin, destination, time bucket) -> (duration_min, distance_km). Thread-safe."""
+
+    def __init__(self, size: int = ETA_CACHE_SIZE, grid_m: float = ETA_CACHE_GRID_M,
+                 bucket_min: int = ETA_CACHE_BUCKET_MIN, ttl_min: float = ETA_CACHE_TTL_MIN):
+        self.size = size
+        self.step_deg = grid_m / _M_PER_DEG_LAT
+        self.bucket_min = max(1, bucket_min)
+        self.ttl_sec = ttl_min * 60.0
+        self._entries: "OrderedDict[Key, Tuple[Eta, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _snap(self, lat: float, lng: float) -> Tuple[int, int]:
+        # longitude cells shrink with latitude; scale them to keep cells roughly square
+        lat_i = round(lat / self.step_deg)
+        lng_step = self.step_deg / max(math.cos(math.radians(lat_i * self.step_deg)), 0.01)
+        return lat_i, round(lng / lng_step)
+
+    def key(self, olat: float, olng: float, dlat: float, dlng: float, when: Optional[datetime] = None) -> Key:
+        when = when or datetime.utcnow()
+        bucket = (when.hour * 60 + when.minute) // self.bucket_min
+        return (*self._snap(olat, olng), *self._snap(dlat, dlng), bucket)
+
+    def get(self, key: Key) -> Optional[Eta]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Key, value: Eta, expires_at: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (value, expires_at or time.time() + self.ttl_sec)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def lookup_many(self, origins: Sequence[Tuple[float, float]], dlat: float, dlng: float
+                    ) -> Tuple[List[Key], List[Optional[Eta]]]:
+        """Keys and cached answers for every origin to one destination (None where not cached)."""
+        now = datetime.utcnow()
+        keys = [self.key(lat, lng, dlat, dlng, now) for lat, lng in origins]
+        return keys, [self.get(k) for k in keys]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def save(self, path: str) -> int:
+        """Write unexpired entries to `path` (per-process temp file, then atomic replace)."""
+        now = time.time()
+        with self._lock:
+            rows = [[list(k), list(v), exp] for k, (v, exp) in self._entries.items() if exp > now]
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"step_deg": self.step_deg, "bucket_min": self.bucket_min, "entries": rows}, f)
+        os.replace(tmp, path)
+        return len(rows)
+
+    def load(self, path: str) -> int:
+        """Read entries saved by `save`; a file written with another grid or bucket is ignored."""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if data.get("step_deg") != self.step_deg or data.get("bucket_min") != self.bucket_min:
+            return 0
+        now = time.time()
+        loaded = 0
+        for key, value, expires_at in data.get("entries", []):
+            if expires_at > now:
+                self.put(tuple(key), tuple(value), expires_at)
+                loaded += 1
+        return loaded
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": ETA_CACHE_ENABLED,
+                "entries": len(self._entries),
+                "size": self.size,
+                "grid_m": round(self.step_deg * _M_PER_DEG_LAT, 1),
+                "bucket_min": self.bucket_min,
+                "ttl_min": self.ttl_sec / 60.0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+# Process-wide
+eta_cache = EtaCache()
+
+
+def cached_etas(origins: Sequence[Tuple[float, float]], dlat: float, dlng: float
+                ) -> Tuple[Optional[List[Key]], List[Optional[Eta]]]:
+    """(keys, answers) for the Maps wrappers; keys is None when the cache is off."""
+    if not ETA_CACHE_ENABLED:
+        return None, [None] * len(origins)
+    return eta_cache.lookup_many(origins, dlat, dlng)
+
+
+def remember(keys: Optional[List[Key]], index: int, value: Optional[Eta]) -> None:
+    if keys is not None and value is not None:
+        eta_cache.put(keys[index], value)
+
+
+def load_eta_cache(path: str = ETA_CACHE_PATH) -> int:
+    return eta_cache.load(path) if ETA_CACHE_ENABLED and path else 0
+
+
+def save_eta_cache(path: str = ETA_CACHE_PATH) -> int:
+    return eta_cache.save(path) if ETA_CACHE_ENABLED and path else 0
@@ -0,0 +1,269 @@
+"""
+Local ETA model learned from completed rides.
+
+Each completed ride with Maps estimates is one sample of road pace (minutes per
+straight-line km) and detour (road km per straight-line km). Samples are pooled
+per (pickup zone, dropoff zone, hour of day), with coarser pools per zone pair,
+per hour and overall to back off to. A prediction is straight-line distance
+times the pooled means, so it costs a few dict lookups and no network call.
+
+Confidence = n / (n + ETA_MODEL_PRIOR_SAMPLES) * (1 - coefficient of variation
+of the pace), i.e. it grows with the number of samples and shrinks with their
+spread. Callers only skip Maps for an estimate that is `trusted`: one from a
+zone-pair pool at or above ETA_MODEL_MIN_CONFIDENCE, or from a per-hour or
+city-wide back-off pool at or above ETA_MODEL_FALLBACK_MIN_CONFIDENCE (1, the
+default, means never), so a city-wide mean cannot stand in for a sparse zone.
+
+Trip estimates (pickup -> dropoff) still come from Maps: they are the labels.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from math import sqrt
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from sqlmodel import Session, select
+
+from app.database import engine
+from app.models.models import RideRequest
+from app.services.scoring import haversine_km
+from app.services.zones import zones
+
+ETA_MODEL_MIN_CONFIDENCE = float(os.getenv("ETA_MODEL_MIN_CONFIDENCE", "0.6"))
+ETA_MODEL_FALLBACK_MIN_CONFIDENCE = float(os.getenv("ETA_MODEL_FALLBACK_MIN_CONFIDENCE", "1.0"))
+ETA_MODEL_PRIOR_SAMPLES = float(os.getenv("ETA_MODEL_PRIOR_SAMPLES", "5"))
+ETA_MODEL_LOOKBACK_DAYS = int(os.getenv("ETA_MODEL_LOOKBACK_DAYS", "30"))
+ETA_MODEL_RETRAIN_SEC = float(os.getenv("ETA_MODEL_RETRAIN_SEC", "600"))
+
+# Trips shorter than this (straight line) make pace ratios meaningless
+_MIN_SAMPLE_KM = 0.2
+FLAT_SPEED_KMH = 20.0  # the scheduler's old fallback, used as the accuracy baseline
+
+log = logging.getLogger(__name__)
+
+# (pickup lat, pickup lng, dropoff lat, dropoff lng, hour, maps duration min, maps distance km)
+Trip = Tuple[float, float, float, float, int, float, float]
+
+
+class EtaEstimate(NamedTuple):
+    duration_min: float
+    distance_km: float
+    confidence: float
+    samples: int
+    zone_level: bool  # from a zone-pair pool rather than a per-hour / city-wide back-off
+
+
+def trusted(est: Optional[EtaEstimate]) -> bool:
+    """Whether `est` is good enough to skip Maps."""
+    if est is None:
+        return False
+    return est.confidence >= (ETA_MODEL_MIN_CONFIDENCE if est.zone_level else ETA_MODEL_FALLBACK_MIN_CONFIDENCE)
+
+
+class _Stats:
+    """Running mean/variance of pace (Welford) and mean detour for one pool."""
+
+    __slots__ = ("n", "pace_mean", "pace_m2", "detour_mean")
+
+    def __init__(self):
+        self.n = 0
+        self.pace_mean = 0.0
+        self.pace_m2 = 0.0
+        self.detour_mean = 0.0
+
+    def add(self, pace: float, detour: float) -> None:
+        self.n += 1
+        delta = pace - self.pace_mean
+        self.pace_mean += delta / self.n
+        self.pace_m2 += delta * (pace - self.pace_mean)
+        self.detour_mean += (detour - self.detour_mean) / self.n
+
+    def confidence(self) -> float:
+        if self.n < 2 or self.pace_mean <= 0:
+            return 0.0
+        cv = sqrt(self.pace_m2 / (self.n - 1)) / self.pace_mean
+        return self.n / (self.n + ETA_MODEL_PRIOR_SAMPLES) * max(0.0, 1.0 - cv)
+
+
+class EtaModel:
+    def __init__(self):
+        self._pools: Dict[tuple, _Stats] = {}
+        self.samples = 0
+        self.trained_at: Optional[datetime] = None
+
+    @classmethod
+    def fit(cls, trips: Iterable[Trip]) -> "EtaModel":
+        model = cls()
+        for trip in trips:
+            model.add(*trip)
+        model.trained_at = datetime.utcnow()
+        return model
+
+    def add(self, olat: float, olng: float, dlat: float, dlng: float, hour: int, duration_min: float, distance_km: float) -> None:
+        straight = haversine_km(olat, olng, dlat, dlng)
+        if straight < _MIN_SAMPLE_KM or duration_min <= 0 or distance_km <= 0:
+            return
+        pace, detour = duration_min / straight, max(1.0, distance_km / straight)
+        for key in self._keys(olat, olng, dlat, dlng, hour):
+            stats = self._pools.get(key)
+            if stats is None:
+                stats = self._pools[key] = _Stats()
+            stats.add(pace, detour)
+        self.samples += 1
+
+    def predict(self, olat: float, olng: float, dlat: float, dlng: float, hour: int) -> Optional[EtaEstimate]:
+        """
+        Pooled estimate for this leg, or None if nothing was learned: the most
+        confident trusted pool if any, else the most confident pool (for
+        callers that only use it when Maps fails).
+        """
+        best: Optional[tuple] = None
+        for key in self._keys(olat, olng, dlat, dlng, hour):
+            stats = self._pools.get(key)
+            if stats is not None:
+                conf, zone_level = stats.confidence(), key[0] in ("zh", "z")
+                rank = (conf >= (ETA_MODEL_MIN_CONFIDENCE if zone_level else ETA_MODEL_FALLBACK_MIN_CONFIDENCE), conf)
+                if best is None or rank > best[0]:
+                    best = (rank, stats, zone_level)
+        if best is None:
+            return None
+        (_, conf), stats, zone_level = best
+        straight = haversine_km(olat, olng, dlat, dlng)
+        return EtaEstimate(straight * stats.pace_mean, straight * stats.detour_mean, conf, stats.n, zone_level)
+
+    def summary(self) -> dict:
+        return {
+            "samples": self.samples,
+            "pools": len(self._pools),
+            "trained_at": self.trained_at.isoformat() if self.trained_at else None,
+            "min_confidence": ETA_MODEL_MIN_CONFIDENCE,
+            "fallback_min_confidence": ETA_MODEL_FALLBACK_MIN_CONFIDENCE,
+        }
+
+    @staticmethod
+    def _keys(olat: float, olng: float, dlat: float, dlng: float, hour: int) -> List[tuple]:
+        keys: List[tuple] = []
+        oz, dz = zones.zone_of(olat, olng), zones.zone_of(dlat, dlng)
+        if oz is not None and dz is not None:
+            keys.append(("zh", oz, dz, hour))
+            keys.append(("z", oz, dz))
+        keys.append(("h", hour))
+        keys.append(("*",))
+        return keys
+
+
+# Swapped wholesale on retrain, so readers never see a half-trained model
+_model = EtaModel()
+
+
+def current_model() -> EtaModel:
+    return _model
+
+
+def training_trips(session: Session, days: int = ETA_MODEL_LOOKBACK_DAYS) -> List[Trip]:
+    """Completed rides with Maps estimates, oldest first."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    rows = session.exec(
+        select(RideRequest)
+        .where(
+            RideRequest.status == "completed",
+            RideRequest.requested_at >= cutoff,
+            RideRequest.estimated_duration.is_not(None),
+            RideRequest.estimated_distance.is_not(None),
+            RideRequest.pickup_lat.is_not(None),
+            RideRequest.pickup_lng.is_not(None),
+            RideRequest.dropoff_lat.is_not(None),
+            RideRequest.dropoff_lng.is_not(None),
+        )
+        .order_by(RideRequest.requested_at)
+    ).all()
+    return [
+        (r.pickup_lat, r.pickup_lng, r.dropoff_lat, r.dropoff_lng, r.requested_at.hour,
+         float(r.estimated_duration), float(r.estimated_distance))
+        for r in rows
+    ]
+
+
+def retrain(session: Session) -> EtaModel:
+    global _model
+    _model = EtaModel.fit(training_trips(session))
+    return _model
+
+
+def accuracy_report(session: Session, holdout: float = 0.2) -> dict:
+    """
+    Fit on the older (1 - holdout) share of trips and score the newest share
+    against the Maps durations stored on those rides. The flat 20 km/h
+    fallback is reported alongside as the baseline.
+    """
+    trips = training_trips(session)
+    split = int(len(trips) * (1 - holdout))
+    model, test = EtaModel.fit(trips[:split]), trips[split:]
+
+    model_err: List[float] = []
+    model_pct: List[float] = []
+    confident_err: List[float] = []
+    baseline_err: List[float] = []
+    for olat, olng, dlat, dlng, hour, maps_min, _ in test:
+        straight = haversine_km(olat, olng, dlat, dlng)
+        baseline_err.append(abs(straight / FLAT_SPEED_KMH * 60.0 - maps_min))
+        est = model.predict(olat, olng, dlat, dlng, hour)
+        if est is None:
+            continue
+        err = abs(est.duration_min - maps_min)
+        model_err.append(err)
+        if maps_min > 0:
+            model_pct.append(err / maps_min)
+        if trusted(est):
+            confident_err.append(err)
+
+    def mean(values: List[float]) -> Optional[float]:
+        return round(sum(values) / len(values), 2) if values else None
+
+    return {
+        "trained_on": split,
+        "evaluated_on": len(test),
+        "model_mae_min": mean(model_err),
+        "model_mape_pct": round(mean(model_pct) * 100, 1) if model_pct else None,
+        "confident_mae_min": mean(confident_err),
+        "confident_coverage": round(len(confident_err) / len(test), 3) if test else 0.0,
+        "baseline_mae_min": mean(baseline_err),
+    }
+
+
+# ---------- background retraining ----------
+_task: Optional[asyncio.Task] = None
+
+
+def _retrain_now() -> None:
+    with Session(engine) as session:
+        model = retrain(session)
+    log.info("ETA model retrained on %d trips", model.samples)
+
+
+async def _retrain_loop(interval_sec: float) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, _retrain_now)
+        except Exception:
+            log.exception("ETA model retrain failed")
+        await asyncio.sleep(interval_sec)
+
+
+def start_retraining(interval_sec: float = ETA_MODEL_RETRAIN_SEC) -> None:
+    """Train now and then every interval_sec (call from an async startup hook)."""
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_retrain_loop(interval_sec))
+
+
+async def stop_retraining() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
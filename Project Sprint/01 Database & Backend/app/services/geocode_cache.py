@@ -0,0 +1,167 @@
+"""
+Two-tier geocode cache: an in-memory LRU in front of the GeocodeCacheEntry table.
+
+Keys are normalized addresses (case and accents folded, punctuation and
+repeated whitespace removed), prefixed with a scope: "google" for
+geocode_location, "any" for geocode_location_with_fallback, since a Google
+miss is not a fallback miss. Found coordinates live GEOCODE_CACHE_TTL_DAYS;
+misses are cached too, for GEOCODE_CACHE_NEGATIVE_TTL_MIN, so a typo is not
+looked up again on every keystroke.
+
+The table survives restarts and is shared by every worker; the LRU
+(GEOCODE_CACHE_SIZE entries) saves the database round trip for hot addresses.
+Lookups report memory hits, database hits and misses for `stats()`. Concurrent
+misses for the same key share one network call (app.services.single_flight).
+"""
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Optional, Tuple
+
+from sqlmodel import Session
+
+from app.database import engine
+from app.models.models import GeocodeCacheEntry
+from app.services.single_flight import flights
+
+GEOCODE_CACHE_ENABLED = os.getenv("GEOCODE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "10000"))
+GEOCODE_CACHE_TTL_DAYS = float(os.getenv("GEOCODE_CACHE_TTL_DAYS", "30"))
+GEOCODE_CACHE_NEGATIVE_TTL_MIN = float(os.getenv("GEOCODE_CACHE_NEGATIVE_TTL_MIN", "60"))
+
+Coords = Optional[Tuple[float, float]]
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_address(address: str) -> str:
+    """'  123 Main St., PARAÑAQUE ' -> '123 main st paranaque'."""
+    # NFKD splits "ñ" into "n" + a combining tilde, which is then dropped
+    text = "".join(c for c in unicodedata.normalize("NFKD", address) if not unicodedata.combining(c))
+    text = text.casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def cache_key(scope: str, address: str) -> str:
+    return f"{scope}:{normalize_address(address)}"
+
+
+def _ttl_sec(coords: Coords) -> float:
+    return GEOCODE_CACHE_TTL_DAYS * 86400.0 if coords is not None else GEOCODE_CACHE_NEGATIVE_TTL_MIN * 60.0
+
+
+class GeocodeCache:
+    """LRU of key -> (coords, expires_at); misses go to the table. Thread-safe."""
+
+    def __init__(self, size: int = GEOCODE_CACHE_SIZE):
+        self.size = size
+        self._entries: "OrderedDict[str, Tuple[Coords, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.negative_hits = 0  # hits (either tier) on a cached "not found"
+
+    # ---------- memory tier ----------
+    def get_memory(self, key: str) -> Tuple[bool, Coords]:
+        """(found, coords) from the LRU; found=False counts nothing yet."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            coords, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            self.memory_hits += 1
+            self.negative_hits += coords is None
+            return True, coords
+
+    def _remember(self, key: str, coords: Coords, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (coords, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    # ---------- database tier ----------
+    def get_stored(self, key: str) -> Tuple[bool, Coords]:
+        """(found, coords) from the table, promoting fresh rows into the LRU; counts the lookup."""
+        with Session(engine) as session:
+            row = session.get(GeocodeCacheEntry, key)
+        if row is not None:
+            coords = (row.lat, row.lng) if row.lat is not None and row.lng is not None else None
+            age = (datetime.utcnow() - row.cached_at).total_seconds()
+            if age < _ttl_sec(coords):
+                self._remember(key, coords, time.time() + _ttl_sec(coords) - age)
+                with self._lock:
+                    self.db_hits += 1
+                    self.negative_hits += coords is None
+                return True, coords
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def get(self, key: str) -> Tuple[bool, Coords]:
+        found, coords = self.get_memory(key)
+        if found:
+            return found, coords
+        return self.get_stored(key)
+
+    def put(self, key: str, coords: Coords) -> None:
+        self._remember(key, coords, time.time() + _ttl_sec(coords))
+        lat, lng = coords if coords is not None else (None, None)
+        with Session(engine) as session:
+            session.merge(GeocodeCacheEntry(address_key=key, lat=lat, lng=lng, cached_at=datetime.utcnow()))
+            session.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.memory_hits = self.db_hits = self.misses = self.negative_hits = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.db_hits + self.misses
+            return {
+                "enabled": GEOCODE_CACHE_ENABLED,
+                "entries": len(self._entries),
+                "size": self.size,
+                "lookups": lookups,
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "hit_rate": round((self.memory_hits + self.db_hits) / lookups, 3) if lookups else None,
+            }
+
+
+# Process-wide
+geocode_cache = GeocodeCache()
+
+
+def cached(scope: str, address: str, fetch: Callable[[str], Tuple[Coords, bool]]) -> Coords:
+    """
+    Cached lookup. `fetch(address)` returns (coords, cacheable); network errors
+    and quota answers come back with cacheable=False so they are retried.
+    """
+    key = cache_key(scope, address)
+    if GEOCODE_CACHE_ENABLED:
+        found, coords = geocode_cache.get(key)
+        if found:
+            return coords
+
+    def load() -> Coords:
+        coords, cacheable = fetch(address)
+        if cacheable and GEOCODE_CACHE_ENABLED:
+            geocode_cache.put(key, coords)
+        return coords
+
+    return flights.do(("geocode", key), load)
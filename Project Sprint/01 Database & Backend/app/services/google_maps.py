@@ -1,42 +1,62 @@
 import os
 import requests
-from typing import Optional, Tuple
+from typing import List, Optional, Sequence, Tuple
 from urllib.parse import quote_plus
 
+from app.services import decision_log, eta_cache, http_client, routing
+from app.services.geocode_cache import cached
+from app.services.single_flight import flights
+
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
 
 DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+# Distance Matrix limits per request: 25 origins, 25 destinations, 100 elements
+DISTANCE_MATRIX_MAX_ORIGINS = 25
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
 GEOCODING_URL = "https://maps.googleapis.com/maps/api/geocode/json"
 
 def geocode_location(address: str) -> Optional[Tuple[float, float]]:
     """
     Convert an address/location string to latitude and longitude.
-    Returns (lat, lng) if successful, else None.
+    Returns (lat, lng) if successful, else None. Answers (including "not
+    found") are cached per normalized address; see app.services.geocode_cache.
     """
     if not GOOGLE_MAPS_API_KEY:
         return None
-    
+    return cached("google", address, _fetch_geocode)
+
+
+def _fetch_geocode(address: str) -> Tuple[Optional[Tuple[float, float]], bool]:
+    """(coords, cacheable) from the Geocoding API."""
     params = {
         "address": address,
         "key": GOOGLE_MAPS_API_KEY,
     }
     
     try:
-        resp = requests.get(GEOCODING_URL, params=params, timeout=5.0)
+        resp = http_client.get(GEOCODING_URL, params=params)
         resp.raise_for_status()
         data = resp.json()
-        
-        if data.get("status") != "OK" or not data.get("results"):
-            return None
-        
-        location = data["results"][0]["geometry"]["location"]
-        lat = location.get("lat")
-        lng = location.get("lng")
-        return (lat, lng) if lat and lng else None
-    
     except requests.RequestException:
+        return None, False
+    return _parse_geocode(data), _geocode_definitive(data)
+
+
+def _geocode_definitive(data: dict) -> bool:
+    """Only OK and ZERO_RESULTS describe the address; quota and server errors do not."""
+    return data.get("status") in ("OK", "ZERO_RESULTS")
+
+
+def _parse_geocode(data: dict) -> Optional[Tuple[float, float]]:
+    """(lat, lng) of the first Geocoding API result, else None."""
+    if data.get("status") != "OK" or not data.get("results"):
         return None
 
+    location = data["results"][0]["geometry"]["location"]
+    lat = location.get("lat")
+    lng = location.get("lng")
+    return (lat, lng) if lat and lng else None
+
 
 # Fallback using OpenStreetMap Nominatim (no API key required)
 NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
@@ -45,26 +65,32 @@ def geocode_location_with_fallback(address: str) -> Optional[Tuple[float, float]
     """
     Try Google geocoding first (if key available), otherwise fall back to Nominatim.
     """
+    return cached("any", address, _fetch_with_fallback)
+
+
+def _fetch_with_fallback(address: str) -> Tuple[Optional[Tuple[float, float]], bool]:
     # Try Google first
     res = geocode_location(address)
     if res:
-        return res
+        return res, True
 
     # Nominatim fallback
     try:
         params = {"q": address, "format": "json", "limit": 1}
         headers = {"User-Agent": "CPE106L-Project/1.0 (contact@example.com)"}
-        r = requests.get(NOMINATIM_URL, params=params, headers=headers, timeout=5.0)
+        r = http_client.get(NOMINATIM_URL, params=params, headers=headers)
         r.raise_for_status()
-        items = r.json()
-        if items:
-            item = items[0]
-            lat = float(item.get("lat"))
-            lon = float(item.get("lon"))
-            return (lat, lon)
+        return _parse_nominatim(r.json()), True
     except requests.RequestException:
-        return None
+        return None, False
+
 
+def _parse_nominatim(items: list) -> Optional[Tuple[float, float]]:
+    if items:
+        item = items[0]
+        lat = float(item.get("lat"))
+        lon = float(item.get("lon"))
+        return (lat, lon)
     return None
 
 
@@ -90,47 +116,120 @@ def get_eta_and_distance_minutes(
     origin_lng: float,
     dest_lat: float,
     dest_lng: float,
-    timeout: float = 5.0,
+    timeout: Optional[float] = None,
 ) -> Optional[Tuple[float, float]]:
     """
     Returns (duration_minutes, distance_km) if successful, else None.
+    `timeout` overrides the read timeout (MAPS_HTTP_READ_TIMEOUT).
+    With ROUTING_BACKEND=local the answer comes from the offline road graph.
     """
-    if not GOOGLE_MAPS_API_KEY:
-        return None
+    if routing.ROUTING_BACKEND == "local":
+        return routing.route(origin_lat, origin_lng, dest_lat, dest_lng)
+    return get_eta_and_distance_minutes_many([(origin_lat, origin_lng)], dest_lat, dest_lng, timeout)[0]
 
-    params = {
-        "origins": f"{origin_lat},{origin_lng}",
+
+def get_eta_and_distance_minutes_many(
+    origins: Sequence[Tuple[float, float]],
+    dest_lat: float,
+    dest_lng: float,
+    timeout: Optional[float] = None,
+) -> List[Optional[Tuple[float, float]]]:
+    """
+    Multi-origin variant of get_eta_and_distance_minutes: ETA from every (lat, lng)
+    in `origins` to one destination. Origins are sent in as few Distance Matrix
+    requests as the API limits allow (one request for up to 25 origins).
+    Origins answered by the ETA cache (app.services.eta_cache) are not sent, and
+    a chunk identical to one already in flight waits for that request's answer.
+    Returns a list aligned with `origins`; an entry is None if that element failed.
+    """
+    if routing.ROUTING_BACKEND == "local":
+        return routing.route_many(origins, dest_lat, dest_lng)
+    if not GOOGLE_MAPS_API_KEY or not origins:
+        return [None] * len(origins)
+
+    keys, results = eta_cache.cached_etas(origins, dest_lat, dest_lng)
+    todo = [i for i, r in enumerate(results) if r is None]
+    for start in range(0, len(todo), MATRIX_CHUNK):
+        indices = todo[start:start + MATRIX_CHUNK]
+        part = [origins[i] for i in indices]
+        answer = flights.do(
+            _eta_flight_key(keys, indices, origins, dest_lat, dest_lng),
+            lambda: _remember_chunk(keys, indices, _fetch_matrix(part, dest_lat, dest_lng, timeout)),
+        )
+        for i, result in zip(indices, answer):
+            results[i] = result
+
+    return results
+
+
+def _fetch_matrix(
+    part: Sequence[Tuple[float, float]], dest_lat: float, dest_lng: float, timeout: Optional[float]
+) -> List[Optional[Tuple[float, float]]]:
+    params = _matrix_params(part, dest_lat, dest_lng)
+    decision_log.count(maps_calls=1)  # only requests that go out; cache hits and coalesced waits are free
+    try:
+        resp = http_client.get(DISTANCE_MATRIX_URL, params=params, timeout=timeout)
+        resp.raise_for_status()
+        return _parse_rows(resp.json(), len(part))
+    except requests.RequestException:
+        return [None] * len(part)
+
+
+def _remember_chunk(keys: Optional[list], indices: Sequence[int],
+                    answer: List[Optional[Tuple[float, float]]]) -> List[Optional[Tuple[float, float]]]:
+    """Cache a fetched chunk; runs inside the flight, so coalesced waiters do not write it again."""
+    for i, result in zip(indices, answer):
+        eta_cache.remember(keys, i, result)
+    return answer
+
+
+def _eta_flight_key(keys: Optional[list], indices: Sequence[int], origins: Sequence[Tuple[float, float]],
+                    dest_lat: float, dest_lng: float) -> tuple:
+    """Single-flight key of one Distance Matrix chunk: snapped cache keys, else exact coordinates."""
+    if keys is not None:
+        return ("eta", tuple(keys[i] for i in indices))
+    return ("eta", tuple(origins[i] for i in indices), dest_lat, dest_lng)
+
+
+# origins per Distance Matrix request (one destination each)
+MATRIX_CHUNK = min(DISTANCE_MATRIX_MAX_ORIGINS, DISTANCE_MATRIX_MAX_ELEMENTS)
+
+
+def _matrix_params(origins: Sequence[Tuple[float, float]], dest_lat: float, dest_lng: float) -> dict:
+    return {
+        "origins": "|".join(f"{lat},{lng}" for lat, lng in origins),
         "destinations": f"{dest_lat},{dest_lng}",
         "mode": "driving",
         "units": "metric",
         "key": GOOGLE_MAPS_API_KEY,
     }
 
-    try:
-        resp = requests.get(DISTANCE_MATRIX_URL, params=params, timeout=timeout)
-        resp.raise_for_status()
-        data = resp.json()
 
-        if data.get("status") != "OK":
-            return None
+def _parse_rows(data: dict, n: int) -> List[Optional[Tuple[float, float]]]:
+    """Results for `n` origins from a one-destination Distance Matrix response."""
+    results: List[Optional[Tuple[float, float]]] = [None] * n
+    if data.get("status") != "OK":
+        return results
 
-        rows = data.get("rows", [])
-        if not rows or not rows[0].get("elements"):
-            return None
+    # one row per origin, in request order
+    for offset, row in enumerate(data.get("rows", [])[:n]):
+        elements = row.get("elements") or []
+        if elements:
+            results[offset] = _parse_element(elements[0])
+    return results
 
-        el = rows[0]["elements"][0]
-        if el.get("status") != "OK":
-            return None
 
-        duration_sec = el["duration"]["value"]           # seconds
-        distance_m  = el["distance"]["value"]            # meters
+def _parse_element(el: dict) -> Optional[Tuple[float, float]]:
+    """Convert one Distance Matrix element into (duration_minutes, distance_km)."""
+    if el.get("status") != "OK":
+        return None
 
-        duration_min = duration_sec / 60.0
-        distance_km  = distance_m / 1000.0
-        return duration_min, distance_km
+    duration_sec = el["duration"]["value"]           # seconds
+    distance_m  = el["distance"]["value"]            # meters
 
-    except requests.RequestException:
-        return None
+    duration_min = duration_sec / 60.0
+    distance_km  = distance_m / 1000.0
+    return duration_min, distance_km
 
 
 def make_static_map_url(
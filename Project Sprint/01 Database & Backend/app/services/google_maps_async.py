@@ -0,0 +1,152 @@
+"""
+Async versions of the app.services.google_maps lookups, for async routes.
+
+Same requests, parsing and API limits as the sync module, but sent through the
+shared httpx.AsyncClient (app.services.http_client), so a slow Maps API holds
+coroutines on the event loop instead of threadpool workers. Multi-origin ETA
+chunks go out concurrently. Without httpx installed every function runs its
+sync counterpart in the threadpool.
+
+Geocodes share the app.services.geocode_cache tiers with the sync module; the
+in-memory LRU is read on the loop, database reads and writes in the threadpool.
+Identical lookups in flight at the same time share one request
+(app.services.single_flight).
+"""
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.services import decision_log, eta_cache, geocode_cache, google_maps, http_client, routing
+from app.services.single_flight import async_flights
+
+if http_client.HAS_HTTPX:
+    import httpx
+
+
+Coords = Optional[Tuple[float, float]]
+
+
+async def _cached(scope: str, address: str, fetch: Callable[[str], Awaitable[Tuple[Coords, bool]]]) -> Coords:
+    """Async geocode_cache.cached."""
+    enabled = geocode_cache.GEOCODE_CACHE_ENABLED
+    cache = geocode_cache.geocode_cache
+    key = geocode_cache.cache_key(scope, address)
+    if enabled:
+        found, coords = cache.get_memory(key)
+        if not found:
+            found, coords = await run_in_threadpool(cache.get_stored, key)
+        if found:
+            return coords
+
+    async def load() -> Coords:
+        coords, cacheable = await fetch(address)
+        if cacheable and enabled:
+            await run_in_threadpool(cache.put, key, coords)
+        return coords
+
+    return await async_flights.do(("geocode", key), load)
+
+
+async def geocode_location(address: str) -> Coords:
+    """Async google_maps.geocode_location."""
+    if not http_client.HAS_HTTPX:
+        return await run_in_threadpool(google_maps.geocode_location, address)
+    if not google_maps.GOOGLE_MAPS_API_KEY:
+        return None
+    return await _cached("google", address, _fetch_geocode)
+
+
+async def _fetch_geocode(address: str) -> Tuple[Coords, bool]:
+    params = {"address": address, "key": google_maps.GOOGLE_MAPS_API_KEY}
+    try:
+        resp = await http_client.aget(google_maps.GEOCODING_URL, params=params)
+        resp.raise_for_status()
+        data = resp.json()
+    except httpx.HTTPError:
+        return None, False
+    return google_maps._parse_geocode(data), google_maps._geocode_definitive(data)
+
+
+async def geocode_location_with_fallback(address: str) -> Coords:
+    """Async google_maps.geocode_location_with_fallback."""
+    if not http_client.HAS_HTTPX:
+        return await run_in_threadpool(google_maps.geocode_location_with_fallback, address)
+    return await _cached("any", address, _fetch_with_fallback)
+
+
+async def _fetch_with_fallback(address: str) -> Tuple[Coords, bool]:
+    res = await geocode_location(address)
+    if res:
+        return res, True
+    params = {"q": address, "format": "json", "limit": 1}
+    try:
+        resp = await http_client.aget(google_maps.NOMINATIM_URL, params=params)
+        resp.raise_for_status()
+        return google_maps._parse_nominatim(resp.json()), True
+    except httpx.HTTPError:
+        return None, False
+
+
+async def get_eta_and_distance_minutes(
+    origin_lat: float,
+    origin_lng: float,
+    dest_lat: float,
+    dest_lng: float,
+    timeout: Optional[float] = None,
+) -> Optional[Tuple[float, float]]:
+    """Async google_maps.get_eta_and_distance_minutes."""
+    results = await get_eta_and_distance_minutes_many([(origin_lat, origin_lng)], dest_lat, dest_lng, timeout)
+    return results[0]
+
+
+async def get_eta_and_distance_minutes_many(
+    origins: Sequence[Tuple[float, float]],
+    dest_lat: float,
+    dest_lng: float,
+    timeout: Optional[float] = None,
+) -> List[Optional[Tuple[float, float]]]:
+    """Async google_maps.get_eta_and_distance_minutes_many; uncached chunks are requested concurrently."""
+    if routing.ROUTING_BACKEND == "local":
+        return await run_in_threadpool(routing.route_many, origins, dest_lat, dest_lng)
+    if not http_client.HAS_HTTPX:
+        return await run_in_threadpool(
+            google_maps.get_eta_and_distance_minutes_many, origins, dest_lat, dest_lng, timeout
+        )
+    if not google_maps.GOOGLE_MAPS_API_KEY or not origins:
+        return [None] * len(origins)
+
+    keys, results = eta_cache.cached_etas(origins, dest_lat, dest_lng)
+    todo = [i for i, r in enumerate(results) if r is None]
+    chunk = google_maps.MATRIX_CHUNK
+    parts = [todo[start:start + chunk] for start in range(0, len(todo), chunk)]
+    answers = await asyncio.gather(*(
+        async_flights.do(
+            google_maps._eta_flight_key(keys, part, origins, dest_lat, dest_lng),
+            _chunk_loader(keys, part, [origins[i] for i in part], dest_lat, dest_lng, timeout),
+        )
+        for part in parts
+    ))
+    for part, answer in zip(parts, answers):
+        for i, result in zip(part, answer):
+            results[i] = result
+    return results
+
+
+def _chunk_loader(keys, indices, part, dest_lat, dest_lng, timeout):
+    async def load():
+        return google_maps._remember_chunk(keys, indices, await _matrix_chunk(part, dest_lat, dest_lng, timeout))
+    return load
+
+
+async def _matrix_chunk(
+    part: Sequence[Tuple[float, float]], dest_lat: float, dest_lng: float, timeout: Optional[float]
+) -> List[Optional[Tuple[float, float]]]:
+    params = google_maps._matrix_params(part, dest_lat, dest_lng)
+    decision_log.count(maps_calls=1)
+    try:
+        resp = await http_client.aget(google_maps.DISTANCE_MATRIX_URL, params=params, timeout=timeout)
+        resp.raise_for_status()
+        return google_maps._parse_rows(resp.json(), len(part))
+    except httpx.HTTPError:
+        return [None] * len(part)
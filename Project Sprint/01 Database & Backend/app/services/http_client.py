@@ -0,0 +1,206 @@
+"""
+Shared HTTP client for the Maps services (Google Geocoding, Distance Matrix,
+Nominatim).
+
+One requests.Session per process, so calls reuse keep-alive connections instead
+of opening a new TCP/TLS connection each time. The adapter keeps up to
+MAPS_HTTP_POOL_MAXSIZE idle connections per host and pools for up to
+MAPS_HTTP_POOL_HOSTS hosts. Connect and read timeouts are separate: a dead
+host fails within MAPS_HTTP_CONNECT_TIMEOUT, while a slow answer gets
+MAPS_HTTP_READ_TIMEOUT.
+
+Pool hit/miss counters: every connection checkout is a request; a miss is one
+that had to open a new connection. `stats()` reports both.
+
+Async callers (app.services.google_maps_async) get an httpx.AsyncClient with
+the same limits and timeouts, one per event loop. httpx is optional; without it
+the async functions run the sync ones in the threadpool.
+"""
+import asyncio
+import os
+import threading
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import httpx
+    HAS_HTTPX = True
+except ImportError:  # pragma: no cover - optional dependency
+    HAS_HTTPX = False
+
+MAPS_HTTP_POOL_HOSTS = int(os.getenv("MAPS_HTTP_POOL_HOSTS", "4"))
+MAPS_HTTP_POOL_MAXSIZE = int(os.getenv("MAPS_HTTP_POOL_MAXSIZE", "16"))
+MAPS_HTTP_CONNECT_TIMEOUT = float(os.getenv("MAPS_HTTP_CONNECT_TIMEOUT", "3.05"))
+MAPS_HTTP_READ_TIMEOUT = float(os.getenv("MAPS_HTTP_READ_TIMEOUT", "5.0"))
+MAPS_HTTP_RETRIES = int(os.getenv("MAPS_HTTP_RETRIES", "1"))  # connection errors only
+# async client: requests beyond this many open connections wait for a free one
+MAPS_HTTP_ASYNC_MAX_CONNECTIONS = int(os.getenv("MAPS_HTTP_ASYNC_MAX_CONNECTIONS", "100"))
+
+USER_AGENT = "CPE106L-Project/1.0 (contact@example.com)"
+
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def checkout(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def miss(self) -> None:
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            hits = max(self.requests - self.new_connections, 0)
+            return {
+                "requests": self.requests,
+                "pool_hits": hits,
+                "pool_misses": self.new_connections,
+                "hit_rate": round(hits / self.requests, 3) if self.requests else None,
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = self.new_connections = 0
+
+
+pool_stats = PoolStats()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _get_conn(self, timeout=None):
+        pool_stats.checkout()
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        pool_stats.miss()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _get_conn(self, timeout=None):
+        pool_stats.checkout()
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        pool_stats.miss()
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report hits and misses to `pool_stats`."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = PooledAdapter(
+        pool_connections=MAPS_HTTP_POOL_HOSTS,
+        pool_maxsize=MAPS_HTTP_POOL_MAXSIZE,
+        pool_block=False,  # over the limit: open a temporary connection instead of waiting
+        max_retries=MAPS_HTTP_RETRIES,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def timeouts(read: Optional[float] = None) -> Tuple[float, float]:
+    """(connect, read) timeout pair; `read` overrides MAPS_HTTP_READ_TIMEOUT."""
+    return MAPS_HTTP_CONNECT_TIMEOUT, MAPS_HTTP_READ_TIMEOUT if read is None else read
+
+
+def get(url: str, params: Optional[dict] = None, headers: Optional[dict] = None,
+        timeout: Optional[float] = None) -> requests.Response:
+    """GET through the shared pooled session."""
+    return get_session().get(url, params=params, headers=headers, timeout=timeouts(timeout))
+
+
+# ---------- async ----------
+_async_client = None
+_async_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_async_client() -> "httpx.AsyncClient":
+    """Shared AsyncClient for the running event loop (a client cannot cross loops)."""
+    global _async_client, _async_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_loop is not loop:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAPS_HTTP_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=MAPS_HTTP_POOL_MAXSIZE,
+            ),
+            timeout=httpx.Timeout(MAPS_HTTP_READ_TIMEOUT, connect=MAPS_HTTP_CONNECT_TIMEOUT),
+            transport=httpx.AsyncHTTPTransport(retries=MAPS_HTTP_RETRIES),
+            headers={"User-Agent": USER_AGENT},
+        )
+        _async_loop = loop
+    return _async_client
+
+
+async def aget(url: str, params: Optional[dict] = None, headers: Optional[dict] = None,
+               timeout: Optional[float] = None) -> "httpx.Response":
+    """GET through the shared AsyncClient; `timeout` overrides the read timeout."""
+    client = get_async_client()
+    if timeout is None:
+        return await client.get(url, params=params, headers=headers)
+    return await client.get(
+        url, params=params, headers=headers,
+        timeout=httpx.Timeout(timeout, connect=MAPS_HTTP_CONNECT_TIMEOUT),
+    )
+
+
+async def aclose() -> None:
+    global _async_client, _async_loop
+    if _async_client is not None and _async_loop is asyncio.get_running_loop():
+        await _async_client.aclose()
+    _async_client = _async_loop = None
+
+
+def stats() -> dict:
+    return {
+        **pool_stats.snapshot(),
+        "pool_hosts": MAPS_HTTP_POOL_HOSTS,
+        "pool_maxsize": MAPS_HTTP_POOL_MAXSIZE,
+        "connect_timeout": MAPS_HTTP_CONNECT_TIMEOUT,
+        "read_timeout": MAPS_HTTP_READ_TIMEOUT,
+        "async_client": HAS_HTTPX,
+        "async_max_connections": MAPS_HTTP_ASYNC_MAX_CONNECTIONS,
+    }
+
+
+def close() -> None:
+    """Drop pooled connections (shutdown, tests)."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,525 @@
+"""
+Single dispatcher for multi-worker deployments.
+
+Each uvicorn worker normally assigns rides itself, so the in-process state the
+scheduler relies on (driver store, spatial indexes, pending queue, timing
+wheel, commitments) exists once per worker and drifts apart. With
+DISPATCH_LEADER set, exactly one process owns that state:
+
+  - "auto": every worker competes for a lease row in SQLite (DispatchLease);
+    the holder renews it every DISPATCH_LEASE_TTL_SEC / 3 and is the leader.
+    If it dies, another worker takes over once the lease expires and reloads
+    the state from the database.
+  - "follow": this worker never leads; run a dedicated dispatcher with
+    `python -m app.services.leader` next to the API workers.
+
+The leader listens on DISPATCH_LEADER_ADDRESS (host:port, or a Unix socket
+path) with multiprocessing.connection. Followers keep serving HTTP but forward
+what touches dispatch state: rides to assign or schedule, long-poll waits,
+driver writes and ride changes. Forwarding is request/response over one
+connection per calling thread. On a follower POST /ride-requests/ always
+answers 202; clients poll GET /ride-requests/{id}?wait=N as in async mode.
+
+A ride a follower could not forward is kept and re-sent on every lease check;
+a new leader also drains the pending queue it rebuilt from the database, so no
+"requested" ride is lost across a leader change.
+
+The channel carries pickles, so it is authenticated: DISPATCH_LEADER_AUTHKEY,
+or else a random key created once in DISPATCH_LEADER_AUTHKEY_FILE (mode 0600,
+shared by the processes on this host). A key file readable by others is refused.
+"""
+import asyncio
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import Optional, Set, Tuple, Union
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from app.database import engine
+from app.models.models import DispatchLease, Driver, RideRequest
+from app.services import commitments, driver_state, ride_index, routing
+from app.services.commitments import load_commitments
+from app.services.dispatcher import assign_one, dispatcher, release_ts
+from app.services.driver_index import load_available_drivers
+from app.services.pending_queue import assign_pending, load_pending_rides, pending_queue
+from app.services.reassign import serve_freed
+from app.services.ride_index import load_assigned_rides
+
+DISPATCH_LEADER = os.getenv("DISPATCH_LEADER", "off").lower()  # off | auto | follow
+DISPATCH_LEADER_ADDRESS = os.getenv("DISPATCH_LEADER_ADDRESS", "127.0.0.1:6010")
+DISPATCH_LEADER_AUTHKEY = os.getenv("DISPATCH_LEADER_AUTHKEY", "")
+DISPATCH_LEADER_AUTHKEY_FILE = os.getenv("DISPATCH_LEADER_AUTHKEY_FILE", ".dispatch_authkey")
+DISPATCH_LEASE_TTL_SEC = float(os.getenv("DISPATCH_LEASE_TTL_SEC", "15"))
+# follower connections the leader serves at once; more are turned away (the follower retries or answers 503)
+DISPATCH_LEADER_MAX_CONNECTIONS = int(os.getenv("DISPATCH_LEADER_MAX_CONNECTIONS", "128"))
+
+_LEASE = "dispatcher"
+
+log = logging.getLogger(__name__)
+
+
+def parse_address(value: str) -> Union[Tuple[str, int], str]:
+    host, sep, port = value.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return value  # Unix socket path
+
+
+def load_authkey(value: str = DISPATCH_LEADER_AUTHKEY, path: str = DISPATCH_LEADER_AUTHKEY_FILE) -> bytes:
+    """The configured key, else the shared key file (created 0600 by the first process to start)."""
+    if value:
+        return value.encode()
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        if os.stat(path).st_mode & 0o077:
+            raise RuntimeError(f"{path} must not be accessible to group or others (chmod 600)")
+        for _ in range(50):  # another process may be writing it right now
+            with open(path, "rb") as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f"{path} is empty")
+    key = secrets.token_hex(32).encode()
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def load_dispatch_state(session: Session) -> None:
+    """Build every in-process structure the scheduler reads from the database."""
+    driver_state.load_driver_states(session)  # driver status/position read by the scheduler
+    load_available_drivers(session)  # spatial index used by the scheduler
+    load_commitments(session)  # scheduled rides already holding a driver
+    dispatcher.load_scheduled(session)  # rides booked ahead wait in the timing wheel
+    load_pending_rides(session)  # unassigned rides wait for the next free driver
+    load_assigned_rides(session)  # rides not yet picked up, for reassignment
+
+
+# ---------- lease ----------
+def acquire_lease(holder: str, ttl_sec: float = DISPATCH_LEASE_TTL_SEC) -> bool:
+    """Take or renew the lease. True if `holder` holds it for the next ttl_sec."""
+    now = time.time()
+    with Session(engine) as session:
+        renewed = session.exec(
+            update(DispatchLease)
+            .where(
+                DispatchLease.name == _LEASE,
+                or_(DispatchLease.holder == holder, DispatchLease.expires_at < now),
+            )
+            .values(holder=holder, expires_at=now + ttl_sec)
+        )
+        if renewed.rowcount == 1:
+            session.commit()
+            return True
+        if session.get(DispatchLease, _LEASE) is not None:
+            return False
+        session.add(DispatchLease(name=_LEASE, holder=holder, expires_at=now + ttl_sec))
+        try:
+            session.commit()
+        except IntegrityError:
+            return False  # another process created it first
+        return True
+
+
+def release_lease(holder: str) -> None:
+    with Session(engine) as session:
+        session.exec(
+            update(DispatchLease)
+            .where(DispatchLease.name == _LEASE, DispatchLease.holder == holder)
+            .values(expires_at=0.0)
+        )
+        session.commit()
+
+
+def lease_info() -> Optional[dict]:
+    with Session(engine) as session:
+        lease = session.get(DispatchLease, _LEASE)
+        if lease is None:
+            return None
+        return {"holder": lease.holder, "expires_in_sec": round(lease.expires_at - time.time(), 1)}
+
+
+# ---------- leader side ----------
+def refresh_ride(session: Session, ride_id: int) -> None:
+    """Bring the commitment and assigned-ride indexes in line with a ride row."""
+    ride = session.get(RideRequest, ride_id)
+    if ride is None or ride.status in ("completed", "cancelled"):
+        commitments.commitments.remove(ride_id)
+        ride_index.untrack(ride_id)
+        return
+    window = commitments.commitment_window(ride)
+    if ride.driver_id is not None and window is not None and ride.status in ("requested", "assigned"):
+        commitments.commitments.add(ride.driver_id, window[0], window[1], ride_id)
+    ride_index.track(ride)
+
+
+def _sweep_pending() -> None:
+    with Session(engine) as session:
+        assigned = assign_pending(session, limit=max(len(pending_queue), 1))
+    if assigned:
+        log.info("new dispatch leader assigned %d waiting rides", len(assigned))
+
+
+def _free_driver(session: Session, driver_id: int) -> bool:
+    """
+    Serve the pending queue, then let the driver take over a nearby ride: in the
+    dispatcher's background drain when it runs, else inline. True if anything
+    moved here and now.
+    """
+    if dispatcher.drain(driver_id):
+        return False
+    return serve_freed(session, [driver_id])
+
+
+class LeaderServer:
+    """
+    Accepts follower connections; one thread per connection answers its
+    requests in order, up to max_connections threads at a time.
+    """
+
+    def __init__(self, address, authkey: bytes, loop: asyncio.AbstractEventLoop,
+                 max_connections: int = DISPATCH_LEADER_MAX_CONNECTIONS):
+        self.address = address
+        self.authkey = authkey
+        self.loop = loop
+        self._listener: Optional[Listener] = None
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def start(self) -> None:
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)  # stale socket from a previous leader
+        self._listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, name="leader-accept", daemon=True).start()
+
+    def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def _accept(self) -> None:
+        listener = self._listener
+        while self._listener is listener:
+            try:
+                conn = listener.accept()
+            except Exception:
+                if self._listener is not listener:
+                    return  # closed by stop()
+                log.exception("rejected follower connection")
+                continue
+            if not self._slots.acquire(blocking=False):
+                log.warning("dispatch leader at its connection limit; closing a follower connection")
+                conn.close()
+                continue
+            threading.Thread(target=self._serve, args=(conn,), name="leader-conn", daemon=True).start()
+
+    def _serve(self, conn) -> None:
+        try:
+            self._serve_requests(conn)
+        finally:
+            self._slots.release()
+
+    def _serve_requests(self, conn) -> None:
+        with conn:
+            while True:
+                try:
+                    kind, *args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = self.handle(kind, *args)
+                except Exception:
+                    log.exception("leader failed to handle %s%s", kind, tuple(args))
+                    reply = None
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+
+    def handle(self, kind: str, *args):
+        if kind == "assign":
+            # answer at once, so the follower's POST returns 202 without waiting on Maps
+            if dispatcher.running:
+                dispatcher.submit(args[0])
+                return None
+            return assign_one(args[0])  # no event loop in this process (scripts, tests)
+        if kind == "schedule":
+            with Session(engine) as session:
+                ride = session.get(RideRequest, args[0])
+            due = release_ts(ride) if ride is not None else None
+            if due is None or due <= time.time():
+                return False
+            self.loop.call_soon_threadsafe(dispatcher.wheel.schedule, ride.ride_id, due)
+            return True
+        if kind == "reserve":
+            return commitments.commitments.reserve(*args)
+        if kind == "wait":
+            ride_id, timeout = args
+            future = asyncio.run_coroutine_threadsafe(self._wait(ride_id, timeout), self.loop)
+            return future.result(timeout + 5)
+        with Session(engine) as session:
+            if kind == "driver":
+                driver = session.get(Driver, args[0])
+                if driver is None:
+                    driver_state.forget_driver(args[0])
+                else:
+                    driver_state.sync_driver(driver)
+                return None
+            if kind == "driver_available":
+                return _free_driver(session, args[0])
+            if kind == "ride":
+                refresh_ride(session, args[0])
+                return None
+        raise ValueError(f"unknown request {kind!r}")
+
+    async def _wait(self, ride_id: int, timeout: float) -> None:
+        async with dispatcher.watch(ride_id) as processed:
+            with Session(engine) as session:
+                ride = session.get(RideRequest, ride_id)
+                status = ride.status if ride else None
+            if status == "requested":
+                try:
+                    await asyncio.wait_for(processed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+
+# ---------- follower side ----------
+class LeaderClient:
+    """Synchronous calls to the leader; each calling thread keeps its own connection."""
+
+    def __init__(self, address, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+        self._unsent: Set[int] = set()  # rides to assign that could not be forwarded yet
+        self._unsent_lock = threading.Lock()
+
+    def call(self, kind: str, *args):
+        """Send one request and return the reply. Raises ConnectionError if no leader answers."""
+        for attempt in (1, 2):
+            conn = getattr(self._local, "conn", None)
+            try:
+                if conn is None:
+                    conn = self._local.conn = Client(self.address, authkey=self.authkey)
+                conn.send((kind, *args))
+                return conn.recv()
+            except (EOFError, OSError) as exc:
+                self._local.conn = None
+                if attempt == 2:
+                    raise ConnectionError(f"dispatch leader unreachable at {self.address}") from exc
+
+    def notify(self, kind: str, *args) -> None:
+        """Fire-and-log variant for state updates a missing leader will reload anyway."""
+        try:
+            self.call(kind, *args)
+        except ConnectionError:
+            log.warning("could not forward %s%s to the dispatch leader", kind, tuple(args))
+
+    def assign(self, ride_id: int) -> None:
+        """Forward a ride to assign; if no leader answers, keep it for `resend`."""
+        try:
+            self.call("assign", ride_id)
+        except ConnectionError:
+            with self._unsent_lock:
+                self._unsent.add(ride_id)
+            log.warning("dispatch leader unreachable; ride %s will be re-sent", ride_id)
+
+    def resend(self) -> int:
+        """Forward the rides `assign` could not; stops at the first failure. Returns how many went out."""
+        with self._unsent_lock:
+            pending = sorted(self._unsent)
+        sent = 0
+        for ride_id in pending:
+            try:
+                self.call("assign", ride_id)
+            except ConnectionError:
+                break
+            with self._unsent_lock:
+                self._unsent.discard(ride_id)
+            sent += 1
+        return sent
+
+
+# ---------- election ----------
+class Coordinator:
+    """Runs the lease loop and switches this process between leader and follower."""
+
+    def __init__(self, mode: str = DISPATCH_LEADER, address: str = DISPATCH_LEADER_ADDRESS,
+                 authkey: Optional[bytes] = None, ttl_sec: float = DISPATCH_LEASE_TTL_SEC):
+        self.mode = mode
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self.ttl_sec = ttl_sec
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.role = "solo"  # solo | leader | follower
+        self.client: Optional[LeaderClient] = None
+        self._server: Optional[LeaderServer] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("auto", "follow")
+
+    @property
+    def following(self) -> bool:
+        return self.role == "follower"
+
+    def start(self) -> None:
+        if self.enabled and (self._task is None or self._task.done()):
+            if self.authkey is None:
+                self.authkey = load_authkey()  # refuses to start on a world-readable key file
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.role == "leader":
+            self._step_down()
+            await asyncio.get_running_loop().run_in_executor(None, release_lease, self.holder)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                held = self.mode == "auto" and await loop.run_in_executor(
+                    None, acquire_lease, self.holder, self.ttl_sec
+                )
+            except Exception:
+                log.exception("dispatch lease check failed")
+                held = False
+            try:
+                if held and self.role != "leader":
+                    self._become_leader(loop)  # on the loop: loading touches the timing wheel
+                elif not held and self.role != "follower":
+                    self._become_follower()
+            except Exception:
+                log.exception("dispatch role change failed; retrying")
+            if self.role == "follower":
+                await loop.run_in_executor(None, self.client.resend)
+            await asyncio.sleep(self.ttl_sec / 3)
+
+    def _become_leader(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.client = None
+        self._bind_followers(False)
+        with Session(engine) as session:
+            load_dispatch_state(session)
+        self._server = LeaderServer(self.address, self.authkey, loop)
+        self._server.start()
+        self.role = "leader"
+        log.info("%s is the dispatch leader on %s", self.holder, self.address)
+        # rides left "requested" while no leader was answering are in the rebuilt queue
+        loop.run_in_executor(None, _sweep_pending)
+
+    def _become_follower(self) -> None:
+        if self.role == "leader":
+            self._step_down()
+        self.client = LeaderClient(self.address, self.authkey)
+        self._bind_followers(True)
+        self.role = "follower"
+        log.info("%s follows the dispatch leader on %s", self.holder, self.address)
+
+    def _step_down(self) -> None:
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        dispatcher.reset_wheel()  # the next leader reloads scheduled rides
+
+    def _bind_followers(self, following: bool) -> None:
+        dispatcher.leader = self.client if following else None
+        driver_state.on_change = (lambda driver_id: self.client.notify("driver", driver_id)) if following else None
+
+
+coordinator = Coordinator()
+
+
+# ---------- helpers for the routers ----------
+def driver_available(session: Session, driver_id: int) -> bool:
+    """A driver just became available. True if this process assigned or moved rides for it."""
+    if coordinator.following:
+        coordinator.client.notify("driver_available", driver_id)
+        return False
+    return _free_driver(session, driver_id)
+
+
+def reserve(ride: RideRequest, driver_id: int) -> bool:
+    """
+    Hold `driver_id` for a scheduled ride, in the leader's commitment index when
+    following. Raises ConnectionError if the leader cannot be reached.
+    """
+    if not coordinator.following:
+        return commitments.reserve(ride, driver_id)
+    window = commitments.commitment_window(ride)
+    if window is None:
+        return False
+    return coordinator.client.call("reserve", driver_id, window[0], window[1], ride.ride_id)
+
+
+def release(ride_id: int) -> None:
+    """Drop the reservation of a ride whose row was never stored (its insert failed)."""
+    if coordinator.following:
+        coordinator.client.notify("ride", ride_id)  # the leader finds no row and forgets it
+    else:
+        commitments.commitments.remove(ride_id)
+
+
+def ride_changed(ride_id: int) -> None:
+    """A ride row was written outside the dispatcher (booking with a driver, completion)."""
+    if coordinator.following:
+        coordinator.client.notify("ride", ride_id)
+
+
+def wait_processed(ride_id: int, timeout: float) -> None:
+    """Follower long-poll: block until the leader has processed the ride or timeout passes."""
+    try:
+        coordinator.client.call("wait", ride_id, timeout)
+    except ConnectionError:
+        time.sleep(min(timeout, 1.0))
+
+
+async def _serve_forever() -> None:
+    from app.services import decision_log, eta_model, zone_matrix
+
+    dispatcher.start()
+    eta_model.start_retraining()
+    zone_matrix.start_refreshing()
+    decision_log.writer.start(engine)
+    coordinator.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await coordinator.stop()
+        await dispatcher.stop()
+        await eta_model.stop_retraining()
+        await zone_matrix.stop_refreshing()
+        decision_log.writer.stop()
+
+
+def main() -> None:
+    """Dedicated dispatcher process: competes for the lease and leads whenever it holds it."""
+    from app.database import init_db
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    routing.preload()
+    coordinator.mode = "auto"
+    try:
+        asyncio.run(_serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Batch ride-to-driver matching.
+
+Instead of giving each ride the nearest free driver as it arrives, a batch of
+pending rides is matched against the available drivers at once by solving a
+min-cost bipartite assignment (Hungarian algorithm) over the scheduler's _score.
+"""
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+from sqlmodel import Session
+
+from app.models.models import Driver, RideRequest
+from app.services import decision_log, scheduler
+
+# How many of the nearest drivers each ride may be matched with
+DISPATCH_CANDIDATES_PER_RIDE = int(os.getenv("DISPATCH_CANDIDATES_PER_RIDE", "10"))
+
+# Cost for ride/driver pairs that were not scored (never chosen over a real pair)
+_UNREACHABLE = 1e9
+
+
+def solve_assignment(cost: List[List[float]]) -> List[Tuple[int, int]]:
+    """
+    Min-cost assignment for a rectangular cost matrix (Hungarian algorithm, O(n^2 m)).
+    Returns (row, col) pairs; when rows != cols only min(rows, cols) pairs are returned.
+    """
+    if not cost or not cost[0]:
+        return []
+
+    transposed = len(cost) > len(cost[0])
+    if transposed:
+        cost = [list(col) for col in zip(*cost)]
+    n, m = len(cost), len(cost[0])
+
+    inf = float("inf")
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    p = [0] * (m + 1)      # p[j] = row matched to column j (1-based, 0 = none)
+    way = [0] * (m + 1)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            row = cost[i0 - 1]
+            delta, j1 = inf, 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = row[j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j], way[j] = cur, j0
+                    if minv[j] < delta:
+                        delta, j1 = minv[j], j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        # augment along the alternating path
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    pairs = [(p[j] - 1, j - 1) for j in range(1, m + 1) if p[j]]
+    if transposed:
+        pairs = [(c, r) for r, c in pairs]
+    return sorted(pairs)
+
+
+def dispatch_batch(session: Session, rides: List[RideRequest]) -> List[RideRequest]:
+    """
+    Match pending rides to available drivers and commit every assignment in one
+    transaction. Rides that could not be matched stay "requested".
+    Returns the rides that were assigned.
+    """
+    rides = [r for r in rides if r.pickup_lat is not None and r.pickup_lng is not None]
+    if not rides:
+        return []
+
+    # Score each ride against its nearest drivers
+    drivers: Dict[int, Driver] = {}
+    scored: List[List[Tuple[Driver, float]]] = []
+    traces: List[decision_log.DecisionTrace] = []
+    for ride in rides:
+        with decision_log.tracing(ride.ride_id, "batch", record=False) as trace:
+            with decision_log.timed("db"):
+                candidates = scheduler.load_candidates(session, ride)
+                priority = scheduler.user_priority_for(session, ride)
+            decision_log.count(candidates=len(candidates))
+            pairs = scheduler.nearest_candidate_scores(ride, candidates, priority, DISPATCH_CANDIDATES_PER_RIDE)
+        for d, _ in pairs:
+            drivers[d.driver_id] = d
+        scored.append(pairs)
+        traces.append(trace)
+    if not drivers:
+        _record(traces, scored, {})
+        return []
+
+    columns = list(drivers.values())
+    col_of = {d.driver_id: j for j, d in enumerate(columns)}
+    cost = [[_UNREACHABLE] * len(columns) for _ in rides]
+    for i, pairs in enumerate(scored):
+        for d, score in pairs:
+            cost[i][col_of[d.driver_id]] = score
+
+    t0 = time.perf_counter()
+    matched = [(i, j) for i, j in solve_assignment(cost) if cost[i][j] < _UNREACHABLE]
+    solve_share = (time.perf_counter() - t0) / len(rides)
+    for trace in traces:
+        trace.scoring_sec += solve_share
+    pairs = [(rides[i], columns[j]) for i, j in matched]
+    trace_of = {rides[i].ride_id: traces[i] for i, _ in matched}
+    # Maps calls for the trip legs happen before any row is claimed
+    estimates = []
+    for ride, _ in pairs:
+        with decision_log.resume(trace_of[ride.ride_id]):
+            estimates.append(scheduler.trip_estimates(ride))
+
+    assigned: List[Tuple[RideRequest, Driver]] = []
+    now = datetime.utcnow()
+    for (ride, driver), leg in zip(pairs, estimates):
+        # Atomic claim; a pair that lost a race is skipped and retried next window
+        with decision_log.resume(trace_of[ride.ride_id]):
+            if scheduler.claim_assignment(session, ride, driver.driver_id, leg, now):
+                assigned.append((ride, driver))
+
+    # every claim in the batch commits together
+    session.commit()
+    for ride, driver in assigned:
+        session.refresh(ride)
+        scheduler.track_assignment(ride)
+    _record(traces, scored, {ride.ride_id: driver.driver_id for ride, driver in assigned})
+    return [ride for ride, _ in assigned]
+
+
+def _record(
+    traces: List[decision_log.DecisionTrace], scored: List[List[Tuple[Driver, float]]], winners: Dict[int, int]
+) -> None:
+    for trace, pairs in zip(traces, scored):
+        trace.driver_id = winners.get(trace.ride_id)
+        ids = [d.driver_id for d, _ in pairs]
+        winner = ids.index(trace.driver_id) if trace.driver_id in ids else None
+        trace.set_scores([score for _, score in pairs], winner)
+        decision_log.record_trace(trace)
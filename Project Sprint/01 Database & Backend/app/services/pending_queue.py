@@ -0,0 +1,166 @@
+"""
+Pending-ride queue: rides that found no free driver wait here instead of failing.
+
+Rides are served highest effective priority first, where
+
+    effective = User.priority_level + PENDING_AGING_PER_MIN * minutes waited
+
+so a low-priority rider keeps gaining ground and is never starved. Every queued
+ride ages at the same rate, which makes the order fixed at insertion time: the
+heap key is priority - rate * requested_at and nothing is ever re-sorted.
+
+The rides table is the source of truth (queued rides simply stay "requested");
+the heap is rebuilt from it at startup and drained whenever a driver frees up.
+A drain walks the queue in priority order: a ride no free driver can serve
+(vehicle type, commitments) keeps its place without blocking the rides behind it.
+"""
+import heapq
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlmodel import Session, select
+
+from app.models.models import RideRequest
+from app.services.scheduler import assign_driver_to_ride, user_priority_for
+
+# Priority points a waiting ride gains per minute (0.1 -> one level every 10 min)
+PENDING_AGING_PER_MIN = float(os.getenv("PENDING_AGING_PER_MIN", "0.1"))
+# Most rides a single drain may assign (one freed driver usually serves one ride)
+PENDING_DRAIN_MAX = int(os.getenv("PENDING_DRAIN_MAX", "20"))
+# Most queued rides a single drain tries, served or not
+PENDING_SCAN_MAX = int(os.getenv("PENDING_SCAN_MAX", "100"))
+
+
+def _epoch_min(dt: datetime) -> float:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)  # stored naive, in UTC
+    return dt.timestamp() / 60.0
+
+
+class PendingQueue:
+    """Max-priority queue of ride ids with aging. Removal is lazy (stale heap entries are skipped)."""
+
+    def __init__(self, aging_per_min: float = PENDING_AGING_PER_MIN):
+        self.aging_per_min = aging_per_min
+        self._heap: List[Tuple[float, float, int]] = []  # (-key, requested_min, ride_id)
+        self._entries: Dict[int, Tuple[float, float]] = {}  # live ride_id -> (key, requested_min)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, ride_id: int) -> bool:
+        return ride_id in self._entries
+
+    def push(self, ride_id: int, priority: int, requested_at: datetime) -> None:
+        requested_min = _epoch_min(requested_at)
+        key = priority - self.aging_per_min * requested_min
+        with self._lock:
+            if self._entries.get(ride_id) == (key, requested_min):
+                return
+            self._entries[ride_id] = (key, requested_min)
+            heapq.heappush(self._heap, (-key, requested_min, ride_id))
+
+    def discard(self, ride_id: int) -> None:
+        with self._lock:
+            self._entries.pop(ride_id, None)
+
+    def peek(self) -> Optional[int]:
+        """Ride id at the head of the queue (not removed)."""
+        with self._lock:
+            while self._heap:
+                neg_key, requested_min, ride_id = self._heap[0]
+                if self._entries.get(ride_id) == (-neg_key, requested_min):
+                    return ride_id
+                heapq.heappop(self._heap)
+            return None
+
+    def ordered(self, n: int) -> List[int]:
+        """Up to n live ride ids, head first (not removed)."""
+        with self._lock:
+            live = [e for e in self._heap if self._entries.get(e[2]) == (-e[0], e[1])]
+        return [ride_id for _, _, ride_id in heapq.nsmallest(n, live)]
+
+    def effective_priority(self, ride_id: int, now: Optional[datetime] = None) -> Optional[float]:
+        entry = self._entries.get(ride_id)
+        if entry is None:
+            return None
+        return entry[0] + self.aging_per_min * _epoch_min(now or datetime.utcnow())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._heap.clear()
+            self._entries.clear()
+
+    def stats(self, now: Optional[datetime] = None) -> dict:
+        """Depth and wait times (minutes) of the rides currently queued."""
+        now_min = _epoch_min(now or datetime.utcnow())
+        with self._lock:
+            waits = [now_min - requested_min for _, requested_min in self._entries.values()]
+        return {
+            "depth": len(waits),
+            "oldest_wait_min": round(max(waits), 2) if waits else 0.0,
+            "avg_wait_min": round(sum(waits) / len(waits), 2) if waits else 0.0,
+            "aging_per_min": self.aging_per_min,
+        }
+
+
+# Process-wide queue of unassigned rides
+pending_queue = PendingQueue()
+
+# One drain at a time, so two freed drivers don't both chase the same head ride
+_drain_lock = threading.Lock()
+
+
+def enqueue(session: Session, ride: RideRequest) -> None:
+    """Queue a saved ride that could not get a driver right now."""
+    pending_queue.push(ride.ride_id, user_priority_for(session, ride), ride.requested_at)
+
+
+def load_pending_rides(session: Session) -> int:
+    """
+    Startup: rebuild the queue from rides still waiting for a driver. Rides booked
+    ahead are left to the dispatcher's timing wheel. Returns the queue depth.
+    """
+    rides = session.exec(
+        select(RideRequest).where(
+            RideRequest.status == "requested",
+            RideRequest.driver_id.is_(None),
+            RideRequest.pickup_lat.is_not(None),
+            RideRequest.pickup_lng.is_not(None),
+            RideRequest.scheduled_for.is_(None),
+        )
+    ).all()
+    pending_queue.clear()
+    for ride in rides:
+        enqueue(session, ride)
+    return len(pending_queue)
+
+
+def assign_pending(session: Session, limit: int = PENDING_DRAIN_MAX) -> List[RideRequest]:
+    """
+    A driver just became available: try queued rides in priority order and
+    assign those a driver can serve, until `limit` rides were served or
+    PENDING_SCAN_MAX were tried. A ride with no compatible driver keeps its
+    place and the scan moves on. Returns the assigned rides.
+    """
+    assigned: List[RideRequest] = []
+    if not len(pending_queue):
+        return assigned
+    with _drain_lock:
+        for ride_id in pending_queue.ordered(PENDING_SCAN_MAX):
+            if len(assigned) >= limit:
+                break
+            ride = session.get(RideRequest, ride_id)
+            if ride is None or ride.status != "requested" or ride.driver_id is not None:
+                pending_queue.discard(ride_id)  # cancelled or assigned elsewhere
+                continue
+            result = assign_driver_to_ride(session, ride)
+            if result is None:
+                if ride.status != "requested":
+                    pending_queue.discard(ride_id)
+                continue  # no driver for this one; it keeps its place
+            pending_queue.discard(ride_id)
+            assigned.append(result)
+    return assigned
@@ -0,0 +1,144 @@
+"""
+Hand an assigned ride to a driver who just became available, when that driver
+is clearly better placed than the one already on the way.
+
+Runs when a driver turns available (status change, ride completed) and the
+pending queue had nothing for them. Only rides in the cells around the driver
+(app.services.ride_index, REASSIGN_RINGS) are considered, never the whole
+table. Both legs are scored with the scheduler's _score on straight-line
+distance, from the current driver's last known position; a ride moves only if
+the score improves by at least REASSIGN_MIN_GAIN. Rides booked with a specific
+driver are never moved, nor rides already started (PATCH /ride-requests/{id}/start
+sets "ongoing").
+
+The old driver is freed by the same transaction and may in turn pick up a
+waiting ride or take over another one, up to REASSIGN_MAX_CHAIN hand-overs.
+Every move lowers the total score by the threshold, so chains end.
+"""
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+from sqlalchemy import update
+from sqlmodel import Session
+
+from app.models.models import Driver, RideRequest
+from app.services import commitments, driver_state, ride_index, scheduler
+from app.services.pending_queue import assign_pending
+from app.services.scoring import haversine_km
+
+REASSIGN_ENABLED = os.getenv("REASSIGN_ENABLED", "true").lower() in ("1", "true", "yes")
+REASSIGN_MIN_GAIN = float(os.getenv("REASSIGN_MIN_GAIN", "2.0"))  # score points (~km)
+REASSIGN_RINGS = int(os.getenv("REASSIGN_RINGS", "3"))
+REASSIGN_MAX_CHAIN = int(os.getenv("REASSIGN_MAX_CHAIN", "3"))
+
+log = logging.getLogger(__name__)
+
+
+def _position(session: Session, driver_id: int) -> Optional[Tuple[float, float]]:
+    states = driver_state.driver_states
+    record = states.get(driver_id) if states.loaded else session.get(Driver, driver_id)
+    if record is None or record.current_lat is None or record.current_lng is None:
+        return None
+    return record.current_lat, record.current_lng
+
+
+def _leg_score(lat: float, lng: float, ride: RideRequest) -> float:
+    km = haversine_km(lat, lng, ride.pickup_lat, ride.pickup_lng)
+    return scheduler._score(km, km / scheduler.FALLBACK_SPEED_KMH * 60.0, 0)
+
+
+def best_takeover(session: Session, driver: Driver) -> Optional[Tuple[float, RideRequest]]:
+    """(score gain, ride) for the nearby assigned ride this driver would improve most."""
+    best = None
+    for ride_id in ride_index.assigned_rides.within(driver.current_lat, driver.current_lng, REASSIGN_RINGS):
+        if commitments.commitments.driver_for(ride_id) is not None:
+            continue
+        ride = session.get(RideRequest, ride_id)
+        if ride is None or ride.status != "assigned":
+            ride_index.untrack(ride_id)
+            continue
+        if ride.driver_id is None or ride.driver_id == driver.driver_id:
+            continue
+        if not scheduler.vehicle_compatible(driver, ride):
+            continue
+        current = _position(session, ride.driver_id)
+        if current is None:
+            continue
+        gain = _leg_score(*current, ride) - _leg_score(driver.current_lat, driver.current_lng, ride)
+        if gain < REASSIGN_MIN_GAIN or (best is not None and gain <= best[0]):
+            continue
+        start, end = commitments.busy_window(ride)
+        if commitments.commitments.is_free(driver.driver_id, start, end):
+            best = (gain, ride)
+    return best
+
+
+def hand_over(session: Session, ride: RideRequest, from_id: int, to_id: int) -> bool:
+    """
+    Move `ride` from one driver to another in one transaction. Conditional
+    UPDATEs, as in scheduler.claim_assignment: the new driver must still be
+    available and the ride still assigned to the old one and not started
+    (status "assigned"; starting it sets "ongoing").
+    """
+    taken = session.exec(
+        update(Driver)
+        .where(Driver.driver_id == to_id, Driver.availability_status == "available")
+        .values(availability_status="on_ride")
+    )
+    moved = taken.rowcount == 1 and session.exec(
+        update(RideRequest)
+        .where(
+            RideRequest.ride_id == ride.ride_id,
+            RideRequest.status == "assigned",
+            RideRequest.driver_id == from_id,
+        )
+        .values(driver_id=to_id, assigned_at=datetime.utcnow())
+    ).rowcount == 1
+    if not moved:
+        session.rollback()
+        return False
+    session.exec(
+        update(Driver)
+        .where(Driver.driver_id == from_id, Driver.availability_status == "on_ride")
+        .values(availability_status="available")
+    )
+    session.commit()
+    return True
+
+
+def reassign_for(session: Session, driver_id: int) -> List[int]:
+    """Driver `driver_id` is available: take over nearby rides where that pays off. Returns moved ride ids."""
+    moved: List[int] = []
+    if not REASSIGN_ENABLED:
+        return moved
+    for _ in range(REASSIGN_MAX_CHAIN):
+        driver = session.get(Driver, driver_id)
+        if driver is None or driver.availability_status != "available" or driver.current_lat is None:
+            break
+        found = best_takeover(session, driver)
+        if found is None:
+            break
+        gain, ride = found
+        old_driver = ride.driver_id
+        if not hand_over(session, ride, old_driver, driver_id):
+            scheduler._resync_driver(session, driver_id)
+            break
+        for d in (driver_id, old_driver):
+            scheduler._resync_driver(session, d)
+        moved.append(ride.ride_id)
+        log.info("ride %s moved from driver %s to %s (gain %.2f)", ride.ride_id, old_driver, driver_id, gain)
+        # the freed driver serves the pending queue first, then may improve another ride
+        assign_pending(session, limit=1)
+        driver_id = old_driver
+    return moved
+
+
+def serve_freed(session: Session, driver_ids: Sequence[int]) -> bool:
+    """
+    Drivers just became available: they serve the pending queue first (one ride
+    each at most), then may take over nearby rides. True if anything moved.
+    """
+    served = assign_pending(session, limit=len(driver_ids))
+    moved = [reassign_for(session, driver_id) for driver_id in driver_ids]
+    return bool(served or any(moved))
@@ -0,0 +1,41 @@
+"""
+Spatial index of rides that have a driver but have not been picked up yet
+(status "assigned"), keyed by ride id at the pickup point.
+
+Lets app.services.reassign look only at assigned rides near a driver that just
+became available. Kept in line by the assignment paths (scheduler, matching)
+and by ride completion; rebuilt from the database at startup.
+"""
+from sqlmodel import Session, select
+
+from app.models.models import RideRequest
+from app.services.driver_index import GridIndex
+
+# Process-wide; ride_id -> pickup
+assigned_rides = GridIndex()
+
+
+def track(ride: RideRequest) -> None:
+    if ride.status == "assigned" and ride.pickup_lat is not None and ride.pickup_lng is not None:
+        assigned_rides.upsert(ride.ride_id, ride.pickup_lat, ride.pickup_lng)
+    else:
+        assigned_rides.remove(ride.ride_id)
+
+
+def untrack(ride_id: int) -> None:
+    assigned_rides.remove(ride_id)
+
+
+def load_assigned_rides(session: Session) -> int:
+    rides = session.exec(
+        select(RideRequest).where(
+            RideRequest.status == "assigned",
+            RideRequest.pickup_lat.is_not(None),
+            RideRequest.pickup_lng.is_not(None),
+        )
+    ).all()
+    assigned_rides.clear()
+    for ride in rides:
+        assigned_rides.upsert(ride.ride_id, ride.pickup_lat, ride.pickup_lng)
+    assigned_rides.loaded = True
+    return len(rides)
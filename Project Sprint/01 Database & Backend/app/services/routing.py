@@ -0,0 +1,399 @@
+"""
+Offline road routing: a local stand-in for the Distance Matrix API.
+
+Selected with ROUTING_BACKEND=local; google_maps.get_eta_and_distance_minutes(_many)
+then answer from a road graph on disk instead of calling Google.
+
+Graph file (ROUTING_GRAPH_PATH), one record per line, '#' starts a comment:
+    n <node_id> <lat> <lng>
+    e <from_id> <to_id> <length_m> <duration_s> [1]     # trailing 1 = two-way
+An OSM extract converts to this with any edge-list exporter (node coordinates,
+way segment lengths, and length / maxspeed for durations).
+
+Queries snap both ends to the nearest graph node (the access leg is costed at
+ROUTING_ACCESS_SPEED_KMH) and run a shortest-time search. With ROUTING_USE_CH
+the graph is preprocessed into a contraction hierarchy (cached next to the
+graph file), so a query only explores the small "upward" search spaces of its
+two endpoints; otherwise a bidirectional Dijkstra runs on the plain graph. The
+cache holds plain arrays (no pickle), and any cache that fails to load or does
+not match the graph is rebuilt.
+
+The graph is loaded at startup (`preload`), not inside the first request. A
+graph that cannot be read or parsed is logged once and remembered: routing
+then answers None (callers fall back as for a Maps outage) until restart.
+"""
+import heapq
+import logging
+import os
+import struct
+import threading
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.services.driver_index import GridIndex
+from app.services.scoring import haversine_km
+
+ROUTING_BACKEND = os.getenv("ROUTING_BACKEND", "google").lower()
+ROUTING_GRAPH_PATH = os.getenv("ROUTING_GRAPH_PATH", "road_graph.txt")
+ROUTING_USE_CH = os.getenv("ROUTING_USE_CH", "true").lower() in ("1", "true", "yes")
+ROUTING_ACCESS_SPEED_KMH = float(os.getenv("ROUTING_ACCESS_SPEED_KMH", "15"))
+ROUTING_MAX_SNAP_KM = float(os.getenv("ROUTING_MAX_SNAP_KM", "2.0"))
+
+# .ch cache: magic, node count; then per direction: edge count and CSR arrays
+_CH_HEADER = struct.Struct("<4sQ")
+_CH_MAGIC = b"CHA1"
+_CH_COUNT = struct.Struct("<Q")
+
+# Witness searches during contraction give up after this many settled nodes
+_WITNESS_SETTLE_LIMIT = 60
+
+log = logging.getLogger(__name__)
+
+# adjacency entry: (neighbor, duration_s, length_m)
+Edge = Tuple[int, float, float]
+
+
+class RoadGraph:
+    def __init__(self):
+        self.lats: List[float] = []
+        self.lngs: List[float] = []
+        self.out: List[List[Edge]] = []
+        self.inc: List[List[Edge]] = []
+        self._ids: Dict[str, int] = {}
+        self._snap = GridIndex(cell_km=0.5)
+        self.ch: Optional["ContractionHierarchy"] = None
+
+    def __len__(self) -> int:
+        return len(self.lats)
+
+    def add_node(self, node_id: str, lat: float, lng: float) -> int:
+        idx = self._ids.get(node_id)
+        if idx is None:
+            idx = self._ids[node_id] = len(self.lats)
+            self.lats.append(lat)
+            self.lngs.append(lng)
+            self.out.append([])
+            self.inc.append([])
+            self._snap.upsert(idx, lat, lng)
+        return idx
+
+    def add_edge(self, from_id: str, to_id: str, length_m: float, duration_s: float, two_way: bool = False) -> None:
+        u, v = self._ids[from_id], self._ids[to_id]
+        self.out[u].append((v, duration_s, length_m))
+        self.inc[v].append((u, duration_s, length_m))
+        if two_way:
+            self.out[v].append((u, duration_s, length_m))
+            self.inc[u].append((v, duration_s, length_m))
+
+    @classmethod
+    def load(cls, path: str) -> "RoadGraph":
+        graph = cls()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                parts = line.split("#", 1)[0].split()
+                if not parts:
+                    continue
+                if parts[0] == "n":
+                    graph.add_node(parts[1], float(parts[2]), float(parts[3]))
+                elif parts[0] == "e":
+                    two_way = len(parts) > 5 and parts[5] == "1"
+                    graph.add_edge(parts[1], parts[2], float(parts[3]), float(parts[4]), two_way)
+        return graph
+
+    def nearest_node(self, lat: float, lng: float) -> Optional[Tuple[int, float]]:
+        """(node, distance_km) of the closest graph node."""
+        candidates = self._snap.nearby(lat, lng)
+        if not candidates:
+            return None
+        return min(((n, haversine_km(lat, lng, self.lats[n], self.lngs[n])) for n in candidates), key=lambda p: p[1])
+
+    def shortest(self, s: int, t: int) -> Optional[Tuple[float, float]]:
+        """(duration_s, length_m) of the fastest s -> t path."""
+        if self.ch is not None:
+            return self.ch.query(s, t)
+        return bidirectional_dijkstra(self.out, self.inc, s, t)
+
+    def route(self, olat: float, olng: float, dlat: float, dlng: float) -> Optional[Tuple[float, float]]:
+        """(duration_min, distance_km) between two points, or None if either is off the network."""
+        start, end = self.nearest_node(olat, olng), self.nearest_node(dlat, dlng)
+        if start is None or end is None or max(start[1], end[1]) > ROUTING_MAX_SNAP_KM:
+            return None
+        return _with_access(self.shortest(start[0], end[0]), start[1] + end[1])
+
+
+def _with_access(path: Optional[Tuple[float, float]], access_km: float) -> Optional[Tuple[float, float]]:
+    """Graph path (s, m) plus the off-network legs to/from the snapped nodes -> (min, km)."""
+    if path is None:
+        return None
+    duration_s, length_m = path
+    return duration_s / 60.0 + access_km / ROUTING_ACCESS_SPEED_KMH * 60.0, length_m / 1000.0 + access_km
+
+
+def bidirectional_dijkstra(out: List[List[Edge]], inc: List[List[Edge]], s: int, t: int) -> Optional[Tuple[float, float]]:
+    """Fastest s -> t path on a plain graph, searching from both ends until the frontiers meet."""
+    if s == t:
+        return 0.0, 0.0
+    labels = ({s: (0.0, 0.0)}, {t: (0.0, 0.0)})
+    heaps = ([(0.0, 0.0, s)], [(0.0, 0.0, t)])
+    adjacency = (out, inc)
+    settled = (set(), set())
+    best: Optional[Tuple[float, float]] = None
+    while heaps[0] and heaps[1]:
+        if best is not None and heaps[0][0][0] + heaps[1][0][0] >= best[0]:
+            break
+        side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+        time_s, length_m, node = heapq.heappop(heaps[side])
+        if node in settled[side]:
+            continue
+        settled[side].add(node)
+        other = labels[1 - side].get(node)
+        if other is not None and (best is None or time_s + other[0] < best[0]):
+            best = (time_s + other[0], length_m + other[1])
+        for nxt, dt, dl in adjacency[side][node]:
+            cand = time_s + dt
+            old = labels[side].get(nxt)
+            if old is None or cand < old[0]:
+                labels[side][nxt] = (cand, length_m + dl)
+                heapq.heappush(heaps[side], (cand, length_m + dl, nxt))
+    return best
+
+
+class ContractionHierarchy:
+    """
+    Nodes are contracted one by one (cheapest edge difference first); shortcuts
+    keep shortest times between the remaining nodes. A query then only relaxes
+    edges towards higher-ranked nodes from both ends.
+    """
+
+    def __init__(self, up_out: List[List[Edge]], up_in: List[List[Edge]]):
+        self.up_out = up_out   # v -> higher-ranked w
+        self.up_in = up_in     # higher-ranked u -> v, stored at v
+
+    @classmethod
+    def build(cls, out: List[List[Edge]]) -> "ContractionHierarchy":
+        n = len(out)
+        fwd: List[Dict[int, Tuple[float, float]]] = [dict() for _ in range(n)]
+        bwd: List[Dict[int, Tuple[float, float]]] = [dict() for _ in range(n)]
+        for u, edges in enumerate(out):
+            for v, dt, dl in edges:
+                if u != v and (v not in fwd[u] or dt < fwd[u][v][0]):
+                    fwd[u][v] = (dt, dl)
+                    bwd[v][u] = (dt, dl)
+
+        contracted = [False] * n
+        up_out: List[List[Edge]] = [[] for _ in range(n)]
+        up_in: List[List[Edge]] = [[] for _ in range(n)]
+        depth = [0] * n  # contracted neighbours, spreads contraction evenly
+
+        def shortcuts_for(v: int) -> List[Tuple[int, int, float, float]]:
+            found = []
+            if not fwd[v]:
+                return found
+            max_out = max(dt for dt, _ in fwd[v].values())
+            for u, (t_uv, l_uv) in bwd[v].items():
+                reach = _witness_search(fwd, u, v, t_uv + max_out)
+                for w, (t_vw, l_vw) in fwd[v].items():
+                    if w == u:
+                        continue
+                    t = t_uv + t_vw
+                    if reach.get(w, float("inf")) > t:
+                        found.append((u, w, t, l_uv + l_vw))
+            return found
+
+        def priority(v: int, shortcuts: List[Tuple[int, int, float, float]]) -> int:
+            return len(shortcuts) - len(fwd[v]) - len(bwd[v]) + depth[v]
+
+        heap = [(priority(v, shortcuts_for(v)), v) for v in range(n)]
+        heapq.heapify(heap)
+        while heap:
+            _, v = heapq.heappop(heap)
+            if contracted[v]:
+                continue
+            # lazy update: re-evaluate, and wait our turn if we got more expensive
+            shortcuts = shortcuts_for(v)
+            current = priority(v, shortcuts)
+            if heap and current > heap[0][0]:
+                heapq.heappush(heap, (current, v))
+                continue
+            for u, w, t, length in shortcuts:
+                if w not in fwd[u] or t < fwd[u][w][0]:
+                    fwd[u][w] = (t, length)
+                    bwd[w][u] = (t, length)
+            contracted[v] = True
+            up_out[v] = [(w, dt, dl) for w, (dt, dl) in fwd[v].items()]
+            up_in[v] = [(u, dt, dl) for u, (dt, dl) in bwd[v].items()]
+            for w in fwd[v]:
+                del bwd[w][v]
+                depth[w] += 1
+            for u in bwd[v]:
+                del fwd[u][v]
+                depth[u] += 1
+            fwd[v], bwd[v] = {}, {}
+        return cls(up_out, up_in)
+
+    @staticmethod
+    def _search(
+        adjacency: List[List[Edge]], source: int, meet: Optional[Dict[int, Tuple[float, float]]] = None
+    ):
+        """
+        Upward Dijkstra from source. Without `meet` returns every label; given a
+        finished search from the other end, returns the best meeting and stops as
+        soon as the frontier can no longer improve on it.
+        """
+        labels = {source: (0.0, 0.0)}
+        heap = [(0.0, 0.0, source)]
+        done = set()
+        best: Optional[Tuple[float, float]] = None
+        while heap:
+            time_s, length_m, node = heapq.heappop(heap)
+            if best is not None and time_s >= best[0]:
+                break
+            if node in done:
+                continue
+            done.add(node)
+            if meet is not None:
+                other = meet.get(node)
+                if other is not None and (best is None or time_s + other[0] < best[0]):
+                    best = (time_s + other[0], length_m + other[1])
+            for nxt, dt, dl in adjacency[node]:
+                cand = time_s + dt
+                old = labels.get(nxt)
+                if old is None or cand < old[0]:
+                    labels[nxt] = (cand, length_m + dl)
+                    heapq.heappush(heap, (cand, length_m + dl, nxt))
+        return labels if meet is None else best
+
+    def save(self, f) -> None:
+        """Write as arrays: per direction, row offsets, targets, durations, lengths (native byte order)."""
+        f.write(_CH_HEADER.pack(_CH_MAGIC, len(self.up_out)))
+        for rows in (self.up_out, self.up_in):
+            offsets, targets, durations, lengths = array("q", [0]), array("q"), array("d"), array("d")
+            for edges in rows:
+                for v, dt, dl in edges:
+                    targets.append(v)
+                    durations.append(dt)
+                    lengths.append(dl)
+                offsets.append(len(targets))
+            f.write(_CH_COUNT.pack(len(targets)))
+            for values in (offsets, targets, durations, lengths):
+                values.tofile(f)
+
+    @classmethod
+    def read(cls, f, nodes: int) -> "ContractionHierarchy":
+        """Read what `save` wrote; ValueError if it is not a hierarchy for `nodes` nodes."""
+        magic, n = _CH_HEADER.unpack(f.read(_CH_HEADER.size))
+        if magic != _CH_MAGIC or n != nodes:
+            raise ValueError("not a contraction hierarchy for this graph")
+        directions = []
+        for _ in range(2):
+            (m,) = _CH_COUNT.unpack(f.read(_CH_COUNT.size))
+            offsets, targets, durations, lengths = array("q"), array("q"), array("d"), array("d")
+            offsets.fromfile(f, n + 1)  # EOFError when truncated
+            for values in (targets, durations, lengths):
+                values.fromfile(f, m)
+            if offsets[0] != 0 or offsets[-1] != m or any(not 0 <= v < n for v in targets):
+                raise ValueError("corrupt contraction hierarchy")
+            directions.append([
+                list(zip(targets[offsets[v]:offsets[v + 1]], durations[offsets[v]:offsets[v + 1]],
+                         lengths[offsets[v]:offsets[v + 1]]))
+                for v in range(n)
+            ])
+        return cls(*directions)
+
+    def query(self, s: int, t: int) -> Optional[Tuple[float, float]]:
+        return self.query_many([s], t)[0]
+
+    def query_many(self, sources: Sequence[int], t: int) -> List[Optional[Tuple[float, float]]]:
+        """Many origins, one destination: the destination's search space is computed once."""
+        backward = self._search(self.up_in, t)
+        return [self._search(self.up_out, s, backward) for s in sources]
+
+
+def _witness_search(fwd: List[Dict[int, Tuple[float, float]]], source: int, skip: int, limit: float) -> Dict[int, float]:
+    """Shortest times from source avoiding `skip`, up to `limit` seconds / a few settled nodes."""
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = 0
+    while heap and settled < _WITNESS_SETTLE_LIMIT:
+        d, node = heapq.heappop(heap)
+        if d > dist.get(node, float("inf")):
+            continue
+        if d > limit:
+            break
+        settled += 1
+        for nxt, (dt, _) in fwd[node].items():
+            if nxt == skip:
+                continue
+            cand = d + dt
+            if cand < dist.get(nxt, float("inf")):
+                dist[nxt] = cand
+                heapq.heappush(heap, (cand, nxt))
+    return dist
+
+
+def load_graph(path: str = ROUTING_GRAPH_PATH, use_ch: bool = ROUTING_USE_CH) -> RoadGraph:
+    """Read the graph and attach its contraction hierarchy (built once, then cached as <path>.ch)."""
+    graph = RoadGraph.load(path)
+    if use_ch:
+        cache = f"{path}.ch"
+        if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+            try:
+                with open(cache, "rb") as f:
+                    graph.ch = ContractionHierarchy.read(f, len(graph))
+            except Exception:  # truncated, older format, another graph: the cache is only a shortcut
+                log.warning("contraction hierarchy cache %s is unusable; rebuilding", cache, exc_info=True)
+        if graph.ch is None:
+            graph.ch = ContractionHierarchy.build(graph.out)
+            tmp = f"{cache}.{os.getpid()}.tmp"  # workers starting together each build, one file wins
+            with open(tmp, "wb") as f:
+                graph.ch.save(f)
+            os.replace(tmp, cache)
+    return graph
+
+
+_graph: Optional[RoadGraph] = None
+_graph_failed = False
+_graph_lock = threading.Lock()
+
+
+def get_graph() -> Optional[RoadGraph]:
+    """The process-wide graph, loaded on first use; None if it could not be loaded."""
+    global _graph, _graph_failed
+    if _graph is None and not _graph_failed:
+        with _graph_lock:
+            if _graph is None and not _graph_failed:
+                try:
+                    _graph = load_graph()
+                    log.info("road graph loaded: %d nodes", len(_graph))
+                except (OSError, ValueError, KeyError, IndexError):  # missing file, malformed line
+                    log.exception("road graph %s could not be loaded", ROUTING_GRAPH_PATH)
+                    _graph_failed = True
+    return _graph
+
+
+def preload() -> None:
+    """Load the graph (and build its hierarchy) now when the local backend is selected."""
+    if ROUTING_BACKEND == "local":
+        get_graph()
+
+
+def route(olat: float, olng: float, dlat: float, dlng: float) -> Optional[Tuple[float, float]]:
+    graph = get_graph()
+    return graph.route(olat, olng, dlat, dlng) if graph is not None else None
+
+
+def route_many(origins: Sequence[Tuple[float, float]], dlat: float, dlng: float) -> List[Optional[Tuple[float, float]]]:
+    """route() from every origin to one destination, aligned with `origins`."""
+    graph = get_graph()
+    if graph is None or graph.ch is None:
+        return [route(lat, lng, dlat, dlng) for lat, lng in origins]
+    end = graph.nearest_node(dlat, dlng)
+    results: List[Optional[Tuple[float, float]]] = [None] * len(origins)
+    if end is None or end[1] > ROUTING_MAX_SNAP_KM:
+        return results
+    starts = [graph.nearest_node(lat, lng) for lat, lng in origins]
+    usable = [i for i, st in enumerate(starts) if st is not None and st[1] <= ROUTING_MAX_SNAP_KM]
+    found = graph.ch.query_many([starts[i][0] for i in usable], end[0])
+    for i, path in zip(usable, found):
+        results[i] = _with_access(path, starts[i][1] + end[1])
+    return results
@@ -1,77 +1,356 @@
-from math import radians, sin, cos, asin, sqrt
+import os
 from datetime import datetime
-from typing import Optional
+from typing import Callable, List, Optional, Tuple
+from sqlalchemy import update
 from sqlmodel import Session, select
 from app.models.models import Driver, RideRequest, User
 
 # NEW: import the Maps helper
-from app.services.google_maps import get_eta_and_distance_minutes
+from app.services.google_maps import get_eta_and_distance_minutes, get_eta_and_distance_minutes_many
+from app.services import commitments, decision_log, driver_index, driver_state, eta_model, ride_index, zone_matrix
+from app.services.scoring import (
+    CandidateBatch, DISTANCE_WEIGHT, ETA_WEIGHT, PRIORITY_WEIGHT,
+    argsort, eta_from_distance, haversine_km, score_candidates, score_many,
+)
 
-def _haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
-    R = 6371.0
-    dlat = radians(lat2 - lat1)
-    dlng = radians(lng2 - lng1)
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlng/2)**2
-    c = 2 * asin(sqrt(a))
-    return R * c
+# Candidate pruning: road ETAs are only requested for the SCHEDULER_TOP_K closest
+# drivers (straight-line), plus any driver whose lower-bound score could still win.
+# The bound assumes no road is shorter than the straight line and no driver is
+# faster than SCHEDULER_MAX_SPEED_KMH. Set SCHEDULER_TOP_K=0 to disable pruning.
+SCHEDULER_TOP_K = int(os.getenv("SCHEDULER_TOP_K", "5"))
+SCHEDULER_MAX_SPEED_KMH = float(os.getenv("SCHEDULER_MAX_SPEED_KMH", "80"))
+# When false, driver legs are first looked up in the precomputed zone matrix
+# (zone-level accuracy, no network call) and only misses go to the model/Maps.
+SCHEDULER_EXACT_ETA = os.getenv("SCHEDULER_EXACT_ETA", "true").lower() in ("1", "true", "yes")
+
+# Fallback speed when Maps has no answer
+FALLBACK_SPEED_KMH = 20.0
 
 def _score(distance_km: float, eta_min: float, user_priority: int) -> float:
-    return (distance_km * 1.0) + (eta_min * 0.3) - (user_priority * 0.5)
+    return (distance_km * DISTANCE_WEIGHT) + (eta_min * ETA_WEIGHT) - (user_priority * PRIORITY_WEIGHT)
 
-def choose_best_driver(session: Session, ride: RideRequest) -> Optional[Driver]:
-    if ride.pickup_lat is None or ride.pickup_lng is None:
-        return None
+def load_candidates(session: Session, ride: RideRequest) -> List[Driver]:
+    """
+    Available drivers worth scoring for this ride's pickup, minus those
+    committed to a scheduled ride before this one would be over.
+    """
+    index = commitments.commitments
+    free: Optional[Callable[[int], bool]] = None
+    if len(index):
+        start, end = commitments.busy_window(ride)
 
-    drivers = session.exec(
-        select(Driver).where(Driver.availability_status == "available")
-    ).all()
-    if not drivers:
-        return None
+        def free(driver_id: int) -> bool:
+            return index.is_free(driver_id, start, end, ignore_ride=ride.ride_id)
+
+    drivers = _available_candidates(session, ride, free)
+    if free is None or not drivers:
+        return drivers
+    return [d for d in drivers if free(d.driver_id)]
+
+def _available_candidates(session: Session, ride: RideRequest,
+                          accept: Optional[Callable[[int], bool]] = None) -> List[Driver]:
+    """
+    Only drivers whose vehicle meets ride.required_vehicle_type. Served from
+    the in-memory driver state when it is loaded (records quack like Driver rows).
+    The spatial search keeps widening until it finds drivers `accept` allows.
+    """
+    states = driver_state.driver_states
+    required = driver_index.vehicle_key(ride.required_vehicle_type)
+    if driver_index.available_drivers.loaded:
+        if states.loaded:
+            # skip drivers whose status moved on but whose index entry has not yet
+            accept = _both(accept, lambda driver_id: _is_available(states.get(driver_id)))
+        # Only look at drivers in the cells around the pickup, in the ride's vehicle pool
+        candidate_ids = driver_index.available_drivers.nearby(
+            ride.pickup_lat, ride.pickup_lng, required, accept=accept
+        )
+        if not candidate_ids:
+            return []
+        if states.loaded:
+            return states.get_many(candidate_ids, status="available")
+        return session.exec(
+            select(Driver).where(
+                Driver.driver_id.in_(candidate_ids),
+                Driver.availability_status == "available",
+            )
+        ).all()
+    if states.loaded:
+        drivers = states.with_status("available")
+    else:
+        drivers = session.exec(
+            select(Driver).where(Driver.availability_status == "available")
+        ).all()
+    if required is None:
+        return drivers
+    return [d for d in drivers if vehicle_compatible(d, ride)]
+
+def _both(first: Optional[Callable[[int], bool]], second: Callable[[int], bool]) -> Callable[[int], bool]:
+    return second if first is None else (lambda item_id: first(item_id) and second(item_id))
+
+def _is_available(record) -> bool:
+    return record is not None and record.availability_status == "available"
+
+def vehicle_compatible(driver: Driver, ride: RideRequest) -> bool:
+    required = driver_index.vehicle_key(ride.required_vehicle_type)
+    return required is None or driver_index.vehicle_key(driver.vehicle_type) == required
 
+def user_priority_for(session: Session, ride: RideRequest) -> int:
     user = session.get(User, ride.user_id)
-    user_priority = user.priority_level if user else 0
+    return user.priority_level if user else 0
 
-    best_driver, best_score = None, float("inf")
+def choose_best_driver(session: Session, ride: RideRequest, exact: bool = SCHEDULER_EXACT_ETA) -> Optional[Driver]:
+    ranked = rank_drivers(session, ride, exact)
+    return session.get(Driver, ranked[0][1].driver_id) if ranked else None
 
-    for d in drivers:
-        # Try Google Distance Matrix (ETA from driver -> pickup)
-        maps_result = get_eta_and_distance_minutes(
-            d.current_lat, d.current_lng, ride.pickup_lat, ride.pickup_lng
+def rank_drivers(session: Session, ride: RideRequest, exact: bool = SCHEDULER_EXACT_ETA) -> List[Tuple[float, Driver]]:
+    """
+    (score, driver) for every candidate that got a road ETA, best first.
+    Later entries are the fallbacks if the best driver is claimed by someone else.
+    """
+    if ride.pickup_lat is None or ride.pickup_lng is None:
+        return []
+
+    with decision_log.timed("db"):
+        drivers = load_candidates(session, ride)
+        decision_log.count(candidates=len(drivers))
+        if not drivers:
+            return []
+        user_priority = user_priority_for(session, ride)
+
+    # Straight-line distance, fallback ETA and score for every candidate in one pass
+    with decision_log.timed("scoring"):
+        batch = CandidateBatch.from_drivers(drivers)
+        dist, _, fallback = score_candidates(
+            ride.pickup_lat, ride.pickup_lng, batch, user_priority, FALLBACK_SPEED_KMH
         )
+        order = argsort(dist)
+    top = order if SCHEDULER_TOP_K <= 0 else order[:SCHEDULER_TOP_K]
+    scored = list(zip(_road_scores(top, drivers, fallback, ride, user_priority, exact), top))
+
+    # Anyone past the top K whose lower bound still beats the best gets a road ETA too.
+    # The bound grows with distance, so those drivers are a prefix of the remainder.
+    rest = order[len(top):]
+    if rest and scored:
+        best_score = min(score for score, _ in scored)
+        lower = score_many(dist, eta_from_distance(dist, SCHEDULER_MAX_SPEED_KMH), user_priority)
+        n = 0
+        while n < len(rest) and lower[rest[n]] < best_score:
+            n += 1
+        if n:
+            scored.extend(zip(_road_scores(rest[:n], drivers, fallback, ride, user_priority, exact), rest[:n]))
+
+    scored.sort(key=lambda pair: pair[0])
+    trace = decision_log.current()
+    if trace is not None:
+        trace.set_scores([score for score, _ in scored])
+    return [(score, drivers[i]) for score, i in scored]
 
+def nearest_candidate_scores(
+    ride: RideRequest, drivers: List[Driver], user_priority: int, limit: int, exact: bool = SCHEDULER_EXACT_ETA
+) -> List[Tuple[Driver, float]]:
+    """
+    (driver, score) for the `limit` straight-line-closest drivers, scored with
+    road ETAs where Maps answers. Used by batch matching to fill its cost matrix.
+    """
+    if not drivers or ride.pickup_lat is None or ride.pickup_lng is None:
+        return []
+    with decision_log.timed("scoring"):
+        batch = CandidateBatch.from_drivers(drivers)
+        dist, _, fallback = score_candidates(
+            ride.pickup_lat, ride.pickup_lng, batch, user_priority, FALLBACK_SPEED_KMH
+        )
+        indices = argsort(dist)[:limit] if limit > 0 else argsort(dist)
+    scores = _road_scores(indices, drivers, fallback, ride, user_priority, exact)
+    return [(drivers[i], score) for i, score in zip(indices, scores)]
+
+def _road_scores(
+    indices: List[int], drivers: List[Driver], fallback_scores, ride: RideRequest, user_priority: int,
+    exact: bool = SCHEDULER_EXACT_ETA,
+) -> List[float]:
+    scores: List[Optional[float]] = [None] * len(indices)
+    estimates: List[Optional[eta_model.EtaEstimate]] = [None] * len(indices)
+    matrix = None if exact else zone_matrix.current_matrix()
+    model = eta_model.current_model()
+    hour = datetime.utcnow().hour
+    ask: List[int] = []
+    with decision_log.timed("scoring"):
+        for pos, i in enumerate(indices):
+            d = drivers[i]
+            cached = matrix.lookup(d.current_lat, d.current_lng, ride.pickup_lat, ride.pickup_lng) if matrix else None
+            if cached is not None:
+                scores[pos] = _estimate_score(cached[0], cached[1], d, ride, user_priority)
+                continue
+            # Legs the local ETA model is confident about skip Maps entirely
+            est = estimates[pos] = model.predict(d.current_lat, d.current_lng, ride.pickup_lat, ride.pickup_lng, hour)
+            if eta_model.trusted(est):
+                scores[pos] = _estimate_score(est.duration_min, est.distance_km, d, ride, user_priority)
+            else:
+                ask.append(pos)
+    if not ask:
+        return scores
+
+    # One batched Distance Matrix call (ETA from every remaining driver -> pickup)
+    with decision_log.timed("maps"):
+        maps_results = get_eta_and_distance_minutes_many(
+            [(drivers[indices[pos]].current_lat, drivers[indices[pos]].current_lng) for pos in ask],
+            ride.pickup_lat, ride.pickup_lng,
+        )
+    for pos, maps_result in zip(ask, maps_results):
         if maps_result is not None:
             eta_min, dist_km = maps_result
+            scores[pos] = _score(dist_km, eta_min, user_priority)
+        elif estimates[pos] is not None:
+            # Maps failed: a low-confidence learned ETA still beats a flat speed
+            est = estimates[pos]
+            scores[pos] = _estimate_score(est.duration_min, est.distance_km, drivers[indices[pos]], ride, user_priority)
         else:
-            # Fallback: Haversine + 20 km/h heuristic
-            dist_km = _haversine_km(ride.pickup_lat, ride.pickup_lng, d.current_lat, d.current_lng)
-            eta_min = (dist_km / 20.0) * 60.0
+            # Fallback: Haversine + 20 km/h heuristic (already scored in the batch pass)
+            scores[pos] = float(fallback_scores[indices[pos]])
+    return scores
 
-        score = _score(dist_km, eta_min, user_priority)
-        if score < best_score:
-            best_driver, best_score = d, score
-
-    return best_driver
+def _estimate_score(duration_min: float, distance_km: float, driver: Driver, ride: RideRequest, user_priority: int) -> float:
+    # Keep learned/zone ETAs above the pruning lower bound so the top-K cut stays safe
+    straight = haversine_km(driver.current_lat, driver.current_lng, ride.pickup_lat, ride.pickup_lng)
+    eta_min = max(duration_min, straight / SCHEDULER_MAX_SPEED_KMH * 60.0)
+    return _score(max(distance_km, straight), eta_min, user_priority)
 
 def assign_driver_to_ride(session: Session, ride: RideRequest) -> Optional[RideRequest]:
-    driver = choose_best_driver(session, ride)
-    if not driver:
+    reserved = ride.driver_id is not None and ride.status == "requested"
+    with decision_log.tracing(ride.ride_id, "reserved" if reserved else "single") as trace:
+        assigned = _assign_driver_to_ride(session, ride, reserved)
+        trace.driver_id = assigned.driver_id if assigned is not None else None
+    return assigned
+
+def _assign_driver_to_ride(session: Session, ride: RideRequest, booked: bool) -> Optional[RideRequest]:
+    if booked:
+        # booked with a driver: take that one, or release the booking and match normally
+        assigned = _assign_reserved(session, ride)
+        if assigned is not None or not _ride_still_open(session, ride):
+            return assigned
+
+    ranked = rank_drivers(session, ride)
+    if not ranked:
         return None
 
-    ride.driver_id = driver.driver_id
-    ride.status = "assigned"
-    ride.assigned_at = datetime.utcnow()
-    driver.availability_status = "on_ride"
+    # Maps call for the trip leg happens before any row is claimed
+    estimates = trip_estimates(ride)
 
-    # Optional: also set estimates from pickup -> dropoff using Maps
-    if ride.dropoff_lat is not None and ride.dropoff_lng is not None:
-        maps_leg = get_eta_and_distance_minutes(
-            ride.pickup_lat, ride.pickup_lng, ride.dropoff_lat, ride.dropoff_lng
-        )
-        if maps_leg is not None:
-            ride.estimated_duration, ride.estimated_distance = maps_leg[0], maps_leg[1]
+    # Claim the best driver still free; on a lost race fall back to the next one
+    for driver_id in [d.driver_id for _, d in ranked]:
+        if claim_assignment(session, ride, driver_id, estimates):
+            session.commit()
+            session.refresh(ride)
+            track_assignment(ride)
+            return ride
+        session.rollback()
+        # our view of that driver was stale; bring the index back in line with the DB
+        _resync_driver(session, driver_id)
+        if not _ride_still_open(session, ride):
+            return None  # someone else assigned this ride meanwhile
+    return None
 
-    session.add(ride)
-    session.add(driver)
+def _assign_reserved(session: Session, ride: RideRequest) -> Optional[RideRequest]:
+    driver_id = ride.driver_id
+    if claim_assignment(session, ride, driver_id, trip_estimates(ride)):
+        session.commit()
+        session.refresh(ride)
+        track_assignment(ride)
+        return ride
+    session.rollback()
+    _resync_driver(session, driver_id)
+    # reserved driver is busy or gone; the ride goes to whoever is free
+    session.exec(
+        update(RideRequest)
+        .where(RideRequest.ride_id == ride.ride_id, RideRequest.status == "requested")
+        .values(driver_id=None)
+    )
     session.commit()
+    commitments.commitments.remove(ride.ride_id)
     session.refresh(ride)
-    return ride
+    return None
+
+def track_assignment(ride: RideRequest) -> None:
+    """
+    In-memory side of a committed claim: the driver is on a ride, the ride is
+    tracked, and a scheduled ride holds its driver's window (the same window
+    load_commitments rebuilds at startup).
+    """
+    driver_state.mark_on_ride(ride.driver_id)
+    ride_index.track(ride)
+    window = commitments.commitment_window(ride)
+    if window is not None:
+        commitments.commitments.add(ride.driver_id, window[0], window[1], ride.ride_id)
+
+def claim_assignment(
+    session: Session,
+    ride: RideRequest,
+    driver_id: int,
+    estimates: Optional[Tuple[float, float]] = None,
+    assigned_at: Optional[datetime] = None,
+) -> bool:
+    """
+    Atomically take `driver_id` for `ride` inside the current transaction.
+
+    Both rows are changed with conditional UPDATEs (driver still "available",
+    ride still unassigned or reserved for this driver), so two concurrent
+    requests or uvicorn workers can never end up with the same driver or
+    double-assign a ride. Returns False if either condition no longer holds;
+    the caller commits on success.
+    """
+    with decision_log.timed("db"):
+        return _claim(session, ride, driver_id, estimates, assigned_at)
+
+def _claim(
+    session: Session,
+    ride: RideRequest,
+    driver_id: int,
+    estimates: Optional[Tuple[float, float]],
+    assigned_at: Optional[datetime],
+) -> bool:
+    taken = session.exec(
+        update(Driver)
+        .where(Driver.driver_id == driver_id, Driver.availability_status == "available")
+        .values(availability_status="on_ride")
+    )
+    if taken.rowcount != 1:
+        return False
+
+    values = {"driver_id": driver_id, "status": "assigned", "assigned_at": assigned_at or datetime.utcnow()}
+    if estimates is not None:
+        values["estimated_duration"], values["estimated_distance"] = estimates
+    claimed = session.exec(
+        update(RideRequest)
+        .where(
+            RideRequest.ride_id == ride.ride_id,
+            RideRequest.status == "requested",
+            RideRequest.driver_id.is_(None) | (RideRequest.driver_id == driver_id),
+        )
+        .values(**values)
+    )
+    if claimed.rowcount != 1:
+        # ride went elsewhere; hand the driver back within the same transaction
+        session.exec(
+            update(Driver).where(Driver.driver_id == driver_id).values(availability_status="available")
+        )
+        return False
+    return True
+
+def _resync_driver(session: Session, driver_id: int) -> None:
+    driver = session.get(Driver, driver_id)
+    if driver is None:
+        driver_state.forget_driver(driver_id)
+    else:
+        driver_state.sync_driver(driver)
+
+def _ride_still_open(session: Session, ride: RideRequest) -> bool:
+    session.refresh(ride)
+    return ride.status == "requested" and ride.driver_id is None
+
+def trip_estimates(ride: RideRequest) -> Optional[Tuple[float, float]]:
+    """Optional: (duration_min, distance_km) from pickup -> dropoff using Maps."""
+    if ride.dropoff_lat is None or ride.dropoff_lng is None:
+        return None
+    with decision_log.timed("maps"):
+        return get_eta_and_distance_minutes(
+            ride.pickup_lat, ride.pickup_lng, ride.dropoff_lat, ride.dropoff_lng
+        )
@@ -0,0 +1,100 @@
+"""
+Single-flight request coalescing for the Maps service.
+
+When identical lookups arrive at the same time (several riders booking from the
+same entrance), the first caller for a key makes the network call and the
+others wait for its result instead of sending duplicates. Nothing is kept once
+the call finishes; remembering answers is the caches' job
+(app.services.geocode_cache, app.services.eta_cache).
+
+`flights` serves the sync path (request threads, dispatcher executor);
+`async_flights` the async routes. In the async group the call runs as its own
+task, so a caller that disconnects does not cancel it for the others.
+"""
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Thread-based coalescing: `do(key, fn)` runs fn once per key at a time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.shared, "in_flight": len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """Coroutine coalescing: `await do(key, fn)` awaits one fn() task per key and event loop."""
+
+    def __init__(self):
+        self._tasks: Dict[Tuple[int, Hashable], "asyncio.Task"] = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        loop = asyncio.get_running_loop()
+        slot = (id(loop), key)
+        task = self._tasks.get(slot)
+        if task is None:
+            task = loop.create_task(fn())
+            self._tasks[slot] = task
+            task.add_done_callback(lambda _task: self._tasks.pop(slot, None))
+            self.calls += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "coalesced": self.shared, "in_flight": len(self._tasks)}
+
+
+# Process-wide
+flights = SingleFlight()
+async_flights = AsyncSingleFlight()
+
+
+def stats() -> dict:
+    return {"sync": flights.stats(), "async": async_flights.stats()}
@@ -0,0 +1,112 @@
+"""
+Hierarchical timing wheel for future events (scheduled rides).
+
+Each level is a ring of slots; level 0 slots are one tick wide, level 1 slots
+are one full turn of level 0 wide, and so on. An item sits in exactly one slot
+and moves down a level when its slot comes around ("cascading"), so a tick
+costs O(1) plus the items that fire, and memory is O(items + slots) no matter
+how far ahead bookings are. Items beyond the top level wait in a small heap.
+"""
+import heapq
+import threading
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+# 60 x 1 s, 60 x 1 min, 24 x 1 h, 64 x 1 day  -> ~64 days before the overflow heap
+DEFAULT_WHEEL_SIZES = (60, 60, 24, 64)
+
+
+class TimingWheel:
+    def __init__(self, start_ts: float, tick_sec: float = 1.0, wheel_sizes: Sequence[int] = DEFAULT_WHEEL_SIZES):
+        self.tick_sec = tick_sec
+        self.sizes = list(wheel_sizes)
+        # ticks covered by one slot of each level
+        self.res = [1]
+        for size in self.sizes[:-1]:
+            self.res.append(self.res[-1] * size)
+        self.horizon = self.res[-1] * self.sizes[-1]
+
+        self._wheels: List[List[List[Tuple[int, Hashable]]]] = [[[] for _ in range(n)] for n in self.sizes]
+        self._overflow: List[Tuple[int, int, Hashable]] = []  # (tick, seq, key)
+        self._seq = 0
+        self._due: Dict[Hashable, int] = {}  # live key -> tick; anything else in a slot is stale
+        self._ready: List[Hashable] = []
+        self._current = int(start_ts // tick_sec)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._due
+
+    def schedule(self, key: Hashable, due_ts: float) -> None:
+        """Fire `key` at due_ts (replaces any earlier schedule for the same key)."""
+        tick = int(due_ts // self.tick_sec)
+        with self._lock:
+            self._due[key] = tick
+            self._place(tick, key)
+
+    def cancel(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._due.pop(key, None) is not None
+
+    def due_at(self, key: Hashable) -> Optional[float]:
+        tick = self._due.get(key)
+        return None if tick is None else tick * self.tick_sec
+
+    def advance(self, now_ts: float) -> List[Hashable]:
+        """Move the wheel up to now_ts and return the keys that became due."""
+        target = int(now_ts // self.tick_sec)
+        with self._lock:
+            fired: List[Hashable] = []
+            while self._current < target:
+                self._current += 1
+                self._cascade()
+                slot = self._wheels[0][self._current % self.sizes[0]]
+                if slot:
+                    items, slot[:] = list(slot), []
+                    fired.extend(self._take(items))
+            # late schedules and items that cascaded onto the current tick
+            fired.extend(self._ready)
+            self._ready = []
+            return fired
+
+    # ---------- internals (caller holds the lock) ----------
+    def _place(self, tick: int, key: Hashable) -> None:
+        if tick <= self._current:
+            if self._due.get(key) == tick:
+                self._ready.append(key)
+                del self._due[key]
+            return
+        for level, size in enumerate(self.sizes):
+            span = self.res[level] * size
+            # same turn of this level as "now" -> it belongs in this level
+            if tick // span == self._current // span:
+                self._wheels[level][(tick // self.res[level]) % size].append((tick, key))
+                return
+        self._seq += 1
+        heapq.heappush(self._overflow, (tick, self._seq, key))
+
+    def _cascade(self) -> None:
+        # top level first so items can fall through several levels in one tick
+        if self._current % self.horizon == 0:
+            while self._overflow and self._overflow[0][0] // self.horizon == self._current // self.horizon:
+                tick, _, key = heapq.heappop(self._overflow)
+                if self._due.get(key) == tick:
+                    self._place(tick, key)
+        for level in range(len(self.sizes) - 1, 0, -1):
+            if self._current % self.res[level] == 0:
+                slot = self._wheels[level][(self._current // self.res[level]) % self.sizes[level]]
+                if slot:
+                    items, slot[:] = list(slot), []
+                    for tick, key in items:
+                        if self._due.get(key) == tick:
+                            self._place(tick, key)
+
+    def _take(self, items: List[Tuple[int, Hashable]]) -> List[Hashable]:
+        out = []
+        for tick, key in items:
+            if self._due.get(key) == tick:
+                del self._due[key]
+                out.append(key)
+        return out
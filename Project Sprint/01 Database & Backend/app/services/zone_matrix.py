@@ -0,0 +1,222 @@
+"""
+Precomputed zone-to-zone travel times, memory-mapped from a file.
+
+The service area is split into zones (app.services.zones); for every ordered
+zone pair the file holds (duration_min, distance_km) as two float32 values, NaN
+where nothing is known. A lookup is one index computation into the mapped
+array, so callers that don't need exact road ETAs skip Maps (and the model)
+entirely. Accuracy is roughly one zone width.
+
+A background job rebuilds the file from the learned ETA model (app.services.
+eta_model) every ZONE_MATRIX_REFRESH_SEC: it writes a per-process temp file and
+atomically replaces the old one, so readers never see a half-written matrix.
+Workers take turns: a rebuild needs the "<path>.lock" file lock and is skipped
+when another worker built the file within the interval. Every worker remaps the
+file when its modification time changes (checked at most every
+ZONE_MATRIX_RELOAD_CHECK_SEC), whichever process wrote it.
+"""
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+from datetime import datetime
+from typing import Optional, Tuple
+
+from app.services import eta_model
+from app.services.zones import ZoneGrid, zones
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:  # pragma: no cover - Windows: rebuilds are not serialized
+    HAS_FCNTL = False
+
+ZONE_MATRIX_PATH = os.getenv("ZONE_MATRIX_PATH", "zone_matrix.bin")
+ZONE_MATRIX_REFRESH_SEC = float(os.getenv("ZONE_MATRIX_REFRESH_SEC", "900"))
+ZONE_MATRIX_RELOAD_CHECK_SEC = float(os.getenv("ZONE_MATRIX_RELOAD_CHECK_SEC", "5"))
+
+# magic, rows, cols, min_lat, min_lng, max_lat, max_lng, cell_km, built_at (epoch s), hour
+_HEADER = struct.Struct("<4sII6dI4x")
+_MAGIC = b"ZMX1"
+# mean distance between two random points of a square, as a share of its side
+_SAME_ZONE_FACTOR = 0.52
+
+log = logging.getLogger(__name__)
+
+
+class ZoneMatrix:
+    """Read-only view of a matrix file. `ready` is False if the file is missing or was built for other zones."""
+
+    def __init__(self, path: str = ZONE_MATRIX_PATH, grid: ZoneGrid = zones):
+        self.grid = grid
+        self.n = len(grid)
+        self.built_at: Optional[float] = None
+        self.hour: Optional[int] = None
+        self.mtime_ns: Optional[int] = None  # of the file this maps, to notice replacements
+        self._values = None
+        try:
+            with open(path, "rb") as f:
+                self.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return
+        if len(self._mm) != _HEADER.size + self.n * self.n * 8:
+            return
+        magic, rows, cols, *bbox, cell_km, built_at, hour = _HEADER.unpack_from(self._mm)
+        if magic != _MAGIC or (rows, cols, cell_km) != (grid.rows, grid.cols, grid.cell_km) or bbox != [
+            grid.min_lat, grid.min_lng, grid.max_lat, grid.max_lng
+        ]:
+            return
+        self.built_at, self.hour = built_at, hour
+        self._values = memoryview(self._mm)[_HEADER.size:].cast("f")
+
+    @property
+    def ready(self) -> bool:
+        return self._values is not None
+
+    def lookup(self, olat: float, olng: float, dlat: float, dlng: float) -> Optional[Tuple[float, float]]:
+        """(duration_min, distance_km) between the zones of two points, or None."""
+        if self._values is None:
+            return None
+        oz, dz = self.grid.zone_of(olat, olng), self.grid.zone_of(dlat, dlng)
+        if oz is None or dz is None:
+            return None
+        i = (oz * self.n + dz) * 2
+        duration, distance = self._values[i], self._values[i + 1]
+        if duration != duration:  # NaN: pair never estimated
+            return None
+        return duration, distance
+
+    def summary(self) -> dict:
+        return {
+            "ready": self.ready,
+            "zones": self.n,
+            "built_at": datetime.utcfromtimestamp(self.built_at).isoformat() if self.built_at else None,
+            "hour": self.hour,
+        }
+
+
+def build_matrix(path: str = ZONE_MATRIX_PATH, grid: ZoneGrid = zones, hour: Optional[int] = None) -> int:
+    """
+    Fill every zone pair from the current ETA model (zone centers, one hour of
+    day) and atomically replace the file. Returns the number of known pairs.
+    """
+    hour = datetime.utcnow().hour if hour is None else hour
+    model = eta_model.current_model()
+    n = len(grid)
+    centers = [grid.center(z) for z in range(n)]
+    nan = float("nan")
+    row = struct.Struct(f"<{n * 2}f")
+    known = 0
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, grid.rows, grid.cols, grid.min_lat, grid.min_lng, grid.max_lat,
+                             grid.max_lng, grid.cell_km, time.time(), hour))
+        for oz, (olat, olng) in enumerate(centers):
+            values = [nan] * (n * 2)
+            for dz, (dlat, dlng) in enumerate(centers):
+                est = model.predict(olat, olng, dlat, dlng, hour)
+                if est is None:
+                    continue
+                duration, distance = est.duration_min, est.distance_km
+                if oz == dz:
+                    # centers coincide; scale pace/detour to a typical in-zone trip
+                    est = model.predict(olat, olng, olat + grid.lat_step * _SAME_ZONE_FACTOR, olng, hour)
+                    duration, distance = est.duration_min, est.distance_km
+                values[dz * 2], values[dz * 2 + 1] = duration, distance
+                known += 1
+            f.write(row.pack(*values))
+    os.replace(tmp, path)
+    return known
+
+
+# Reopened whenever the file changes; readers just call current_matrix()
+_matrix = ZoneMatrix()
+_checked_at = 0.0
+
+
+def current_matrix() -> ZoneMatrix:
+    global _checked_at
+    now = time.monotonic()
+    if now - _checked_at >= ZONE_MATRIX_RELOAD_CHECK_SEC:
+        _checked_at = now
+        reload_if_changed()
+    return _matrix
+
+
+def reload(path: str = ZONE_MATRIX_PATH) -> ZoneMatrix:
+    """Map the file again; the old mapping stays valid for readers still holding it, then is released by GC."""
+    global _matrix
+    _matrix = ZoneMatrix(path)
+    return _matrix
+
+
+def reload_if_changed(path: str = ZONE_MATRIX_PATH) -> ZoneMatrix:
+    """Pick up a matrix file replaced by any process since it was mapped."""
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    if mtime_ns != _matrix.mtime_ns:
+        return reload(path)
+    return _matrix
+
+
+def refresh(path: str = ZONE_MATRIX_PATH, min_age_sec: float = 0.0) -> bool:
+    """
+    Rebuild the file unless another worker is building it or built it less than
+    min_age_sec ago, then map the newest file. Returns whether this call built it.
+    """
+    with open(f"{path}.lock", "a") as lock:
+        if HAS_FCNTL:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False  # the other worker's file is picked up by reload_if_changed
+        try:
+            built = time.time() - os.stat(path).st_mtime >= min_age_sec
+        except OSError:
+            built = True
+        if built:
+            build_matrix(path)
+    reload_if_changed(path)
+    return built
+
+
+# ---------- background refresh ----------
+_task: Optional[asyncio.Task] = None
+
+
+async def _refresh_loop(interval_sec: float) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        if eta_model.current_model().trained_at is None:
+            await asyncio.sleep(5)  # first build waits for the first model training
+            continue
+        try:
+            # a little under the interval, so a worker's own schedule jitter doesn't skip its turn
+            if await loop.run_in_executor(None, refresh, ZONE_MATRIX_PATH, interval_sec * 0.9):
+                log.info("zone matrix rebuilt: %s", _matrix.summary())
+        except Exception:
+            log.exception("zone matrix refresh failed")
+        await asyncio.sleep(interval_sec)
+
+
+def start_refreshing(interval_sec: float = ZONE_MATRIX_REFRESH_SEC) -> None:
+    """Rebuild now (once the ETA model is trained) and every interval_sec, taking turns with other workers."""
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_refresh_loop(interval_sec))
+
+
+async def stop_refreshing() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
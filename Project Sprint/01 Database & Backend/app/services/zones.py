@@ -0,0 +1,50 @@
+"""
+Service-area zones: a fixed grid of square cells over a bounding box.
+
+Zones are numbered row-major from the south-west corner, so a zone id is a
+small int that can index arrays directly. Points outside the box have no zone.
+"""
+import os
+from math import cos, floor, radians
+from typing import Optional, Tuple
+
+# min_lat,min_lng,max_lat,max_lng (default: Metro Manila)
+SERVICE_AREA_BBOX = os.getenv("SERVICE_AREA_BBOX", "14.35,120.90,14.80,121.15")
+ZONE_KM = float(os.getenv("ZONE_KM", "2.0"))
+
+_KM_PER_DEG = 111.32
+
+
+class ZoneGrid:
+    def __init__(self, bbox: Tuple[float, float, float, float], cell_km: float = ZONE_KM):
+        self.min_lat, self.min_lng, self.max_lat, self.max_lng = bbox
+        self.cell_km = cell_km
+        mid_lat = (self.min_lat + self.max_lat) / 2
+        # square-ish cells: longitude degrees shrink with latitude
+        self.lat_step = cell_km / _KM_PER_DEG
+        self.lng_step = cell_km / (_KM_PER_DEG * cos(radians(mid_lat)))
+        self.rows = max(1, int(-(-(self.max_lat - self.min_lat) // self.lat_step)))
+        self.cols = max(1, int(-(-(self.max_lng - self.min_lng) // self.lng_step)))
+
+    def __len__(self) -> int:
+        return self.rows * self.cols
+
+    def zone_of(self, lat: float, lng: float) -> Optional[int]:
+        if not (self.min_lat <= lat <= self.max_lat and self.min_lng <= lng <= self.max_lng):
+            return None
+        row = min(floor((lat - self.min_lat) / self.lat_step), self.rows - 1)
+        col = min(floor((lng - self.min_lng) / self.lng_step), self.cols - 1)
+        return row * self.cols + col
+
+    def center(self, zone: int) -> Tuple[float, float]:
+        row, col = divmod(zone, self.cols)
+        return (self.min_lat + (row + 0.5) * self.lat_step, self.min_lng + (col + 0.5) * self.lng_step)
+
+
+def parse_bbox(value: str) -> Tuple[float, float, float, float]:
+    min_lat, min_lng, max_lat, max_lng = (float(v) for v in value.split(","))
+    return min_lat, min_lng, max_lat, max_lng
+
+
+# Process-wide zoning of the service area
+zones = ZoneGrid(parse_bbox(SERVICE_AREA_BBOX))
@@ -0,0 +1,87 @@
+"""
+Offline routing benchmark: bidirectional Dijkstra vs. contraction hierarchy.
+
+Builds a synthetic street grid (random speeds, some one-way streets), writes it
+in the ROUTING_GRAPH_PATH format, and times random point-to-point queries.
+
+Run from the backend folder:
+    python -m benchmarks.bench_routing
+    python -m benchmarks.bench_routing --size 120 --queries 2000
+    python -m benchmarks.bench_routing --write road_graph.txt   # keep the graph for ROUTING_BACKEND=local
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from math import cos, radians
+
+from app.services import routing
+
+ORIGIN = (14.5500, 120.9800)  # Manila
+BLOCK_M = 150.0
+
+
+def write_grid_graph(path: str, size: int, seed: int = 106) -> None:
+    """size x size intersections, 150 m blocks, 20-60 km/h streets, ~1 in 5 one-way."""
+    rnd = random.Random(seed)
+    lat_step = BLOCK_M / 111_320.0
+    lng_step = BLOCK_M / (111_320.0 * cos(radians(ORIGIN[0])))
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("# synthetic street grid\n")
+        for r in range(size):
+            for c in range(size):
+                f.write(f"n {r}_{c} {ORIGIN[0] + r * lat_step:.7f} {ORIGIN[1] + c * lng_step:.7f}\n")
+        for r in range(size):
+            for c in range(size):
+                for nr, nc in ((r + 1, c), (r, c + 1)):
+                    if nr < size and nc < size:
+                        speed_ms = rnd.uniform(20, 60) / 3.6
+                        two_way = rnd.random() > 0.2
+                        a, b = (f"{r}_{c}", f"{nr}_{nc}") if rnd.random() < 0.5 else (f"{nr}_{nc}", f"{r}_{c}")
+                        f.write(f"e {a} {b} {BLOCK_M:.1f} {BLOCK_M / speed_ms:.2f}{' 1' if two_way else ''}\n")
+
+
+def _percentile_ms(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=60, help="intersections per side")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--write", help="also keep the generated graph at this path")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.write or os.path.join(tmp, "grid.txt")
+        write_grid_graph(path, args.size)
+        graph = routing.RoadGraph.load(path)
+        t0 = time.perf_counter()
+        ch = routing.ContractionHierarchy.build(graph.out)
+        build_sec = time.perf_counter() - t0
+        if args.write:
+            routing.load_graph(path)  # writes the .ch cache next to the graph
+
+    rnd = random.Random(7)
+    pairs = [(rnd.randrange(len(graph)), rnd.randrange(len(graph))) for _ in range(args.queries)]
+    timings = {"dijkstra": [], "ch": []}
+    for s, t in pairs:
+        t0 = time.perf_counter()
+        plain = routing.bidirectional_dijkstra(graph.out, graph.inc, s, t)
+        timings["dijkstra"].append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        fast = ch.query(s, t)
+        timings["ch"].append(time.perf_counter() - t0)
+        assert (plain is None) == (fast is None) and (plain is None or abs(plain[0] - fast[0]) < 1e-6)
+
+    shortcuts = sum(len(e) for e in ch.up_out) - sum(len(e) for e in graph.out)
+    print(f"graph: {len(graph)} nodes, CH built in {build_sec:.2f} s ({shortcuts:+d} edges vs. original)")
+    print(f"{'search':>10} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for name, samples in timings.items():
+        print(f"{name:>10} {_percentile_ms(samples, 50):>10.3f} {_percentile_ms(samples, 99):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
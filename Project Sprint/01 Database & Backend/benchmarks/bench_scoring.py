@@ -0,0 +1,83 @@
+"""
+Micro-benchmark: scheduler scalar scoring loop vs. the batch scoring engine.
+
+Both sides start from the driver rows the scheduler has in hand, so the batch
+timing includes building the CandidateBatch (CandidateBatch.from_drivers), as
+it does in production.
+
+Run from the backend folder:
+    python -m benchmarks.bench_scoring
+    python -m benchmarks.bench_scoring --sizes 100 10000 100000 --repeat 5
+"""
+import argparse
+import random
+import time
+from typing import List, NamedTuple
+
+from app.services import scoring
+from app.services.scheduler import _score
+
+PICKUP = (14.5995, 120.9842)  # Manila
+
+
+class _Driver(NamedTuple):
+    """The Driver fields scoring reads."""
+    driver_id: int
+    current_lat: float
+    current_lng: float
+
+
+def _random_fleet(n: int, seed: int = 106) -> List[_Driver]:
+    rnd = random.Random(seed)
+    return [
+        _Driver(i, PICKUP[0] + rnd.uniform(-0.2, 0.2), PICKUP[1] + rnd.uniform(-0.2, 0.2))
+        for i in range(n)
+    ]
+
+
+def scalar_loop(drivers, user_priority: int = 1):
+    """The original per-driver loop from choose_best_driver (fallback path)."""
+    best_i, best_score = -1, float("inf")
+    for i, d in enumerate(drivers):
+        dist_km = scoring.haversine_km(PICKUP[0], PICKUP[1], d.current_lat, d.current_lng)
+        eta_min = (dist_km / 20.0) * 60.0
+        s = _score(dist_km, eta_min, user_priority)
+        if s < best_score:
+            best_i, best_score = i, s
+    return best_i
+
+
+def batch_engine(drivers, user_priority: int = 1):
+    batch = scoring.CandidateBatch.from_drivers(drivers)
+    _, _, scores = scoring.score_candidates(PICKUP[0], PICKUP[1], batch, user_priority)
+    return scoring.argmin(scores)
+
+
+def _best_time(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"NumPy available: {scoring.HAS_NUMPY}")
+    print(f"{'drivers':>10} {'loop (ms)':>12} {'batch (ms)':>12} {'speedup':>9}")
+    for n in args.sizes:
+        drivers = _random_fleet(n)
+        assert scalar_loop(drivers) == batch_engine(drivers)
+
+        t_loop = _best_time(lambda: scalar_loop(drivers), args.repeat)
+        t_batch = _best_time(lambda: batch_engine(drivers), args.repeat)
+        print(f"{n:>10} {t_loop * 1000:>12.3f} {t_batch * 1000:>12.3f} {t_loop / t_batch:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Discrete-event dispatch simulator: a synthetic city driven through the real scheduler.
+
+Riders request trips as a Poisson process; each request is saved to an in-memory
+SQLite database and handed to app.services.scheduler.assign_driver_to_ride. Rides
+that find no driver wait in the pending queue until a trip completes and frees
+one. Google Maps is replaced by a straight-line road model (or, with --graph, a
+local road graph), so runs are offline and repeatable for a given seed.
+
+Simulated time drives arrivals and trips; assignment latency is wall-clock time
+spent inside the scheduler, which is what scheduler changes should move.
+
+Run from the backend folder:
+    python -m benchmarks.simulator
+    python -m benchmarks.simulator --drivers 2000 --riders 5000 --rate 120 --minutes 60
+    python -m benchmarks.simulator --state sql      # compare against the plain SQL path
+    python -m benchmarks.simulator --graph road_graph.txt   # route over a local road graph
+"""
+import argparse
+import heapq
+import random
+import time
+from datetime import datetime, timedelta
+from math import cos, radians
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, Session, create_engine
+
+from app.models.models import Driver, RideRequest, User
+from app.services import driver_index, driver_state, pending_queue, ride_index, routing, scheduler
+from app.services.scoring import haversine_km
+
+CITY_CENTER = (14.5995, 120.9842)  # Manila
+ROAD_FACTOR = 1.3                  # road distance / straight-line distance
+SIM_SPEED_KMH = 25.0
+
+_KM_PER_DEG = 111.32
+
+# Set by simulate(graph_path=...): legs are routed over a local road graph instead
+_road_graph: Optional[routing.RoadGraph] = None
+
+
+def road_leg(lat1: float, lng1: float, lat2: float, lng2: float) -> Tuple[float, float]:
+    """(duration_min, distance_km) under the simulator's road model."""
+    if _road_graph is not None:
+        routed = _road_graph.route(lat1, lng1, lat2, lng2)
+        if routed is not None:
+            return routed
+    dist = haversine_km(lat1, lng1, lat2, lng2) * ROAD_FACTOR
+    return dist / SIM_SPEED_KMH * 60.0, dist
+
+
+def _stub_eta(origin_lat, origin_lng, dest_lat, dest_lng, timeout=5.0):
+    return road_leg(origin_lat, origin_lng, dest_lat, dest_lng)
+
+
+def _stub_eta_many(origins, dest_lat, dest_lng, timeout=5.0):
+    return [road_leg(lat, lng, dest_lat, dest_lng) for lat, lng in origins]
+
+
+def _random_point(rnd: random.Random, radius_km: float) -> Tuple[float, float]:
+    dlat = rnd.uniform(-radius_km, radius_km) / _KM_PER_DEG
+    dlng = rnd.uniform(-radius_km, radius_km) / (_KM_PER_DEG * cos(radians(CITY_CENTER[0])))
+    return CITY_CENTER[0] + dlat, CITY_CENTER[1] + dlng
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def build_city(session: Session, rnd: random.Random, drivers: int, riders: int, radius_km: float) -> List[int]:
+    """Insert drivers spread over the city and rider accounts. Returns the user ids."""
+    for i in range(drivers):
+        lat, lng = _random_point(rnd, radius_km)
+        session.add(Driver(name=f"Driver {i}", vehicle_type="van", plate_number=f"SIM-{i}",
+                           current_lat=lat, current_lng=lng))
+    users = [User(name=f"Rider {i}", email=f"rider{i}@sim.local", priority_level=rnd.choice((0, 0, 0, 1, 2)))
+             for i in range(riders)]
+    session.add_all(users)
+    session.commit()
+    return [u.user_id for u in users]
+
+
+def simulate(
+    drivers: int = 500,
+    riders: int = 2000,
+    rate_per_min: float = 30.0,
+    minutes: float = 60.0,
+    radius_km: float = 10.0,
+    state: str = "memory",
+    seed: int = 106,
+    graph_path: Optional[str] = None,
+) -> dict:
+    """
+    Run one simulation and return its metrics. `state` picks where the scheduler
+    finds candidates: "sql" (table scan), "index" (grid index + SQL) or
+    "memory" (grid index + in-memory driver state, as in production).
+    With graph_path, trips follow a local road graph (app.services.routing).
+    """
+    global _road_graph
+    _road_graph = routing.load_graph(graph_path) if graph_path else None
+    rnd = random.Random(seed)
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    originals = (scheduler.get_eta_and_distance_minutes, scheduler.get_eta_and_distance_minutes_many)
+    scheduler.get_eta_and_distance_minutes = _stub_eta
+    scheduler.get_eta_and_distance_minutes_many = _stub_eta_many
+
+    latencies: List[float] = []   # seconds per scheduler call that assigned a ride
+    waits: List[float] = []       # simulated minutes from request to pickup
+    queued_waits: List[float] = []  # simulated minutes spent in the pending queue
+    requested_at: Dict[int, float] = {}
+    busy_sec = 0.0
+    requested = unserved_calls = 0
+
+    try:
+        with Session(engine) as session:
+            user_ids = build_city(session, rnd, drivers, riders, radius_km)
+            _reset_caches()
+            if state in ("index", "memory"):
+                driver_index.load_available_drivers(session)
+            if state == "memory":
+                driver_state.load_driver_states(session)
+
+            epoch = datetime(2025, 1, 1)
+            events: List[Tuple[float, int, str, Optional[int]]] = []  # (sim minute, seq, kind, id)
+            seq = 0
+            t = rnd.expovariate(rate_per_min)
+            while t < minutes:
+                seq += 1
+                heapq.heappush(events, (t, seq, "request", None))
+                t += rnd.expovariate(rate_per_min)
+
+            def start_trip(ride: RideRequest, now: float) -> None:
+                nonlocal seq
+                driver = session.get(Driver, ride.driver_id)
+                pickup_min, _ = road_leg(driver.current_lat, driver.current_lng, ride.pickup_lat, ride.pickup_lng)
+                trip_min, _ = road_leg(ride.pickup_lat, ride.pickup_lng, ride.dropoff_lat, ride.dropoff_lng)
+                waits.append(now - requested_at[ride.ride_id] + pickup_min)
+                queued_waits.append(now - requested_at[ride.ride_id])
+                seq += 1
+                heapq.heappush(events, (now + pickup_min + trip_min, seq, "complete", ride.ride_id))
+
+            while events:
+                now, _, kind, ride_id = heapq.heappop(events)
+                if kind == "request":
+                    requested += 1
+                    (plat, plng), (dlat, dlng) = _random_point(rnd, radius_km), _random_point(rnd, radius_km)
+                    ride = RideRequest(
+                        user_id=rnd.choice(user_ids), pickup_location="sim", dropoff_location="sim",
+                        pickup_lat=plat, pickup_lng=plng, dropoff_lat=dlat, dropoff_lng=dlng,
+                        requested_at=epoch + timedelta(minutes=now),
+                    )
+                    session.add(ride)
+                    session.commit()
+                    requested_at[ride.ride_id] = now
+
+                    t0 = time.perf_counter()
+                    assigned = scheduler.assign_driver_to_ride(session, ride)
+                    elapsed = time.perf_counter() - t0
+                    busy_sec += elapsed
+                    if assigned is None:
+                        unserved_calls += 1
+                        pending_queue.enqueue(session, ride)
+                        continue
+                    latencies.append(elapsed)
+                    start_trip(assigned, now)
+                else:
+                    ride = session.get(RideRequest, ride_id)
+                    ride.status = "completed"
+                    driver = session.get(Driver, ride.driver_id)
+                    driver.availability_status = "available"
+                    driver.current_lat, driver.current_lng = ride.dropoff_lat, ride.dropoff_lng
+                    session.add(ride)
+                    session.add(driver)
+                    session.commit()
+                    session.refresh(driver)
+                    if state == "memory":
+                        driver_state.sync_driver(driver)
+                    elif state == "index":
+                        driver_index.sync_driver(driver)
+
+                    t0 = time.perf_counter()
+                    served = pending_queue.assign_pending(session)
+                    elapsed = time.perf_counter() - t0
+                    busy_sec += elapsed
+                    for ride in served:
+                        latencies.append(elapsed / len(served))
+                        start_trip(ride, now)
+            still_waiting = len(pending_queue.pending_queue)
+    finally:
+        scheduler.get_eta_and_distance_minutes, scheduler.get_eta_and_distance_minutes_many = originals
+        _road_graph = None
+        _reset_caches()
+        engine.dispose()
+
+    return {
+        "state": state,
+        "drivers": drivers,
+        "requests": requested,
+        "assigned": len(latencies),
+        "queued_on_arrival": unserved_calls,
+        "never_served": still_waiting,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "assignments_per_sec": len(latencies) / busy_sec if busy_sec else 0.0,
+        "mean_wait_min": sum(waits) / len(waits) if waits else 0.0,
+        "mean_queue_wait_min": sum(queued_waits) / len(queued_waits) if queued_waits else 0.0,
+    }
+
+
+def _reset_caches() -> None:
+    driver_index.available_drivers.clear()
+    driver_index.available_drivers.loaded = False
+    driver_state.driver_states.clear()
+    driver_state.driver_states.loaded = False
+    pending_queue.pending_queue.clear()
+    ride_index.assigned_rides.clear()
+
+
+def format_report(stats: dict) -> str:
+    return "\n".join([
+        f"state={stats['state']}  drivers={stats['drivers']}  requests={stats['requests']}",
+        f"  assigned            {stats['assigned']:>10}  (queued on arrival: {stats['queued_on_arrival']},"
+        f" never served: {stats['never_served']})",
+        f"  latency p50/p95/p99 {stats['latency_p50_ms']:>8.2f} / {stats['latency_p95_ms']:.2f}"
+        f" / {stats['latency_p99_ms']:.2f} ms",
+        f"  assignments/sec     {stats['assignments_per_sec']:>10.1f}",
+        f"  mean rider wait     {stats['mean_wait_min']:>10.2f} min"
+        f"  (in queue: {stats['mean_queue_wait_min']:.2f} min)",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--drivers", type=int, default=500)
+    parser.add_argument("--riders", type=int, default=2000, help="rider accounts requests are drawn from")
+    parser.add_argument("--rate", type=float, default=30.0, help="ride requests per simulated minute")
+    parser.add_argument("--minutes", type=float, default=60.0, help="simulated minutes of arrivals")
+    parser.add_argument("--radius-km", type=float, default=10.0, help="half-width of the square city")
+    parser.add_argument("--state", choices=("sql", "index", "memory", "all"), default="memory")
+    parser.add_argument("--seed", type=int, default=106)
+    parser.add_argument("--graph", help="road graph file to route over (see app/services/routing.py)")
+    args = parser.parse_args()
+
+    states = ("sql", "index", "memory") if args.state == "all" else (args.state,)
+    for state in states:
+        stats = simulate(args.drivers, args.riders, args.rate, args.minutes, args.radius_km, state, args.seed, args.graph)
+        print(format_report(stats))
+
+
+if __name__ == "__main__":
+    main()
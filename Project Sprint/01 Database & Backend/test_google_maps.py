@@ -0,0 +1,353 @@
+import pytest
+
+from app.services import eta_cache, google_maps
+
+
+@pytest.fixture(autouse=True)
+def _empty_eta_cache():
+    eta_cache.eta_cache.clear()
+    yield
+    eta_cache.eta_cache.clear()
+
+
+class _FakeResponse:
+    def __init__(self, payload):
+        self._payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+def test_eta_many_chunks_origins_and_maps_results_back(monkeypatch):
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        origins = params["origins"].split("|")
+        calls.append(len(origins))
+        rows = []
+        for o in origins:
+            lat = float(o.split(",")[0])
+            # encode the origin latitude in the duration so results can be matched back
+            rows.append({"elements": [{
+                "status": "OK",
+                "duration": {"value": lat * 60},
+                "distance": {"value": 1000},
+            }]})
+        return _FakeResponse({"status": "OK", "rows": rows})
+
+    monkeypatch.setattr(google_maps, "GOOGLE_MAPS_API_KEY", "test-key")
+    monkeypatch.setattr(google_maps.http_client, "get", fake_get)
+
+    origins = [(float(i), 0.0) for i in range(30)]
+    results = google_maps.get_eta_and_distance_minutes_many(origins, 1.0, 1.0)
+
+    assert calls == [25, 5]
+    assert [r[0] for r in results] == [float(i) for i in range(30)]
+    assert all(r[1] == 1.0 for r in results)
+
+
+def test_eta_many_without_key_returns_none_per_origin(monkeypatch):
+    monkeypatch.setattr(google_maps, "GOOGLE_MAPS_API_KEY", None)
+    assert google_maps.get_eta_and_distance_minutes_many([(0, 0), (1, 1)], 2, 2) == [None, None]
+
+
+def test_contraction_hierarchy_matches_plain_dijkstra(tmp_path):
+    from benchmarks.bench_routing import write_grid_graph
+    from app.services import routing
+
+    path = str(tmp_path / "grid.txt")
+    write_grid_graph(path, size=8)
+    graph = routing.RoadGraph.load(path)
+    ch = routing.ContractionHierarchy.build(graph.out)
+    for s in range(0, len(graph), 5):
+        many = ch.query_many(list(range(len(graph))), s)
+        for t in range(len(graph)):
+            plain = routing.bidirectional_dijkstra(graph.out, graph.inc, t, s)
+            assert (plain is None) == (many[t] is None)
+            if plain is not None:
+                assert many[t][0] == pytest.approx(plain[0])
+
+
+def test_hierarchy_cache_round_trips_and_bad_caches_are_rebuilt(tmp_path):
+    import os
+    from benchmarks.bench_routing import write_grid_graph
+    from app.services import routing
+
+    path = str(tmp_path / "grid.txt")
+    write_grid_graph(path, size=5)
+    built = routing.load_graph(path).ch
+    cached = routing.load_graph(path).ch  # read back from grid.txt.ch
+    assert cached.up_out == built.up_out and cached.up_in == built.up_in
+
+    good = open(path + ".ch", "rb").read()
+    for bad in (good[: len(good) // 2], b"\x80\x04garbage", b""):
+        with open(path + ".ch", "wb") as f:
+            f.write(bad)
+        os.utime(path + ".ch")  # newer than the graph, so it is tried
+        assert routing.load_graph(path).ch.up_out == built.up_out
+        assert open(path + ".ch", "rb").read() == good  # rewritten
+
+
+def test_local_routing_backend_replaces_distance_matrix(tmp_path, monkeypatch):
+    from app.services import routing
+
+    path = tmp_path / "line.txt"
+    # three nodes ~1.1 km apart on a two-way road at 36 km/h (10 m/s)
+    path.write_text("n a 14.50 121.0\nn b 14.51 121.0\nn c 14.52 121.0\n"
+                    "e a b 1112 111.2 1\ne b c 1112 111.2 1\n")
+    monkeypatch.setattr(routing, "ROUTING_BACKEND", "local")
+    monkeypatch.setattr(routing, "_graph", routing.load_graph(str(path), use_ch=True))
+    monkeypatch.setattr(google_maps.requests, "get", lambda *a, **k: pytest.fail("network call"))
+
+    duration, distance = google_maps.get_eta_and_distance_minutes(14.50, 121.0, 14.52, 121.0)
+    assert duration == pytest.approx(222.4 / 60) and distance == pytest.approx(2.224)
+    many = google_maps.get_eta_and_distance_minutes_many([(14.50, 121.0), (14.51, 121.0), (16.0, 121.0)], 14.52, 121.0)
+    assert many[0] == pytest.approx((duration, distance))
+    assert many[2] is None   # too far from the network to snap
+
+
+def test_unloadable_road_graph_fails_once_and_answers_none(tmp_path, monkeypatch):
+    from app.services import routing
+
+    path = tmp_path / "bad.txt"
+    path.write_text("n a 14.50 not-a-number\n")
+    loads = []
+    monkeypatch.setattr(routing, "ROUTING_BACKEND", "local")
+    monkeypatch.setattr(routing, "_graph", None)
+    monkeypatch.setattr(routing, "_graph_failed", False)
+    monkeypatch.setattr(routing, "load_graph", lambda: loads.append(1) or routing.RoadGraph.load(str(path)))
+
+    routing.preload()
+    assert routing.route(14.50, 121.0, 14.52, 121.0) is None
+    assert routing.route_many([(14.50, 121.0)], 14.52, 121.0) == [None]
+    assert loads == [1]   # the failure is remembered, not retried per request
+
+
+def test_maps_http_client_reuses_pooled_connections():
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from app.services import http_client
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_GET(self):
+            body = b'{"status": "OK"}'
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    http_client.close()
+    http_client.pool_stats.reset()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/"
+        for _ in range(3):
+            assert http_client.get(url).json() == {"status": "OK"}
+        stats = http_client.stats()
+        assert (stats["requests"], stats["pool_misses"], stats["pool_hits"]) == (3, 1, 2)
+    finally:
+        http_client.close()
+        server.shutdown()
+
+
+def test_async_eta_many_sends_chunks_concurrently(monkeypatch):
+    import asyncio
+    from app.services import google_maps_async, http_client
+
+    in_flight, peak = [0], [0]
+
+    async def fake_aget(url, params=None, **kwargs):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        origins = params["origins"].split("|")
+        rows = [{"elements": [{
+            "status": "OK",
+            "duration": {"value": float(o.split(",")[0]) * 60},
+            "distance": {"value": 1000},
+        }]} for o in origins]
+        return _FakeResponse({"status": "OK", "rows": rows})
+
+    monkeypatch.setattr(google_maps, "GOOGLE_MAPS_API_KEY", "test-key")
+    monkeypatch.setattr(http_client, "aget", fake_aget)
+
+    origins = [(float(i), 0.0) for i in range(60)]
+    results = asyncio.run(google_maps_async.get_eta_and_distance_minutes_many(origins, 1.0, 1.0))
+
+    assert peak[0] == 3  # 25 + 25 + 10 origins, all in flight at once
+    assert [r[0] for r in results] == [float(i) for i in range(60)]
+
+
+def test_coalesced_eta_lookups_write_the_cache_once(monkeypatch):
+    import asyncio
+    import threading
+    import time
+    from app.services import google_maps_async, http_client
+
+    def rows(params):
+        return _FakeResponse({"status": "OK", "rows": [{"elements": [{
+            "status": "OK", "duration": {"value": 600}, "distance": {"value": 1000},
+        }]} for _ in params["origins"].split("|")]})
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append(1)
+        time.sleep(0.2)  # every caller joins this flight
+        return rows(params)
+
+    async def fake_aget(url, params=None, **kwargs):
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return rows(params)
+
+    puts = []
+    real_put = eta_cache.eta_cache.put
+    monkeypatch.setattr(eta_cache.eta_cache, "put", lambda key, value: puts.append(key) or real_put(key, value))
+    monkeypatch.setattr(eta_cache, "ETA_CACHE_ENABLED", True)
+    monkeypatch.setattr(google_maps, "GOOGLE_MAPS_API_KEY", "test-key")
+    monkeypatch.setattr(google_maps.http_client, "get", fake_get)
+    monkeypatch.setattr(http_client, "aget", fake_aget)
+    origins = [(14.55, 121.02), (14.6, 121.05)]
+
+    calls = []
+    threads = [threading.Thread(target=google_maps.get_eta_and_distance_minutes_many, args=(origins, 14.5, 121.0))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1 and len(puts) == 2  # one request, one write per origin
+
+    eta_cache.eta_cache.clear()
+    calls, puts[:] = [], []
+
+    async def lookups():
+        return await asyncio.gather(*(
+            google_maps_async.get_eta_and_distance_minutes_many(origins, 14.5, 121.0) for _ in range(4)
+        ))
+
+    assert all(r == [(10.0, 1.0)] * 2 for r in asyncio.run(lookups()))
+    assert len(calls) == 1 and len(puts) == 2
+
+
+def test_geocode_cache_normalizes_and_caches_hits_and_misses(monkeypatch):
+    from sqlalchemy.pool import StaticPool
+    from sqlmodel import SQLModel, create_engine
+    from app.services import geocode_cache
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(geocode_cache, "engine", engine)
+    monkeypatch.setattr(geocode_cache, "geocode_cache", geocode_cache.GeocodeCache(size=10))
+    monkeypatch.setattr(google_maps, "GOOGLE_MAPS_API_KEY", "test-key")
+    assert geocode_cache.normalize_address(" Parañaque  City.") == geocode_cache.normalize_address("PARANAQUE city")
+
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append(params["address"])
+        if "nowhere" in params["address"].lower():
+            return _FakeResponse({"status": "ZERO_RESULTS", "results": []})
+        if "quota" in params["address"]:
+            return _FakeResponse({"status": "OVER_QUERY_LIMIT"})
+        return _FakeResponse({"status": "OK", "results": [{"geometry": {"location": {"lat": 14.6, "lng": 121.0}}}]})
+
+    monkeypatch.setattr(google_maps.http_client, "get", fake_get)
+
+    assert geocode_cache.normalize_address("  123 Main St.,  MANILA ") == "123 main st manila"
+    assert google_maps.geocode_location("123 Main St., Manila") == (14.6, 121.0)
+    assert google_maps.geocode_location("123 main st manila") == (14.6, 121.0)
+    assert google_maps.geocode_location("Nowhere") is None
+    assert google_maps.geocode_location("nowhere!") is None
+    assert google_maps.geocode_location("quota") is None
+    assert google_maps.geocode_location("quota") is None  # errors are not cached
+    assert calls == ["123 Main St., Manila", "Nowhere", "quota", "quota"]
+
+    geocode_cache.geocode_cache.clear()  # a restart: the table still has the answers
+    assert google_maps.geocode_location("123 MAIN ST MANILA") == (14.6, 121.0)
+    stats = geocode_cache.geocode_cache.stats()
+    assert (stats["memory_hits"], stats["db_hits"], stats["misses"]) == (0, 1, 0)
+    assert len(calls) == 4
+
+
+def test_eta_cache_snaps_nearby_legs_and_survives_a_restart(monkeypatch, tmp_path):
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        origins = params["origins"].split("|")
+        calls.append(len(origins))
+        rows = [{"elements": [{"status": "OK", "duration": {"value": 600}, "distance": {"value": 4000}}]}
+                for _ in origins]
+        return _FakeResponse({"status": "OK", "rows": rows})
+
+    monkeypatch.setattr(google_maps, "GOOGLE_MAPS_API_KEY", "test-key")
+    monkeypatch.setattr(google_maps.http_client, "get", fake_get)
+
+    assert google_maps.get_eta_and_distance_minutes(14.60000, 121.00000, 14.65, 121.05) == (10.0, 4.0)
+    # ~10 m away: same grid cell, no request; plus one far origin that is fetched
+    results = google_maps.get_eta_and_distance_minutes_many([(14.60008, 121.00005), (14.70, 121.10)], 14.65, 121.05)
+    assert results == [(10.0, 4.0), (10.0, 4.0)] and calls == [1, 1]
+
+    path = str(tmp_path / "eta_cache.json")
+    # a stale temp file of another worker is neither read nor clobbered
+    (tmp_path / "eta_cache.json.tmp").write_text("partial")
+    assert eta_cache.eta_cache.save(path) == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["eta_cache.json", "eta_cache.json.tmp"]
+    restarted = eta_cache.EtaCache()
+    assert restarted.load(path) == 2
+    assert restarted.get(restarted.key(14.60, 121.00, 14.65, 121.05)) == (10.0, 4.0)
+
+
+def test_identical_concurrent_lookups_share_one_request(monkeypatch):
+    import asyncio
+    import threading
+    import time
+    from app.services import geocode_cache, google_maps_async, http_client
+
+    calls = []
+
+    def slow_get(url, params=None, **kwargs):
+        calls.append(url)
+        time.sleep(0.1)
+        row = {"elements": [{"status": "OK", "duration": {"value": 600}, "distance": {"value": 4000}}]}
+        return _FakeResponse({"status": "OK", "rows": [row]})
+
+    monkeypatch.setattr(google_maps, "GOOGLE_MAPS_API_KEY", "test-key")
+    monkeypatch.setattr(google_maps.http_client, "get", slow_get)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            google_maps.get_eta_and_distance_minutes(14.6, 121.0, 14.65, 121.05)))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [(10.0, 4.0)] * 5 and len(calls) == 1
+
+    async def slow_aget(url, params=None, **kwargs):
+        calls.append(url)
+        await asyncio.sleep(0.05)
+        return _FakeResponse({"status": "OK", "results": [{"geometry": {"location": {"lat": 14.6, "lng": 121.0}}}]})
+
+    monkeypatch.setattr(geocode_cache, "GEOCODE_CACHE_ENABLED", False)
+    monkeypatch.setattr(http_client, "aget", slow_aget)
+
+    async def burst():
+        return await asyncio.gather(*(
+            google_maps_async.geocode_location(address)
+            for address in ["St. Luke's Hospital", "st. luke's hospital", "ST LUKE'S  HOSPITAL"]
+        ))
+
+    assert asyncio.run(burst()) == [(14.6, 121.0)] * 3
+    assert len(calls) == 2
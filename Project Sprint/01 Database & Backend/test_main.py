@@ -1,5 +1,14 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
 from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+from app.database import engine
 from app.main import app
+from app.routers import ride_requests
+from app.services.commitments import commitments
 
 client = TestClient(app)
 
@@ -25,3 +34,66 @@ def test_get_drivers():
 def test_get_ride_requests():
     response = client.get("/ride-requests/")
     assert response.status_code == 200
+
+def _booking(user_id, driver_id, at):
+    return {
+        "user_id": user_id, "driver_id": driver_id,
+        "pickup_location": "A", "dropoff_location": "B",
+        "pickup_lat": 14.60, "pickup_lng": 120.98, "dropoff_lat": 14.62, "dropoff_lng": 121.00,
+        "scheduled_for": at.isoformat(),
+    }
+
+def test_booking_a_committed_driver_is_rejected():
+    user = client.post("/users/", json={"name": "Booker", "email": "booker@example.com", "phone": "0", "priority_level": 1}).json()
+    driver = client.post("/drivers/", json={"name": "Booked", "vehicle_type": "van", "plate_number": "BK-1",
+                                           "current_lat": 14.60, "current_lng": 120.98}).json()
+    at = datetime.utcnow() + timedelta(days=30, minutes=random.randint(0, 10000))
+
+    first = client.post("/ride-requests/", json=_booking(user["user_id"], driver["driver_id"], at))
+    assert first.status_code == 202
+    assert commitments.driver_for(first.json()["ride_id"]) == driver["driver_id"]
+    second = client.post("/ride-requests/", json=_booking(user["user_id"], driver["driver_id"], at + timedelta(minutes=5)))
+    assert second.status_code == 409
+    commitments.remove(first.json()["ride_id"])  # keep the in-memory index clean for later tests
+
+class FailingCommit(Session):
+    def commit(self):
+        raise RuntimeError("disk full")
+
+def failing_session():
+    with FailingCommit(engine) as session:
+        yield session
+
+def test_failed_booking_insert_releases_the_reservation():
+    user = client.post("/users/", json={"name": "Booker", "email": "booker2@example.com", "phone": "0", "priority_level": 1}).json()
+    driver = client.post("/drivers/", json={"name": "Booked", "vehicle_type": "van", "plate_number": "BK-2",
+                                           "current_lat": 14.60, "current_lng": 120.98}).json()
+    at = datetime.utcnow() + timedelta(days=30, minutes=random.randint(0, 10000))
+    held = len(commitments)
+    app.dependency_overrides[ride_requests.get_session] = failing_session
+    try:
+        with pytest.raises(RuntimeError):
+            client.post("/ride-requests/", json=_booking(user["user_id"], driver["driver_id"], at))
+    finally:
+        app.dependency_overrides.clear()
+    assert len(commitments) == held
+    # the driver is still bookable for that slot
+    retried = client.post("/ride-requests/", json=_booking(user["user_id"], driver["driver_id"], at))
+    assert retried.status_code == 202
+    commitments.remove(retried.json()["ride_id"])
+
+def test_failed_completion_keeps_the_reservation():
+    user = client.post("/users/", json={"name": "Booker", "email": "booker3@example.com", "phone": "0", "priority_level": 1}).json()
+    driver = client.post("/drivers/", json={"name": "Booked", "vehicle_type": "van", "plate_number": "BK-3",
+                                           "current_lat": 14.60, "current_lng": 120.98}).json()
+    at = datetime.utcnow() + timedelta(days=30, minutes=random.randint(0, 10000))
+    ride_id = client.post("/ride-requests/", json=_booking(user["user_id"], driver["driver_id"], at)).json()["ride_id"]
+    app.dependency_overrides[ride_requests.get_session] = failing_session
+    try:
+        with pytest.raises(RuntimeError):
+            client.patch(f"/ride-requests/{ride_id}/complete")
+    finally:
+        app.dependency_overrides.clear()
+    assert commitments.driver_for(ride_id) == driver["driver_id"]  # the ride is still open in the DB
+    assert client.patch(f"/ride-requests/{ride_id}/complete").status_code == 200
+    assert commitments.driver_for(ride_id) is None
@@ -0,0 +1,912 @@
+import pytest
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, Session, create_engine
+
+from app.models.models import Driver, RideRequest, User
+from app.services import commitments, driver_index, driver_state, pending_queue, ride_index, scheduler, scoring
+from app.services.driver_index import GridIndex
+
+
+@pytest.fixture
+def session(monkeypatch):
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    SQLModel.metadata.create_all(engine)
+    # Keep the Maps API out of scheduler tests
+    monkeypatch.setattr(scheduler, "get_eta_and_distance_minutes", lambda *a, **k: None)
+    monkeypatch.setattr(
+        scheduler, "get_eta_and_distance_minutes_many", lambda origins, *a, **k: [None] * len(origins)
+    )
+    with Session(engine) as s:
+        yield s
+    driver_index.available_drivers.clear()
+    driver_index.available_drivers.loaded = False
+    pending_queue.pending_queue.clear()
+    driver_state.driver_states.clear()
+    driver_state.driver_states.loaded = False
+    commitments.commitments.clear()
+    ride_index.assigned_rides.clear()
+
+
+def _make_ride(session, lat, lng):
+    user = User(name="Rider", email="rider@example.com")
+    session.add(user)
+    session.commit()
+    ride = RideRequest(
+        user_id=user.user_id, pickup_location="A", dropoff_location="B",
+        pickup_lat=lat, pickup_lng=lng,
+    )
+    session.add(ride)
+    session.commit()
+    session.refresh(ride)
+    return ride
+
+
+def test_grid_index_nearby_returns_closest_ring():
+    idx = GridIndex(cell_km=1.0)
+    idx.upsert(1, 14.5600, 121.0000)   # same cell as the query
+    idx.upsert(2, 14.5650, 121.0050)   # a few hundred meters away
+    idx.upsert(3, 15.5000, 122.0000)   # far away
+    found = set(idx.nearby(14.5601, 121.0001))
+    assert 1 in found and 3 not in found
+
+    idx.upsert(1, 15.5001, 122.0001)   # moves out of the neighborhood
+    assert 1 not in idx.nearby(14.5601, 121.0001)
+    idx.remove(3)
+    assert 3 not in idx
+
+
+def test_choose_best_driver_uses_index(session):
+    near = Driver(name="Near", vehicle_type="van", plate_number="N1", current_lat=14.56, current_lng=121.0)
+    far = Driver(name="Far", vehicle_type="van", plate_number="F1", current_lat=15.5, current_lng=122.0)
+    session.add(near)
+    session.add(far)
+    session.commit()
+    driver_index.load_available_drivers(session)
+
+    ride = _make_ride(session, 14.561, 121.001)
+    assigned = scheduler.assign_driver_to_ride(session, ride)
+    assert assigned.driver_id == near.driver_id
+    # the assigned driver is no longer available, so it leaves the index
+    assert near.driver_id not in driver_index.available_drivers
+    assert far.driver_id in driver_index.available_drivers
+
+
+def test_only_top_k_and_possible_winners_get_road_etas(session, monkeypatch):
+    asked = []
+
+    def fake_many(origins, dest_lat, dest_lng, timeout=5.0):
+        asked.extend(origins)
+        # every road ETA is 1 minute, distance equal to the straight line
+        return [(1.0, scoring.haversine_km(lat, lng, dest_lat, dest_lng)) for lat, lng in origins]
+
+    monkeypatch.setattr(scheduler, "get_eta_and_distance_minutes_many", fake_many)
+    monkeypatch.setattr(scheduler, "SCHEDULER_TOP_K", 2)
+    for i in range(6):
+        # 0.5 km, 1 km, ... apart along one meridian
+        session.add(Driver(name=f"D{i}", vehicle_type="van", plate_number=f"P{i}",
+                           current_lat=14.56 + 0.0045 * (i + 1), current_lng=121.0))
+    session.commit()
+
+    ride = _make_ride(session, 14.56, 121.0)
+    best = scheduler.choose_best_driver(session, ride)
+    assert best.name == "D0"
+    # far drivers can never beat a 0.5 km / 1 min candidate
+    assert len(asked) < 6
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_batch_scoring_matches_scalar_score(monkeypatch, use_numpy):
+    if use_numpy and not scoring.HAS_NUMPY:
+        pytest.skip("NumPy not installed")
+    monkeypatch.setattr(scoring, "HAS_NUMPY", use_numpy)
+    lats, lngs = [14.56, 14.60, 14.70], [121.0, 121.05, 120.95]
+    batch = scoring.CandidateBatch([1, 2, 3], lats, lngs)
+    dist, eta, scores = scoring.score_candidates(14.58, 121.01, batch, user_priority=2)
+    for i in range(3):
+        d = scoring.haversine_km(14.58, 121.01, lats[i], lngs[i])
+        assert dist[i] == pytest.approx(d)
+        assert scores[i] == pytest.approx(scheduler._score(d, d / 20.0 * 60.0, 2))
+    assert scoring.argsort(dist)[0] == scoring.argmin(dist)
+
+
+def test_solve_assignment_is_optimal_for_rectangular_matrices():
+    from itertools import permutations
+    from app.services.matching import solve_assignment
+
+    cost = [[4, 1, 3, 9], [2, 0, 5, 8], [3, 2, 2, 7]]
+    pairs = solve_assignment(cost)
+    best = min(sum(cost[r][c] for r, c in enumerate(p)) for p in permutations(range(4), 3))
+    assert len(pairs) == 3
+    assert sum(cost[r][c] for r, c in pairs) == best
+
+    transposed = [list(col) for col in zip(*cost)]
+    assert sum(transposed[r][c] for r, c in solve_assignment(transposed)) == best
+
+
+def test_dispatch_batch_beats_greedy(session):
+    from app.services.matching import dispatch_batch
+
+    # Along one meridian: ride 1 is slightly closer to A than to B, ride 2 is only
+    # close to A. Greedy gives A to ride 1 and sends B far away for ride 2.
+    a = Driver(name="A", vehicle_type="van", plate_number="A1", current_lat=14.500, current_lng=121.0)
+    b = Driver(name="B", vehicle_type="van", plate_number="B1", current_lat=14.520, current_lng=121.0)
+    session.add(a)
+    session.add(b)
+    session.commit()
+    r1 = _make_ride(session, 14.509, 121.0)
+    r2 = _make_ride(session, 14.490, 121.0)
+    r1_id, r2_id, a_id, b_id = r1.ride_id, r2.ride_id, a.driver_id, b.driver_id
+
+    assigned = dispatch_batch(session, [r1, r2])
+    by_ride = {r.ride_id: r.driver_id for r in assigned}
+    assert by_ride == {r1_id: b_id, r2_id: a_id}
+    assert session.get(Driver, a_id).availability_status == "on_ride"
+
+
+def test_async_dispatcher_wakes_long_pollers(monkeypatch):
+    import asyncio
+    from app.services import dispatcher as dispatcher_module
+
+    handled = []
+    monkeypatch.setattr(dispatcher_module, "assign_one", lambda ride_id: handled.append(ride_id) or True)
+
+    async def scenario():
+        d = dispatcher_module.Dispatcher(mode="async", workers=2)
+        d.start()
+        async with d.watch(7) as processed:
+            d.submit(7)
+            await asyncio.wait_for(processed.wait(), 2)
+        # a ride that was already processed does not block a later poll
+        async with d.watch(7) as processed:
+            assert processed.is_set()
+        await d.stop()
+
+    asyncio.run(scenario())
+    assert handled == [7]
+
+
+def test_freed_drivers_are_drained_in_the_background_and_coalesced(monkeypatch):
+    import asyncio
+    import threading
+    from app.services import dispatcher as dispatcher_module
+
+    first_started, release = threading.Event(), threading.Event()
+    drains = []
+
+    def fake_free(driver_ids):
+        drains.append(list(driver_ids))
+        first_started.set()
+        release.wait(2)  # a slow Maps-bound drain
+        return True
+
+    monkeypatch.setattr(dispatcher_module, "free_drivers", fake_free)
+
+    async def scenario():
+        d = dispatcher_module.Dispatcher(mode="inline")
+        assert not d.drain(1)  # no workers yet: the caller drains inline
+        d.start()
+        assert d.drain(1)  # returns at once; the drain runs in the executor
+        await asyncio.get_running_loop().run_in_executor(None, first_started.wait, 2)
+        d.drain(2)
+        d.drain(3)
+        d.drain(2)
+        release.set()
+        while len(drains) < 2:
+            await asyncio.sleep(0.01)
+        await d.stop()
+
+    asyncio.run(scenario())
+    assert drains == [[1], [2, 3]]
+
+
+def test_lost_claim_falls_back_to_next_best_driver(session, monkeypatch):
+    near = Driver(name="Near", vehicle_type="van", plate_number="N1", current_lat=14.561, current_lng=121.0)
+    next_best = Driver(name="Next", vehicle_type="van", plate_number="N2", current_lat=14.570, current_lng=121.0)
+    session.add(near)
+    session.add(next_best)
+    session.commit()
+    driver_index.load_available_drivers(session)
+    ride = _make_ride(session, 14.560, 121.0)
+    near_id, next_id = near.driver_id, next_best.driver_id
+
+    # another worker grabs the nearest driver after we ranked but before we claim
+    real_rank = scheduler.rank_drivers
+
+    def rank_then_steal(s, r):
+        ranked = real_rank(s, r)
+        assert ranked[0][1].driver_id == near_id
+        with Session(s.get_bind()) as other:
+            assert scheduler.claim_assignment(other, _make_ride(other, 14.560, 121.0), near_id)
+            other.commit()
+        return ranked
+
+    monkeypatch.setattr(scheduler, "rank_drivers", rank_then_steal)
+    assigned = scheduler.assign_driver_to_ride(session, ride)
+    assert assigned.driver_id == next_id
+    assert near_id not in driver_index.available_drivers
+
+
+def test_timing_wheel_fires_each_key_once_at_its_tick():
+    from app.services.timing_wheel import TimingWheel
+
+    # tiny levels so items cascade and overflow within a short test
+    wheel = TimingWheel(start_ts=0, wheel_sizes=(4, 4, 4))
+    due = {key: key * 7 % 150 + 1 for key in range(40)}
+    for key, ts in due.items():
+        wheel.schedule(key, ts)
+    wheel.schedule(5, 3)          # reschedule replaces the earlier entry
+    due[5] = 3
+    assert wheel.cancel(6)
+    del due[6]
+
+    fired = {}
+    for now in range(1, 160):
+        for key in wheel.advance(now):
+            assert key not in fired
+            fired[key] = now
+    assert fired == due
+    assert len(wheel) == 0
+
+
+def test_scheduled_ride_waits_in_the_wheel(session):
+    from datetime import datetime, timedelta
+    from app.services.dispatcher import Dispatcher
+
+    ride = _make_ride(session, 14.56, 121.0)
+    d = Dispatcher(mode="inline")
+    assert not d.defer(ride)                      # not scheduled: assign now
+
+    ride.scheduled_for = datetime.utcnow() + timedelta(hours=3)
+    assert d.defer(ride)
+    assert ride.ride_id in d.wheel
+
+    ride.scheduled_for = datetime.utcnow() + timedelta(minutes=5)
+    assert not d.defer(ride)                      # already inside the lead time
+
+
+def test_pending_queue_ages_low_priority_rides_past_new_high_priority_ones():
+    from datetime import datetime, timedelta
+
+    q = pending_queue.PendingQueue(aging_per_min=0.1)
+    now = datetime.utcnow()
+    q.push(1, priority=0, requested_at=now - timedelta(minutes=5))
+    q.push(2, priority=1, requested_at=now)
+    assert q.peek() == 2                         # 0 + 0.5 < 1 + 0
+    q.push(3, priority=0, requested_at=now - timedelta(minutes=30))
+    assert q.peek() == 3                         # 0 + 3.0 > 1
+    q.discard(3)
+    assert q.peek() == 2 and len(q) == 2
+    assert q.stats(now)["oldest_wait_min"] == pytest.approx(5.0)
+
+
+def test_freed_driver_serves_the_pending_queue_head(session):
+    ride = _make_ride(session, 14.56, 121.0)
+    driver_index.load_available_drivers(session)
+    assert scheduler.assign_driver_to_ride(session, ride) is None
+    pending_queue.enqueue(session, ride)
+
+    driver = Driver(name="Late", vehicle_type="van", plate_number="L1", current_lat=14.57, current_lng=121.0)
+    session.add(driver)
+    session.commit()
+    driver_index.sync_driver(driver)
+
+    assigned = pending_queue.assign_pending(session)
+    assert [r.ride_id for r in assigned] == [ride.ride_id]
+    assert assigned[0].driver_id == driver.driver_id
+    assert len(pending_queue.pending_queue) == 0
+
+
+def test_one_freed_driver_scans_the_queue_for_one_ride_only(session, monkeypatch):
+    from app.services import reassign
+
+    rides = [_make_ride(session, 14.56, 121.0 + 0.001 * k) for k in range(3)]
+    driver_index.load_available_drivers(session)
+    for ride in rides:
+        pending_queue.enqueue(session, ride)
+    drivers = [Driver(name=f"D{k}", vehicle_type="van", plate_number=f"D{k}", current_lat=14.57, current_lng=121.0)
+               for k in range(2)]
+    session.add_all(drivers)
+    session.commit()
+    for driver in drivers:
+        driver_index.sync_driver(driver)
+    tried = []
+    real = pending_queue.assign_driver_to_ride
+    monkeypatch.setattr(pending_queue, "assign_driver_to_ride", lambda s, r: tried.append(r.ride_id) or real(s, r))
+
+    reassign.serve_freed(session, [drivers[0].driver_id])
+    assert tried == [rides[0].ride_id] and len(pending_queue.pending_queue) == 2
+
+
+def test_unservable_head_does_not_block_the_queue(session):
+    lift = _make_ride(session, 14.56, 121.0)
+    lift.required_vehicle_type = "wheelchair van"
+    session.add(lift)
+    session.commit()
+    plain = _make_ride(session, 14.56, 121.0)
+    driver_index.load_available_drivers(session)
+    for ride, priority in ((lift, 5), (plain, 1)):
+        assert scheduler.assign_driver_to_ride(session, ride) is None
+        pending_queue.pending_queue.push(ride.ride_id, priority, ride.requested_at)
+    assert pending_queue.pending_queue.peek() == lift.ride_id
+
+    driver = Driver(name="Van", vehicle_type="van", plate_number="V1", current_lat=14.57, current_lng=121.0)
+    session.add(driver)
+    session.commit()
+    driver_index.sync_driver(driver)
+
+    assigned = pending_queue.assign_pending(session)
+    assert [r.ride_id for r in assigned] == [plain.ride_id]
+    assert pending_queue.pending_queue.peek() == lift.ride_id  # still first in line
+
+
+def test_driver_state_serves_candidates_and_detects_drift(session):
+    near = Driver(name="Near", vehicle_type="van", plate_number="N1", current_lat=14.561, current_lng=121.0)
+    far = Driver(name="Far", vehicle_type="sedan", plate_number="F1", current_lat=14.600, current_lng=121.0)
+    session.add(near)
+    session.add(far)
+    session.commit()
+    driver_state.load_driver_states(session)
+    driver_index.load_available_drivers(session)
+    near_id, far_id = near.driver_id, far.driver_id
+
+    ride = _make_ride(session, 14.560, 121.0)
+    candidates = scheduler.load_candidates(session, ride)
+    assert all(isinstance(c, driver_state.DriverRecord) for c in candidates)
+    assert scheduler.assign_driver_to_ride(session, ride).driver_id == near_id
+    assert driver_state.driver_states.get(near_id).availability_status == "on_ride"
+    assert driver_state.verify_driver_states(session)["consistent"]
+
+    # a write that bypassed the store (another process, manual SQL) shows up as drift
+    far.current_lat = 14.7
+    session.add(far)
+    session.commit()
+    report = driver_state.verify_driver_states(session)
+    assert report["mismatched"] == [far_id] and not report["consistent"]
+    driver_state.load_driver_states(session)
+    assert driver_state.verify_driver_states(session)["consistent"]
+
+
+def test_confident_eta_model_replaces_maps_calls(session, monkeypatch):
+    from app.services import eta_model
+
+    # 20 trips within one zone pair that all ran at 2 min per straight-line km with a 1.2 detour
+    trips = []
+    for i in range(20):
+        olng = 121.0 + 0.0002 * i
+        km = scoring.haversine_km(14.57, olng, 14.56, 121.0)
+        trips.append((14.57, olng, 14.56, 121.0, 8, 2.0 * km, 1.2 * km))
+    model = eta_model.EtaModel.fit(trips)
+    est = model.predict(14.57, 121.001, 14.56, 121.0, hour=8)
+    km = scoring.haversine_km(14.57, 121.001, 14.56, 121.0)
+    assert est.duration_min == pytest.approx(2.0 * km)
+    assert est.distance_km == pytest.approx(1.2 * km)
+    assert est.zone_level and eta_model.trusted(est)
+
+    asked = []
+    monkeypatch.setattr(scheduler, "get_eta_and_distance_minutes_many",
+                        lambda origins, *a, **k: asked.extend(origins) or [None] * len(origins))
+    monkeypatch.setattr(eta_model, "_model", model)
+    session.add(Driver(name="D", vehicle_type="van", plate_number="P", current_lat=14.57, current_lng=121.001))
+    session.commit()
+    assert scheduler.choose_best_driver(session, _make_ride(session, 14.56, 121.0)).name == "D"
+    assert asked == []
+
+
+def test_sparse_zone_still_asks_maps_despite_a_confident_city_wide_pool(session, monkeypatch):
+    from app.services import eta_model
+
+    # 40 identical-pace trips far south, one trip in the driver's zone pair
+    trips = []
+    for i in range(40):
+        olng = 121.0 + 0.0002 * i
+        km = scoring.haversine_km(14.40, olng, 14.45, 121.0)
+        trips.append((14.40, olng, 14.45, 121.0, 8, 2.0 * km, 1.2 * km))
+    km = scoring.haversine_km(14.57, 121.0, 14.56, 121.0)
+    trips.append((14.57, 121.0, 14.56, 121.0, 8, 5.0 * km, 1.5 * km))
+    model = eta_model.EtaModel.fit(trips)
+    est = model.predict(14.57, 121.001, 14.56, 121.0, hour=8)
+    assert not est.zone_level and est.confidence >= eta_model.ETA_MODEL_MIN_CONFIDENCE
+    assert not eta_model.trusted(est)
+
+    asked = []
+    monkeypatch.setattr(scheduler, "get_eta_and_distance_minutes_many",
+                        lambda origins, *a, **k: asked.extend(origins) or [None] * len(origins))
+    monkeypatch.setattr(eta_model, "_model", model)
+    session.add(Driver(name="D", vehicle_type="van", plate_number="P", current_lat=14.57, current_lng=121.001))
+    session.commit()
+    assert scheduler.choose_best_driver(session, _make_ride(session, 14.56, 121.0)).name == "D"
+    assert asked == [(14.57, 121.001)]
+
+
+def test_zone_matrix_round_trips_through_the_mapped_file(tmp_path, monkeypatch):
+    from app.services import eta_model, zone_matrix
+    from app.services.zones import ZoneGrid
+
+    grid = ZoneGrid((14.50, 120.95, 14.60, 121.05), cell_km=2.0)
+    trips = [(14.51, 121.0, 14.51 + 0.01 * k, 121.0, 8, 1.5 * 1.11 * k, 1.11 * k) for k in range(1, 9)]
+    monkeypatch.setattr(eta_model, "_model", eta_model.EtaModel.fit(trips))
+    path = str(tmp_path / "zones.bin")
+
+    assert zone_matrix.build_matrix(path, grid, hour=8) == len(grid) ** 2
+    matrix = zone_matrix.ZoneMatrix(path, grid)
+    assert matrix.ready and matrix.hour == 8
+    oz, dz = grid.center(0), grid.center(grid.zone_of(14.58, 121.03))
+    duration, distance = matrix.lookup(oz[0], oz[1], dz[0], dz[1])
+    km = scoring.haversine_km(oz[0], oz[1], dz[0], dz[1])
+    assert duration == pytest.approx(1.5 * km, rel=0.01)
+    assert matrix.lookup(15.5, 121.0, dz[0], dz[1]) is None   # outside the service area
+
+    # a file built for a different zoning is ignored
+    assert not zone_matrix.ZoneMatrix(path, ZoneGrid((14.50, 120.95, 14.60, 121.05), cell_km=1.0)).ready
+
+
+def test_zone_matrix_rebuilds_take_turns_and_readers_follow_the_file(tmp_path, monkeypatch):
+    import fcntl
+    import os
+    from app.services import zone_matrix
+
+    path = str(tmp_path / "zones.bin")
+    builds = []
+
+    def fake_build(p):
+        builds.append(p)
+        with open(f"{p}.{os.getpid()}.tmp", "wb") as f:
+            f.write(b"x" * len(builds))
+        os.replace(f"{p}.{os.getpid()}.tmp", p)
+
+    monkeypatch.setattr(zone_matrix, "build_matrix", fake_build)
+    monkeypatch.setattr(zone_matrix, "_matrix", zone_matrix.ZoneMatrix(path))
+    assert zone_matrix.refresh(path, min_age_sec=60)
+    first = zone_matrix._matrix.mtime_ns
+    assert first is not None
+    assert not zone_matrix.refresh(path, min_age_sec=60)  # another worker built it just now
+    with open(f"{path}.lock", "a") as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        assert not zone_matrix.refresh(path)  # another worker is building it
+    assert len(builds) == 1
+
+    os.utime(path, ns=(first + 10**9, first + 10**9))  # replaced by some other process
+    assert zone_matrix.reload_if_changed(path).mtime_ns == first + 10**9
+
+
+def test_day_planner_chains_compatible_rides_onto_one_driver(session):
+    from datetime import date, datetime
+    from app.services import day_planner
+
+    user = User(name="Rider", email="rider@example.com")
+    session.add(user)
+    session.add_all([
+        Driver(name="Near", vehicle_type="van", plate_number="N", current_lat=14.60, current_lng=120.98),
+        Driver(name="Far", vehicle_type="van", plate_number="F", current_lat=14.75, current_lng=121.10),
+    ])
+    session.commit()
+    # 08:00 out and 09:00 back can share a driver; 08:05 across town needs the second one
+    for hour, minute, (plat, plng), (dlat, dlng) in (
+        (8, 0, (14.60, 120.98), (14.62, 121.00)),
+        (9, 0, (14.62, 121.00), (14.60, 120.98)),
+        (8, 5, (14.75, 121.10), (14.74, 121.09)),
+    ):
+        session.add(RideRequest(
+            user_id=user.user_id, pickup_location="A", dropoff_location="B",
+            pickup_lat=plat, pickup_lng=plng, dropoff_lat=dlat, dropoff_lng=dlng,
+            scheduled_for=datetime(2030, 5, 2, hour, minute),
+        ))
+    session.commit()
+
+    plan = day_planner.plan_day(session, date(2030, 5, 2), budget_sec=2, workers=1)
+    assert plan["rides"] == 3 and plan["unplanned"] == []
+    assert sorted(len(i["stops"]) for i in plan["itineraries"]) == [1, 2]
+    chained = next(i for i in plan["itineraries"] if len(i["stops"]) == 2)
+    assert [s["scheduled_for"][11:16] for s in chained["stops"]] == ["08:00", "09:00"]
+    assert day_planner.plan_day(session, date(2030, 5, 3), workers=1)["rides"] == 0
+
+
+def test_day_plan_runs_as_a_job_and_stores_its_result(session, monkeypatch):
+    from datetime import date
+    from app.services import day_planner
+
+    monkeypatch.setattr(day_planner, "engine", session.get_bind())
+    job_id = day_planner.create_plan_job(date(2030, 5, 2), budget_sec=1e6)
+    job = day_planner.get_plan_job(job_id)
+    assert job["status"] == "queued" and job["plan"] is None
+    day_planner.run_plan_job(job_id)
+    job = day_planner.get_plan_job(job_id)
+    assert job["status"] == "done" and job["plan"]["date"] == "2030-05-02" and job["finished_at"]
+    assert day_planner.get_plan_job("missing") is None
+
+    monkeypatch.setattr(day_planner, "plan_day", lambda *args: 1 / 0)
+    job_id = day_planner.create_plan_job(date(2030, 5, 2))
+    day_planner.run_plan_job(job_id)
+    assert day_planner.get_plan_job(job_id)["status"] == "failed"
+
+
+def test_orphaned_plan_jobs_fail_at_startup_and_the_pool_starts_on_first_plan(session, monkeypatch):
+    import os
+    import subprocess
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import date
+    from app.services import day_planner
+
+    monkeypatch.setattr(day_planner, "engine", session.get_bind())
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    jobs = {}
+    for name, pid in (("exited", exited.pid), ("unowned", None), ("this process", os.getpid()),
+                      ("live sibling", os.getppid())):
+        jobs[name] = day_planner.create_plan_job(date(2030, 5, 2))
+        row = session.get(day_planner.DayPlanJob, jobs[name])
+        row.owner_pid = pid
+        session.add(row)
+    session.commit()
+    assert day_planner.fail_orphaned_jobs() == 3
+    status = {name: day_planner.get_plan_job(job_id)["status"] for name, job_id in jobs.items()}
+    assert status == {"exited": "failed", "unowned": "failed", "this process": "failed", "live sibling": "queued"}
+
+    created = []
+
+    class Pool(ThreadPoolExecutor):
+        def __init__(self, max_workers, mp_context):
+            created.append(max_workers)
+            super().__init__(max_workers)
+
+    monkeypatch.setattr(day_planner, "ProcessPoolExecutor", Pool)
+    monkeypatch.setattr(day_planner, "_pool", None)
+    monkeypatch.setattr(day_planner, "PLAN_WORKERS", 2)
+    problem = day_planner.PlanProblem([1, 2], [7], [0.0, 60.0], [10.0, 70.0], [5.0, 5.0],
+                                      [[1.0, 1.0]], [[0.0, 1.0], [1.0, 0.0]])
+    day_planner.solve_parallel(problem, workers=1, budget_sec=1)
+    assert created == []  # a single run needs no pool
+    try:
+        for _ in range(2):
+            _, routes, unplanned = day_planner.solve_parallel(problem, workers=2, budget_sec=1)
+            assert routes == [[0, 1]] and unplanned == []
+        assert created == [2]  # created once, on the first parallel plan
+    finally:
+        day_planner.stop_pool()
+
+
+def test_commitment_index_finds_overlaps_by_bisect():
+    from datetime import datetime, timedelta
+    index = commitments.CommitmentIndex()
+    at = datetime(2030, 1, 1, 9)
+    index.add(1, at, at + timedelta(hours=3), ride_id=10)  # long window first
+    index.add(1, at + timedelta(hours=4), at + timedelta(hours=4, minutes=30), ride_id=11)
+    assert not index.is_free(1, at + timedelta(hours=2), at + timedelta(hours=2, minutes=10))
+    assert index.is_free(1, at + timedelta(hours=3), at + timedelta(hours=4))  # the gap, ends touching
+    assert not index.is_free(1, at + timedelta(hours=3), at + timedelta(hours=4, minutes=1))
+    assert index.is_free(2, at, at + timedelta(hours=5))
+    assert not index.reserve(1, at + timedelta(hours=1), at + timedelta(hours=2), ride_id=12)
+    assert index.remove(10) == 1 and index.is_free(1, at, at + timedelta(hours=3))
+
+
+def test_commitment_index_stays_consistent_under_concurrent_reserve_and_remove(monkeypatch):
+    import threading
+    import time
+    from bisect import bisect_left, insort
+    from datetime import datetime, timedelta
+
+    def yielding(fn):
+        def wrapper(*args):
+            result = fn(*args)
+            time.sleep(0)  # hand the GIL over mid-update, where a race would show
+            return result
+        return wrapper
+
+    monkeypatch.setattr(commitments, "bisect_left", yielding(bisect_left))
+    monkeypatch.setattr(commitments, "insort", yielding(insort))
+    index = commitments.CommitmentIndex()
+    at = datetime(2030, 1, 1)
+    errors = []
+
+    def churn(offset):
+        try:
+            for k in range(300):
+                ride_id = offset * 1000 + k
+                start = at + timedelta(minutes=(k * 4 + offset) * 10)  # threads' windows interleave
+                assert index.reserve(1, start, start + timedelta(minutes=5), ride_id)
+                if k % 2:
+                    index.remove(ride_id)
+        except Exception as exc:  # IndexError, or a reservation refused by a corrupted index
+            errors.append(exc)
+
+    threads = [threading.Thread(target=churn, args=(t,)) for t in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    windows = index.windows(1)
+    assert len(index) == len(windows) == 4 * 150
+    assert index._starts[1] == [w[0] for w in windows] == sorted(w[0] for w in windows)
+
+
+def test_committed_driver_is_skipped_and_reserved_ride_goes_to_its_driver(session):
+    from datetime import datetime, timedelta
+    near = Driver(name="Near", vehicle_type="van", plate_number="N", current_lat=14.60, current_lng=120.98)
+    far = Driver(name="Far", vehicle_type="van", plate_number="F", current_lat=14.62, current_lng=121.00)
+    session.add_all([near, far])
+    session.commit()
+    booked = _make_ride(session, 14.70, 121.05)
+    booked.scheduled_for = datetime.utcnow() + timedelta(minutes=30)
+    booked.driver_id = near.driver_id
+    session.add(booked)
+    session.commit()
+    assert commitments.reserve(booked, near.driver_id)
+
+    # "Near" is free now but must leave for its booking within the next ride's window
+    now_ride = _make_ride(session, 14.60, 120.98)
+    assert scheduler.assign_driver_to_ride(session, now_ride).driver_id == far.driver_id
+
+    session.refresh(booked)
+    assigned = scheduler.assign_driver_to_ride(session, booked)
+    assert assigned.driver_id == near.driver_id and assigned.status == "assigned"
+
+
+def test_dispatched_scheduled_ride_holds_its_window_as_after_a_restart(session):
+    from datetime import datetime, timedelta
+    driver = Driver(name="Only", vehicle_type="van", plate_number="O", current_lat=14.60, current_lng=120.98)
+    session.add(driver)
+    session.commit()
+    ride = _make_ride(session, 14.60, 120.98)
+    ride.scheduled_for = datetime.utcnow() + timedelta(minutes=10)
+    session.add(ride)
+    session.commit()
+
+    assert scheduler.assign_driver_to_ride(session, ride).driver_id == driver.driver_id
+    live = commitments.commitments.windows(driver.driver_id)
+    assert [w[2] for w in live] == [ride.ride_id]
+    overlapping = _make_ride(session, 14.61, 120.99)
+    overlapping.scheduled_for = ride.scheduled_for + timedelta(minutes=5)
+    assert not commitments.reserve(overlapping, driver.driver_id)  # a booking gets 409, restart or not
+
+    assert commitments.load_commitments(session) == 1
+    assert commitments.commitments.windows(driver.driver_id) == live
+
+
+def test_freed_nearby_driver_takes_over_an_assigned_ride(session):
+    from app.services import reassign
+    far = Driver(name="Far", vehicle_type="van", plate_number="F", current_lat=14.60, current_lng=121.03)
+    near = Driver(name="Near", vehicle_type="van", plate_number="N", availability_status="on_ride",
+                  current_lat=14.60, current_lng=120.981)
+    session.add_all([far, near])
+    session.commit()
+    ride = _make_ride(session, 14.60, 120.98)
+    assert scheduler.assign_driver_to_ride(session, ride).driver_id == far.driver_id
+    assert ride.ride_id in ride_index.assigned_rides
+
+    near.availability_status = "available"
+    session.add(near)
+    session.commit()
+    assert reassign.reassign_for(session, near.driver_id) == [ride.ride_id]
+    session.refresh(ride)
+    session.refresh(far)
+    assert ride.driver_id == near.driver_id and far.availability_status == "available"
+    # the gain runs the other way now, so nothing moves back
+    assert reassign.reassign_for(session, far.driver_id) == []
+
+
+def test_started_ride_is_never_moved(session):
+    from app.routers.ride_requests import start_ride
+    from app.services import reassign
+    far = Driver(name="Far", vehicle_type="van", plate_number="F", current_lat=14.60, current_lng=121.03)
+    near = Driver(name="Near", vehicle_type="van", plate_number="N", availability_status="on_ride",
+                  current_lat=14.60, current_lng=120.981)
+    session.add_all([far, near])
+    session.commit()
+    ride = _make_ride(session, 14.60, 120.98)
+    assert scheduler.assign_driver_to_ride(session, ride).driver_id == far.driver_id
+    assert start_ride(ride.ride_id, session).status == "ongoing"
+    assert ride.ride_id not in ride_index.assigned_rides
+
+    near.availability_status = "available"
+    session.add(near)
+    session.commit()
+    assert reassign.reassign_for(session, near.driver_id) == []
+    # even if the index still listed it, the conditional UPDATE refuses
+    assert not reassign.hand_over(session, ride, far.driver_id, near.driver_id)
+    session.refresh(ride)
+    assert ride.driver_id == far.driver_id and ride.status == "ongoing"
+
+
+def test_assignments_are_logged_with_a_cost_breakdown(session, monkeypatch):
+    from sqlmodel import select
+    from app.models.models import DispatchDecision
+    from app.services import decision_log
+    from app.services.analytics import dispatch_decision_summary
+
+    from app.services import eta_cache, google_maps
+
+    class Matrix:  # Distance Matrix answer: 5 min / 2 km for the first origin, 9 min / 4 km for the second
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            legs = [(300, 2000), (540, 4000)][: len(calls[-1]["origins"].split("|"))]
+            return {"status": "OK", "rows": [
+                {"elements": [{"status": "OK", "duration": {"value": d}, "distance": {"value": m}}]} for d, m in legs
+            ]}
+
+    calls = []
+    monkeypatch.setattr(scheduler, "get_eta_and_distance_minutes_many", google_maps.get_eta_and_distance_minutes_many)
+    monkeypatch.setattr(google_maps, "GOOGLE_MAPS_API_KEY", "test-key")
+    monkeypatch.setattr(eta_cache, "ETA_CACHE_ENABLED", False)
+    monkeypatch.setattr(google_maps.http_client, "get", lambda url, params=None, **k: calls.append(params) or Matrix())
+    for name, lng in (("A", 120.981), ("B", 120.99)):
+        session.add(Driver(name=name, vehicle_type="van", plate_number=name, current_lat=14.60, current_lng=lng))
+    session.commit()
+    ride = _make_ride(session, 14.60, 120.98)
+
+    writer = decision_log.DecisionWriter()
+    monkeypatch.setattr(decision_log, "writer", writer)
+    writer.start(session.get_bind())
+    assert scheduler.assign_driver_to_ride(session, ride) is not None
+    writer.stop()
+
+    row = session.exec(select(DispatchDecision)).one()
+    assert (row.ride_id, row.path, row.candidates, row.maps_calls) == (ride.ride_id, "single", 2, 1)
+    assert len(calls) == 1  # counted at the network call, not before the cached wrapper
+    assert row.runner_up_margin == pytest.approx((4.0 - 2.0) + (9.0 - 5.0) * scoring.ETA_WEIGHT)
+    assert row.total_ms >= row.db_ms + row.maps_ms + row.scoring_ms - 1e-6
+    summary = dispatch_decision_summary(session, hours=1)
+    assert summary["decisions"] == 1 and summary["slowest"][0]["ride_id"] == ride.ride_id
+
+
+def test_rides_only_search_their_vehicle_pool(session):
+    session.add_all([
+        Driver(name="Van", vehicle_type="van", plate_number="V", current_lat=14.60, current_lng=120.981),
+        Driver(name="Lift", vehicle_type="Wheelchair Van", plate_number="W", current_lat=14.62, current_lng=121.00),
+    ])
+    session.commit()
+    driver_index.load_available_drivers(session)
+    assert driver_index.available_drivers.counts() == {"van": 1, "wheelchair van": 1}
+
+    ride = _make_ride(session, 14.60, 120.98)
+    ride.required_vehicle_type = "wheelchair  van"
+    session.add(ride)
+    session.commit()
+    assert [d.name for d in scheduler.load_candidates(session, ride)] == ["Lift"]
+    assert session.get(Driver, scheduler.assign_driver_to_ride(session, ride).driver_id).name == "Lift"
+
+    other = _make_ride(session, 14.60, 120.98)
+    other.required_vehicle_type = "wheelchair van"
+    assert scheduler.load_candidates(session, other) == []  # the only lift van is taken
+
+
+def test_dispatch_lease_and_leader_forwarding(session, monkeypatch, tmp_path):
+    from datetime import datetime, timedelta
+    from app.services import leader
+
+    monkeypatch.setattr(leader, "engine", session.get_bind())
+    assert leader.acquire_lease("a", ttl_sec=60)
+    assert not leader.acquire_lease("b", ttl_sec=60)
+    assert leader.acquire_lease("a", ttl_sec=-1)  # renewal, already expired
+    assert leader.acquire_lease("b", ttl_sec=60)
+    assert leader.lease_info()["holder"] == "b"
+
+    address = str(tmp_path / "leader.sock")
+    server = leader.LeaderServer(address, b"test", loop=None)
+    server.start()
+    try:
+        client = leader.LeaderClient(address, b"test")
+        t0 = datetime(2030, 1, 1, 8, 0)
+        assert client.call("reserve", 7, t0, t0 + timedelta(hours=1), 1)
+        assert not client.call("reserve", 7, t0 + timedelta(minutes=30), t0 + timedelta(hours=2), 2)  # overlaps ride 1
+        assert commitments.commitments.driver_for(1) == 7
+    finally:
+        server.stop()
+
+
+def test_leader_answers_forwarded_rides_at_once_and_caps_connections(monkeypatch, tmp_path):
+    import asyncio
+    import threading
+    import time
+    from app.services import dispatcher as dispatcher_module, leader
+
+    release, handled = threading.Event(), []
+
+    def slow_assign(ride_id):  # candidate load + Maps on the leader
+        release.wait(5)
+        handled.append(ride_id)
+        return True
+
+    monkeypatch.setattr(dispatcher_module, "assign_one", slow_assign)
+    address = str(tmp_path / "leader.sock")
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        d = dispatcher_module.Dispatcher(mode="inline")
+        monkeypatch.setattr(leader, "dispatcher", d)
+        d.start()
+        server = leader.LeaderServer(address, b"key", loop, max_connections=1)
+        server.start()
+        try:
+            first = leader.LeaderClient(address, b"key")
+            t0 = time.monotonic()
+            assert await loop.run_in_executor(None, first.call, "assign", 9) is None
+            assert time.monotonic() - t0 < 1 and handled == []  # replied before the assignment ran
+            with pytest.raises(ConnectionError):  # the only slot is held by `first`
+                await loop.run_in_executor(None, leader.LeaderClient(address, b"key").call, "ride", 1)
+            release.set()
+            while not handled:
+                await asyncio.sleep(0.01)
+        finally:
+            release.set()
+            server.stop()
+            await d.stop()
+
+    asyncio.run(scenario())
+    assert handled == [9]
+
+
+def test_unforwarded_rides_are_resent_and_the_authkey_is_never_a_default(monkeypatch, tmp_path):
+    import os
+    from app.services import leader
+
+    sent = []
+    monkeypatch.setattr(leader, "assign_one", sent.append)
+    monkeypatch.setattr(leader.dispatcher, "mode", "sync")
+    address = str(tmp_path / "leader.sock")
+    client = leader.LeaderClient(address, b"key")
+    client.assign(5)  # no leader yet: kept, not dropped
+    assert client.resend() == 0 and sent == []
+
+    server = leader.LeaderServer(address, b"key", loop=None)
+    server.start()
+    try:
+        assert client.resend() == 1 and sent == [5]
+        assert client.resend() == 0
+    finally:
+        server.stop()
+
+    key_file = str(tmp_path / "authkey")
+    key = leader.load_authkey("", key_file)
+    assert len(key) >= 32 and os.stat(key_file).st_mode & 0o777 == 0o600
+    assert leader.load_authkey("", key_file) == key  # shared by every process
+    assert leader.load_authkey("configured", key_file) == b"configured"
+    os.chmod(key_file, 0o644)
+    with pytest.raises(RuntimeError):
+        leader.load_authkey("", key_file)
+
+
+def test_grid_search_widens_past_rejected_and_corner_hits():
+    idx = GridIndex(cell_km=1.0)
+    deg = idx.cell_deg
+    lat, lng = 0.5 * deg, 0.01 * deg                       # near the west edge of its cell
+    idx.upsert(1, 0.99 * deg, 0.99 * deg)                  # same cell, far corner (~1.1 km)
+    idx.upsert(2, lat, -1.04 * deg)                        # two rings west, but ~1.05 km away
+    idx.upsert(3, lat, 4.5 * deg)                          # four rings east
+    assert {1, 2} <= set(idx.nearby(lat, lng))
+    # drivers near the pickup are rejected (e.g. committed): keep widening
+    assert idx.nearby(lat, lng, accept=lambda i: i == 3) == [3]
+
+
+def test_committed_nearby_drivers_do_not_hide_free_ones_further_out(session):
+    from datetime import datetime, timedelta
+
+    near = Driver(name="Near", vehicle_type="van", plate_number="N", current_lat=14.60, current_lng=120.981)
+    far = Driver(name="Far", vehicle_type="van", plate_number="F", current_lat=14.60, current_lng=121.03)
+    session.add_all([near, far])
+    session.commit()
+    driver_index.load_available_drivers(session)
+    now = datetime.utcnow()
+    commitments.commitments.add(near.driver_id, now - timedelta(hours=1), now + timedelta(hours=3), 999)
+
+    ride = _make_ride(session, 14.60, 120.98)
+    assert [d.name for d in scheduler.load_candidates(session, ride)] == ["Far"]
+
+
+@pytest.mark.parametrize("state", ["sql", "memory"])
+def test_simulator_runs_a_short_offline_load(state):
+    from benchmarks import simulator
+
+    stats = simulator.simulate(drivers=15, riders=20, rate_per_min=4.0, minutes=10.0, state=state, seed=7)
+    assert set(stats) == {
+        "state", "drivers", "requests", "assigned", "queued_on_arrival", "never_served", "latency_p50_ms",
+        "latency_p95_ms", "latency_p99_ms", "assignments_per_sec", "mean_wait_min", "mean_queue_wait_min",
+    }
+    assert stats["requests"] > 0 and stats["assigned"] + stats["never_served"] == stats["requests"]
+    assert stats["latency_p50_ms"] <= stats["latency_p99_ms"]
+    assert state in simulator.format_report(stats)